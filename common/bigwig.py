@@ -0,0 +1,94 @@
+"""
+BigWig tracks read straight into numpy arrays with pyBigWig, without a wig round trip. Usage:
+---
+with BigWig(path) as bw:
+    fr, to, vals = bw.intervals('chrI')  # the stored intervals, 0-based and half open
+    pos, vals = bw.positions('chrI')  # every non-zero position and its value
+    vals = bw.binned('chrI', 100)  # mean of every 100bp bin (over all its bases), from the zoom levels where possible
+---
+Chromosomes that are not in the file are empty.
+"""
+
+import numpy as np
+
+
+def interval_positions(fr, to):
+    """
+    :return: every position covered by the (from, to) intervals, in interval order
+    """
+    lens = to - fr
+    return np.repeat(fr - np.cumsum(lens) + lens, lens) + np.arange(lens.sum())
+
+
+class BigWig(object):
+
+    def __init__(self, path):
+        try:
+            import pyBigWig
+        except ImportError:
+            raise ValueError('reading BigWig files requires the pyBigWig package')
+        self.path = path
+        self.bw = pyBigWig.open(path)
+        if self.bw is None: raise IOError('could not open BigWig file %s' % path)
+        self.chroms = self.bw.chroms()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.bw.close()
+
+    def intervals(self, chr):
+        """
+        :return: from, to and value arrays of the intervals stored for chr
+        """
+        ivs = self.bw.intervals(chr) if chr in self.chroms else None
+        if not ivs: return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0)
+        ivs = np.array(ivs, dtype=float)
+        return ivs[:, 0].astype(np.int64), ivs[:, 1].astype(np.int64), ivs[:, 2]
+
+    def positions(self, chr):
+        """
+        :return: the positions (0-based) with a non-zero value, and their values
+        """
+        fr, to, vals = self.intervals(chr)
+        keep = (vals != 0) & ~np.isnan(vals)
+        fr, to, vals = fr[keep], to[keep], vals[keep]
+        return interval_positions(fr, to), np.repeat(vals, to - fr)
+
+    def values(self, chr, length=None):
+        """
+        :param length: length of the output, default is the chromosome length in the file
+        :return: a dense array of the values of chr, 0 where there is no data
+        """
+        if length is None: length = self.chroms.get(chr, 0)
+        v = np.zeros(length)
+        fr, to, vals = self.intervals(chr)
+        v[interval_positions(fr, to)] = np.repeat(vals, to - fr)
+        return v
+
+    def binned(self, chr, bin_size, stat='mean', exact=False):
+        """
+        summarize chr in bins, computed from the file zoom levels unless exact is set (or no zoom level fits)
+
+        :param stat: mean, max, min, coverage or std. The mean is over all bases of the bin (bases without data count
+                     as 0, as in values), the rest are over the bases with data
+        :return: an array of the statistic of every bin, 0 for bins without data
+        """
+        if chr not in self.chroms: return np.zeros(0)
+        vals = self.bin_stats(chr, bin_size, stat, exact)
+        if stat == 'mean': vals *= self.bin_stats(chr, bin_size, 'coverage', exact)  # pyBigWig means are over data
+        return vals
+
+    def bin_stats(self, chr, bin_size, stat, exact):
+        l = self.chroms[chr]
+        n = (l - 1) // bin_size + 1
+        if l % bin_size:  # the last bin is partial
+            vals = self.bw.stats(chr, 0, (n - 1) * bin_size, type=stat, nBins=n - 1, exact=exact) if n > 1 else []
+            vals += self.bw.stats(chr, (n - 1) * bin_size, l, type=stat, exact=exact)
+        else:
+            vals = self.bw.stats(chr, 0, l, type=stat, nBins=n, exact=exact)
+        return np.nan_to_num(np.array(vals, dtype=float))
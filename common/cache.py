@@ -0,0 +1,121 @@
+"""
+A content-addressed cache for pipeline stages. Usage:
+---
+cache = StageCache(output_dir + os.sep + CACHE_DIR)
+key = cache.key(upstream_key, param1, param2)
+hit, result = cache.lookup('align', sample_name, key)
+if not hit:
+    result = align(...)
+    cache.store('align', sample_name, key, [bam_path], result)
+---
+Every (stage, name) pair has a single manifest holding the key it was computed with, a fingerprint of every
+output file and the (json-able) result of the stage. A lookup is a hit only if the keys match and all outputs are
+still present and unchanged.
+"""
+
+import hashlib
+import json
+import os
+import shlex as sh
+import subprocess as sp
+import time
+from collections import OrderedDict
+
+from common.config import *
+
+FINGERPRINT_BLOCK = 2 ** 20
+
+
+def file_fingerprint(path, block=FINGERPRINT_BLOCK):
+    """
+    A cheap content fingerprint - small files are fully hashed, large files are identified by their size and their
+    first and last blocks (hashing a 50G fastq on every run defeats the purpose).
+
+    :return: a hex digest, or None if path does not exist
+    """
+    if not os.path.isfile(path): return None
+    size = os.path.getsize(path)
+    h = hashlib.sha1(str(size).encode('utf8'))
+    with open(path, 'rb') as IN:
+        if size <= 2 * block:
+            h.update(IN.read())
+        else:
+            h.update(IN.read(block))
+            IN.seek(-block, os.SEEK_END)
+            h.update(IN.read(block))
+    return h.hexdigest()
+
+
+def tool_versions(names):
+    """
+    :param names: keys of the EXEC map in config
+    :return: a map from executable name to the first line of its version output ('NA' if not available)
+    """
+    versions = OrderedDict()
+    for name in names:
+        try:
+            p = sp.Popen(sh.split('%s --version' % EXEC[name]), stdout=sp.PIPE, stderr=sp.STDOUT)
+            out = p.communicate()[0].decode('utf8').strip().split('\n')
+            versions[name] = out[0].strip() if out else 'NA'
+        except OSError:
+            versions[name] = 'NA'
+    return versions
+
+
+class StageCache(object):
+
+    def __init__(self, cache_dir, enabled=True):
+        self.cache_dir = cache_dir
+        self.enabled = enabled
+        os.makedirs(cache_dir, exist_ok=True)
+
+    @staticmethod
+    def key(*parts):
+        """
+        :param parts: any json-able objects (non json-able objects are converted with str)
+        :return: a hex digest identifying the parts
+        """
+        s = json.dumps(parts, sort_keys=True, default=str)
+        return hashlib.sha1(s.encode('utf8')).hexdigest()
+
+    def manifest_path(self, stage, name):
+        return os.sep.join([self.cache_dir, stage, name + '.json'])
+
+    def lookup(self, stage, name, key, check_outputs=True):
+        """
+        :param check_outputs: if False, a matching key suffices (used when outputs were consumed by a later stage
+                              that is itself cached)
+        :return: (hit, result) - result is None if not hit
+        """
+        if not self.enabled: return False, None
+        try:
+            with open(self.manifest_path(stage, name)) as IN:
+                manifest = json.load(IN, object_pairs_hook=OrderedDict)
+        except (IOError, ValueError):
+            return False, None
+        if manifest['key'] != key: return False, None
+        if check_outputs:
+            for path, fp in manifest['outputs'].items():
+                if file_fingerprint(path) != fp: return False, None
+        return True, manifest['result']
+
+    def store(self, stage, name, key, outputs, result):
+        """
+        write a manifest for the stage. Writing is atomic, so a crash never leaves a valid-looking partial manifest.
+
+        :param outputs: paths of files generated by the stage
+        :param result: a json-able stage result, returned on future hits
+        """
+        if not self.enabled: return
+        os.makedirs(self.cache_dir + os.sep + stage, exist_ok=True)
+        manifest = OrderedDict([('key', key),
+                                ('time', time.strftime('%Y-%m-%d %H:%M:%S')),
+                                ('outputs', OrderedDict((p, file_fingerprint(p)) for p in outputs)),
+                                ('result', result)])
+        path = self.manifest_path(stage, name)
+        with open(path + '.tmp', 'w') as OUT: json.dump(manifest, OUT, indent=1)
+        os.replace(path + '.tmp', path)
+
+    def invalidate(self, stage, name):
+        path = self.manifest_path(stage, name)
+        if os.path.isfile(path): os.remove(path)
@@ -0,0 +1,57 @@
+"""
+Sample columns of per chromosome (positions x samples) matrices, spilled to disk one sample at a time, and assembled
+into a chromosome matrix without holding more than one sample column in memory. Usage:
+---
+for si, sample in enumerate(samples):
+    for c, pos, vals in read(sample):  # the non-zero positions of every chromosome, and their values
+        save_column(dirs[si], c, pos, vals)
+m = sparse_chr(dirs, 'chrI', L)  # an L x S csc_matrix
+m = fill_dense_chr(dirs, 'chrI', np.zeros((L, S)))  # or any L x S array, e.g. a memory map
+---
+"""
+
+import os
+
+import numpy as np
+from scipy import sparse
+
+
+def save_column(sample_dir, chr, pos, vals):
+    """
+    write the non-zero positions and values of chr in a sample to <chr>.pos.npy and <chr>.val.npy in sample_dir
+    """
+    np.save(sample_dir + os.sep + chr + '.pos.npy', np.asarray(pos, dtype=np.int64))
+    np.save(sample_dir + os.sep + chr + '.val.npy', np.asarray(vals, dtype=float))
+
+
+def chr_columns(sample_dirs, chr):
+    """
+    :return: yields the (positions, values) arrays of chr in every sample, memory mapped
+    """
+    for d in sample_dirs:
+        yield (np.load(d + os.sep + chr + '.pos.npy', mmap_mode='r'),
+               np.load(d + os.sep + chr + '.val.npy', mmap_mode='r'))
+
+
+def sparse_chr(sample_dirs, chr, L):
+    """
+    :return: an L x S csc_matrix of chr, built directly from the sample columns
+    """
+    lens, indices, data = [0], [], []
+    for pos, vals in chr_columns(sample_dirs, chr):
+        lens.append(len(pos))
+        indices.append(pos)
+        data.append(vals)
+    m = sparse.csc_matrix((np.concatenate(data), np.concatenate(indices), np.cumsum(lens)),
+                          shape=(L, len(sample_dirs)), dtype=float)
+    m.sort_indices()
+    return m
+
+
+def fill_dense_chr(sample_dirs, chr, out):
+    """
+    fill an L x S array (e.g. a memory map) with chr, a sample column at a time
+    """
+    for si, (pos, vals) in enumerate(chr_columns(sample_dirs, chr)):
+        out[pos, si] = vals
+    return out
@@ -14,6 +14,7 @@ BW_DIR = 'BIGWIG'
 UNALIGNED_DIR = 'unaligned'
 FILTERED_DIR = 'filtered'
 TMP_DIR = '.tmp'
+CACHE_DIR = '.cache'
 
 # file suffixes
 SAM_HDR_SUFF = '.sam.hdr'
@@ -31,6 +32,7 @@ BC_COUNTS_FNAME = 'bc-counts-%s'
 # executables
 EXEC = {
     'BOWTIE': 'bowtie2',
+    'BOWTIE_BUILD': 'bowtie2-build',
     'SAMTOOLS': 'samtools',
     'BEDTOOLS': 'bedtools',
     'SLURM': 'sbatch',
@@ -7,6 +7,18 @@ print(55==slurm.execute(f, args=(2,5))) # True!
 ---
 It's also possible to pass key-word arguments to f.
 CRITICAL: if f uses any non built-in modules, they must be imported within f
+
+For many tasks, a SlurmBackend submits tasks with identical specifications as a single job array, and tracks all
+submitted jobs with a single poller thread:
+---
+backend = slurm.SlurmBackend(tmp_path)
+backend.submit([(f, (2,5), {}, {'mem': '4G'}, callback), (f, (3,5), {}, {'mem': '4G'}, callback)])
+# callback(out, err) is called from the poller thread when each task is done
+backend.close()
+---
+Passing cluster=LocalCluster(...) to a SlurmBackend runs the same submission and polling logic against a local
+stand-in for slurm, for testing and benchmarking without a cluster.
+---
 ''' #TODO: change this...
 
 import os
@@ -16,84 +28,517 @@ project_dir = os.path.sep.join(sys.modules[__name__].__file__.split(os.path.sep)
 sys.path.append(project_dir)
 from common.config import *
 
+import binascii
+import queue
+import re
+import socket
+import threading
 import time
 import shlex as sh
 import subprocess as sp
 import sys
 import traceback
+import uuid
+from collections import Counter, OrderedDict
+from multiprocessing.connection import AuthenticationError, Client, Listener
 
 import dill
 
+AUTHKEY_VAR = 'SLURM_TRANSPORT_KEY'
+TERMINAL_STATES = {'COMPLETED', 'FAILED', 'CANCELLED', 'TIMEOUT', 'OUT_OF_MEMORY', 'NODE_FAIL', 'PREEMPTED',
+                   'BOOT_FAIL', 'DEADLINE'}
 
-def pkl_args(id):
-    return '.%s.pkl.args' % id
 
+def pkl_args(spool, tid):
+    return '%s%s.%s.pkl.args' % (spool, os.path.sep, tid)
 
-def pkl_output(id):
-    return '.%s.pkl.out' % id
 
+def pkl_output(spool, tid):
+    return '%s%s.%s.pkl.out' % (spool, os.path.sep, tid)
 
-def execute(f, args, kwargs, slurm_spec, interval=.2, tmp_path=None):
-    if tmp_path is None: tmp_path = '.'
-    # prepare python input
-    execblob = (f, args, kwargs)
-    id = hash(str(execblob))
-    id = id ** 2
-    with open(pkl_args(id), 'wb') as OUT: dill.dump(execblob, OUT)
-
-    # sbatch script
-    tmpscript = '%s%s.%s.slurmscript' % (tmp_path, os.path.sep, id)
-    with open(tmpscript, 'w') as script:
-        script.write('#! /bin/bash \n')
-        script.write('%s %s %s\n' % (INTERPRETER, __file__, id))
-
-    scriptout = '%s%s.%s.slurmout' % (tmp_path, os.path.sep, id)
-
-    # execute
-    opts = ' '.join('--%s=%s' % (k,str(v)) for k,v in slurm_spec.items())
-    command = 'sbatch %s %s --output=%s' % (opts, tmpscript, scriptout)
-    p = sp.Popen(sh.split(command), stderr=sp.PIPE, stdout=sp.PIPE)
-    out, err = p.communicate()
-
-    # monitor until done and file is available
-    jid, done = out.decode('utf8').strip().split(' ')[-1], False
-    while not done:
-        time.sleep(interval)
-        q = sp.Popen("squeue",stdout=sp.PIPE).communicate()[0].decode('utf8').split('\n')
-        done = True
-        for line in q:
-            if line.strip().split(' ')[0] == jid:
-                done = False
-                break
-
-    err = None
-    while not os.path.isfile(pkl_output(id)):
+
+def slurm_out(tmp_path, bid, i='%a'):
+    return '%s%s.%s.%s.slurmout' % (tmp_path, os.path.sep, bid, i)
+
+
+class FileTransport(object):
+    """
+    Task inputs and outputs are passed as dill files in a spool folder, which must be shared with the cluster
+    nodes. Outputs are written under a temporary name and then renamed, so a visible output is always complete.
+    """
+    name = 'files'
+
+    def __init__(self, spool):
+        self.spool = spool
+
+    def start(self, deliver): pass  # outputs are fetched by the poller
+
+    def add(self, tid, blob):
+        with open(pkl_args(self.spool, tid), 'wb') as OUT: OUT.write(blob)
+
+    def worker_args(self):
+        return [self.spool]
+
+    def worker_env(self):
+        return {}
+
+    def fetch(self, tid):
+        """
+        :return: the (out, err) of the task, or None if not available
+        """
+        if not os.path.isfile(pkl_output(self.spool, tid)): return None
+        with open(pkl_output(self.spool, tid), 'rb') as IN: return dill.load(IN)
+
+    def discard(self, tid):
+        for f in [pkl_args(self.spool, tid), pkl_output(self.spool, tid)]:
+            if os.path.isfile(f): os.remove(f)
+
+    def close(self): pass
+
+    @staticmethod
+    def receive(params, tid):
+        with open(pkl_args(params[0], tid), 'rb') as IN: return IN.read()
+
+    @staticmethod
+    def send(params, tid, blob):
+        with open(pkl_output(params[0], tid) + '.tmp', 'wb') as OUT: OUT.write(blob)
+        os.rename(pkl_output(params[0], tid) + '.tmp', pkl_output(params[0], tid))
+
+
+class SocketTransport(object):
+    """
+    Task inputs are served to workers, and outputs are pushed back by them, over authenticated TCP connections to
+    a server thread. Nothing is passed through the file system, and outputs are delivered as soon as they are sent.
+    """
+    name = 'tcp'
+
+    def __init__(self, host=None):
+        """
+        :param host: the name by which cluster nodes reach this machine, default is its host name
+        """
+        self.authkey = os.urandom(16)
+        self.listener = Listener(('', 0), authkey=self.authkey)
+        self.host = socket.gethostname() if host is None else host
+        self.port = self.listener.address[1]
+        self.tasks = {}
+        self.deliver = None
+        self.closed = False
+        self.server = threading.Thread(target=self.serve)
+        self.server.daemon = True
+
+    def start(self, deliver):
+        """
+        :param deliver: deliver(tid, out, err) is called (from a server thread) when a task output is received
+        """
+        self.deliver = deliver
+        self.server.start()
+
+    def add(self, tid, blob):
+        self.tasks[tid] = blob
+
+    def worker_args(self):
+        return [self.host, str(self.port)]
+
+    def worker_env(self):
+        return {AUTHKEY_VAR: binascii.hexlify(self.authkey).decode('ascii')}
+
+    def fetch(self, tid):
+        return None  # outputs are delivered when received
+
+    def discard(self, tid):
+        self.tasks.pop(tid, None)
+
+    def serve(self):
+        while not self.closed:
+            try: conn = self.listener.accept()
+            except (OSError, EOFError, AuthenticationError): continue
+            h = threading.Thread(target=self.handle, args=(conn,))
+            h.daemon = True
+            h.start()
+
+    def handle(self, conn):
+        try:
+            op, tid = conn.recv()
+            if op == 'get':
+                conn.send_bytes(self.tasks[tid])
+            elif op == 'put':
+                out, err = dill.loads(conn.recv_bytes())
+                self.deliver(tid, out, err)
+                conn.send('ok')  # the worker exits (and leaves the queue) only after its output is delivered
+        except (OSError, EOFError, KeyError): pass
+        finally: conn.close()
+
+    def close(self):
+        self.closed = True
+        self.listener.close()
+
+    @staticmethod
+    def connect(params):
+        return Client((params[0], int(params[1])), authkey=binascii.unhexlify(os.environ[AUTHKEY_VAR]))
+
+    @staticmethod
+    def receive(params, tid):
+        conn = SocketTransport.connect(params)
+        conn.send(('get', tid))
+        blob = conn.recv_bytes()
+        conn.close()
+        return blob
+
+    @staticmethod
+    def send(params, tid, blob):
+        conn = SocketTransport.connect(params)
+        conn.send(('put', tid))
+        conn.send_bytes(blob)
+        conn.recv()  # delivery acknowledgement
+        conn.close()
+
+
+class FallbackTransport(object):
+    """
+    A SocketTransport, for clusters where nodes may not be able to reach this machine. Task inputs are also written
+    to the spool folder, and a worker that can't connect reads its input from, and writes its output to, the spool
+    instead, as with a FileTransport.
+    """
+    name = 'auto'
+
+    def __init__(self, spool, host=None):
+        self.socket = SocketTransport(host)
+        self.files = FileTransport(spool)
+
+    def start(self, deliver):
+        self.socket.start(deliver)
+
+    def add(self, tid, blob):
+        self.socket.add(tid, blob)
+        self.files.add(tid, blob)
+
+    def worker_args(self):
+        return self.socket.worker_args() + self.files.worker_args()
+
+    def worker_env(self):
+        return self.socket.worker_env()
+
+    def fetch(self, tid):
+        return self.files.fetch(tid)  # socket outputs are delivered when received
+
+    def discard(self, tid):
+        self.socket.discard(tid)
+        self.files.discard(tid)
+
+    def close(self):
+        self.socket.close()
+
+    @staticmethod
+    def receive(params, tid):
+        try: return SocketTransport.receive(params[:2], tid)
+        except (OSError, EOFError, AuthenticationError): return FileTransport.receive(params[2:], tid)
+
+    @staticmethod
+    def send(params, tid, blob):
+        try: SocketTransport.send(params[:2], tid, blob)
+        except (OSError, EOFError, AuthenticationError): FileTransport.send(params[2:], tid, blob)
+
+
+TRANSPORTS = {T.name: T for T in [FileTransport, SocketTransport, FallbackTransport]}
+
+
+def make_transport(name, spool):
+    """
+    :param name: a transport name - "tcp", "files" (spool must be shared with the nodes) or "auto" (tcp, falling
+                 back to files for workers that can't connect)
+    """
+    if name not in TRANSPORTS: raise ValueError('unknown transport: %s (%s)' % (name, ', '.join(TRANSPORTS)))
+    return SocketTransport() if name == SocketTransport.name else TRANSPORTS[name](spool)
+
+
+class SlurmCluster(object):
+    """
+    The commands a SlurmBackend uses to talk to slurm
+    """
+
+    def __init__(self):
+        self.stats = Counter()
+
+    def sbatch(self, script, ntasks, slurm_spec, output):
+        """
+        submit script as an array of ntasks tasks
+        :param output: task output path, "%a" is replaced with the task index
+        :return: (job id, error) - job id is None if submission failed
+        """
+        self.stats['sbatch'] += 1
+        opts = ' '.join('--%s=%s' % (k, str(v)) for k, v in slurm_spec.items())
+        command = 'sbatch --array=0-%i %s --output=%s %s' % (ntasks - 1, opts, output, script)
+        out, err = sp.Popen(sh.split(command), stderr=sp.PIPE, stdout=sp.PIPE).communicate()
+        jid = out.decode('utf8').strip().split(' ')[-1]
+        if not jid.isdigit(): return None, err.decode('utf8')
+        return jid, None
+
+    def active(self, jids):
+        """
+        :return: the set of "<jid>_<index>" of all tasks (of given jobs) that are still in the queue, pending array
+                 tasks that sacct does not expand are reported as "<jid>"
+        """
+        self.stats['squeue'] += 1
+        q = sp.Popen(sh.split('squeue -h -r -o %%i -j %s' % ','.join(jids)), stdout=sp.PIPE, stderr=sp.PIPE)
+        out, _ = q.communicate()
+        if q.returncode == 0:
+            return set(line.strip() for line in out.decode('utf8').split('\n') if line.strip())
+        # squeue fails if any of the jobs is no longer known, fall back to accounting
+        self.stats['sacct'] += 1
+        acct = sp.Popen(sh.split('sacct -n -X -P -o JobID,State -j %s' % ','.join(jids)), stdout=sp.PIPE)
+        active = set()
+        for line in acct.communicate()[0].decode('utf8').split('\n'):
+            if not line.strip(): continue
+            tid, state = line.strip().split('|')[:2]
+            if state.split(' ')[0] in TERMINAL_STATES: continue
+            active.add(tid.split('_')[0] if '[' in tid else tid)
+        return active
+
+
+def parse_mem(mem):
+    """
+    :param mem: a slurm memory specification, e.g. 4000, 4G, 512M
+    :return: memory in MB
+    """
+    m = re.match(r'(\d+)([KMGT]?)B?$', str(mem).strip().upper())
+    if m is None: raise ValueError('could not parse memory specification: %s' % mem)
+    return int(m.group(1)) * {'K': 2 ** -10, '': 1, 'M': 1, 'G': 2 ** 10, 'T': 2 ** 20}[m.group(2)]
+
+
+class LocalCluster(object):
+    """
+    A local stand-in for a slurm cluster. Tasks submitted with sbatch specifications are queued for (at least)
+    the given latency, and then run as local processes as long as their cpus and memory requests fit in the given
+    limits. The stats counter holds submission/polling counts and total queueing and running times.
+    """
+
+    def __init__(self, cpus=None, mem='16G', latency=1., interval=.05):
+        """
+        :param cpus: number of cpus to share among running tasks (default - all local cpus)
+        :param mem: memory to share among running tasks
+        :param latency: seconds a task spends in the queue before it is eligible to run
+        """
+        self.cpus = os.cpu_count() if cpus is None else cpus
+        self.mem = parse_mem(mem)
+        self.latency = latency
+        self.interval = interval
+        self.stats = Counter()
+        self.pending = []  # (eligible time, jid, index, cpus, mem, script, output)
+        self.running = {}  # "<jid>_<index>" -> (process, cpus, mem, start time)
+        self.lock = threading.Lock()
+        self.jid = 0
+        self.scheduler = threading.Thread(target=self.schedule)
+        self.scheduler.daemon = True
+        self.scheduler.start()
+
+    def sbatch(self, script, ntasks, slurm_spec, output):
+        self.stats['sbatch'] += 1
+        cpus = int(slurm_spec.get('cpus-per-task', 1))
+        if 'mem' in slurm_spec: mem = parse_mem(slurm_spec['mem'])
+        else: mem = parse_mem(slurm_spec.get('mem-per-cpu', 1000)) * cpus
+        if cpus > self.cpus or mem > self.mem:
+            return None, 'sbatch: error: Requested node configuration is not available'
+        with open(script) as IN: script = IN.read()
+        with self.lock:
+            self.jid += 1
+            t = time.time()
+            for i in range(ntasks):
+                self.pending.append((t + self.latency, str(self.jid), i, cpus, mem, script, output))
+            return str(self.jid), None
+
+    def active(self, jids):
+        self.stats['squeue'] += 1
+        jids = set(jids)
+        with self.lock:
+            tids = ['%s_%i' % (p[1], p[2]) for p in self.pending if p[1] in jids]
+            tids += [tid for tid in self.running if tid.split('_')[0] in jids]
+        return set(tids)
+
+    def schedule(self):
+        while True:
+            time.sleep(self.interval)
+            with self.lock:
+                for tid, (p, cpus, mem, start) in list(self.running.items()):
+                    if p.poll() is None: continue
+                    self.stats['run_time'] += time.time() - start
+                    del self.running[tid]
+                cpus = self.cpus - sum(r[1] for r in self.running.values())
+                mem = self.mem - sum(r[2] for r in self.running.values())
+                now, pending = time.time(), []
+                for task in self.pending:
+                    eligible, jid, i, tcpus, tmem, script, output = task
+                    if eligible > now or tcpus > cpus or tmem > mem:
+                        pending.append(task)
+                        continue
+                    env = dict(os.environ, SLURM_JOB_ID=jid, SLURM_ARRAY_TASK_ID=str(i), SLURM_CPUS_PER_TASK=str(tcpus))
+                    with open(output.replace('%a', str(i)), 'w') as OUT:
+                        p = sp.Popen(['bash', '-c', script], env=env, stdout=OUT, stderr=sp.STDOUT)
+                    self.running['%s_%i' % (jid, i)] = (p, tcpus, tmem, now)
+                    self.stats['tasks'] += 1
+                    self.stats['queue_time'] += now - eligible + self.latency
+                    cpus, mem = cpus - tcpus, mem - tmem
+                self.pending = pending
+
+
+class SlurmBackend(object):
+    """
+    Submits tasks as job arrays (one per group of tasks with identical slurm specifications), and polls the queue
+    for all of them with a single squeue call (falling back to sacct) at an interval that backs off while nothing
+    completes. Task inputs and outputs are passed through a transport - a FallbackTransport (default), a
+    SocketTransport, or a FileTransport.
+    """
+
+    def __init__(self, tmp_path=None, interval=.2, max_interval=5, max_array=1000, result_timeout=120, cluster=None,
+                 transport=None):
+        """
+        :param cluster: the cluster to which jobs are submitted - a SlurmCluster (default) or a LocalCluster
+        :param transport: passes inputs to and outputs from tasks - a FallbackTransport (default), a SocketTransport
+                          or a FileTransport, an object or its name (see make_transport)
+        :param interval: initial polling interval (seconds)
+        :param max_interval: polling interval is doubled up to this value while no task completes
+        :param max_array: maximal number of tasks in a single job array
+        :param result_timeout: seconds to wait for a task output after its job has left the queue
+        """
+        self.tmp_path = '.' if tmp_path is None else tmp_path
+        self.cluster = SlurmCluster() if cluster is None else cluster
+        if transport is None: transport = FallbackTransport(self.tmp_path)
+        elif isinstance(transport, str): transport = make_transport(transport, self.tmp_path)
+        self.transport = transport
+        self.interval = interval
+        self.max_interval = max_interval
+        self.max_array = max_array
+        self.result_timeout = result_timeout
+        self.tasks = OrderedDict()  # task id -> [slurm task id (<jid>_<index>), callback]
+        self.gone = {}  # task id -> time the task left the queue
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.closed = False
+        self.transport.start(self.finish)
+        self.poller = threading.Thread(target=self.poll)
+        self.poller.daemon = True
+        self.poller.start()
+
+    def submit(self, tasks):
+        """
+        :param tasks: a list of (f, args, kwargs, slurm_spec, callback) tuples. callback(out, err) is called when
+                      the task is done, err is None if no exception was raised.
+        """
+        groups = OrderedDict()
+        for task in tasks:
+            groups.setdefault(tuple(sorted(task[3].items())), []).append(task)
+        for spec, group in groups.items():
+            for i in range(0, len(group), self.max_array):
+                self.submit_array(dict(spec), group[i:i + self.max_array])
+        self.wakeup.set()
+
+    def submit_array(self, slurm_spec, tasks):
+        bid = uuid.uuid4().hex
+        for i, (f, args, kwargs, _, callback) in enumerate(tasks):
+            tid = '%s.%i' % (bid, i)
+            self.transport.add(tid, dill.dumps((f, args, kwargs)))
+            with self.lock: self.tasks[tid] = [None, callback]  # an output may arrive before sbatch returns
+
+        # sbatch script
+        tmpscript = '%s%s.%s.slurmscript' % (self.tmp_path, os.path.sep, bid)
+        with open(tmpscript, 'w') as script:
+            script.write('#! /bin/bash \n')
+            for k, v in self.transport.worker_env().items(): script.write('export %s=%s\n' % (k, v))
+            wargs = ' '.join([self.transport.name] + self.transport.worker_args() + [bid])
+            script.write('%s %s %s $SLURM_ARRAY_TASK_ID\n' % (INTERPRETER, __file__, wargs))
+
+        # execute
+        jid, err = self.cluster.sbatch(tmpscript, len(tasks), slurm_spec, slurm_out(self.tmp_path, bid))
+        os.remove(tmpscript)
+        for i in range(len(tasks)):
+            tid = '%s.%i' % (bid, i)
+            if jid is None: self.finish(tid, None, 'slurm submission error: \n %s' % err)
+            else:
+                with self.lock:
+                    if tid in self.tasks: self.tasks[tid][0] = '%s_%i' % (jid, i)
+
+    def finish(self, tid, out, err):
+        with self.lock:
+            task = self.tasks.pop(tid, None)
+            self.gone.pop(tid, None)
+        if task is None: return  # already reported
+        self.transport.discard(tid)
+        bid, i = tid.split('.')
+        if os.path.isfile(slurm_out(self.tmp_path, bid, i)): os.remove(slurm_out(self.tmp_path, bid, i))
+        task[1](out, err)
+
+    def poll(self):
+        interval = self.interval
+        while not self.closed:
+            self.wakeup.wait(interval)
+            if self.wakeup.is_set():
+                self.wakeup.clear()
+                interval = self.interval
+            with self.lock:
+                tasks = [(tid, stid) for tid, (stid, _) in self.tasks.items() if stid is not None]
+            if not tasks: continue
+            active, done = self.cluster.active(sorted(set(stid.split('_')[0] for _, stid in tasks))), False
+            for tid, stid in tasks:
+                if stid in active or stid.split('_')[0] in active:
+                    with self.lock: self.gone.pop(tid, None)
+                    continue
+                res = self.collect(tid, stid)
+                if res is None: continue  # no output yet
+                self.finish(tid, *res)
+                done = True
+            interval = self.interval if done else min(interval * 2, self.max_interval)
+
+    def collect(self, tid, stid):
+        """
+        :return: (out, err) of a task that left the queue, or None if its output is not available yet
+        """
+        res = self.transport.fetch(tid)
+        if res is not None: return res
+        err = None
         try:
-            with open(scriptout) as LOG: log = LOG.read().strip()
+            with open(slurm_out(self.tmp_path, *tid.split('.'))) as LOG: log = LOG.read().strip()
             if log: err = 'slurm error: \n %s' % log
         except IOError: pass
-        if err: break
-        # print('waiting for response for job %s' % jid)
-        time.sleep(interval)
+        if err is None:
+            with self.lock:
+                if tid not in self.tasks: return None  # delivered meanwhile
+                gone = self.gone.setdefault(tid, time.time())
+            if time.time() - gone < self.result_timeout: return None
+            err = 'slurm error: task %s left the queue without output' % stid
+        return None, err
 
-    if err is None:
-        with open(pkl_output(id), 'rb') as IN: out, err = dill.load(IN)
+    def close(self):
+        self.closed = True
+        self.wakeup.set()
+        self.poller.join()
+        self.transport.close()
 
-    os.remove(tmpscript)
-    os.remove(pkl_output(id))
-    os.remove(pkl_args(id))
-    os.remove('slurm-%s.out' % jid)
+
+def execute(f, args, kwargs, slurm_spec, interval=.2, tmp_path=None):
+    c = queue.Queue()
+    backend = SlurmBackend(tmp_path, interval)
+    backend.submit([(f, args, kwargs, slurm_spec, lambda out, err: c.put((out, err)))])
+    out, err = c.get()
+    backend.close()
     if err is not None: raise Exception(err)
     return out
 
 
+def ping(data=None, sleep=0.):
+    """
+    a no-op task for checking and benchmarking the task path, returns data after sleeping for the given seconds
+    """
+    time.sleep(sleep)
+    return data
+
+
 if __name__ == '__main__':
-    id = sys.argv[1]
+    T, params, tid = TRANSPORTS[sys.argv[1]], sys.argv[2:-2], '.'.join(sys.argv[-2:])
     try:
         err = None
-        with open(pkl_args(id), 'rb') as IN:
-            f, args, kwargs = dill.load(IN)
-            out = f(*args,**kwargs)
+        f, args, kwargs = dill.loads(T.receive(params, tid))
+        out = f(*args,**kwargs)
     except Exception:
         out, err = None, traceback.format_exc(10)
-    with open(pkl_output(id), 'wb') as OUT: dill.dump((out, err), OUT)
+    try: blob = dill.dumps((out, err))
+    except Exception: blob = dill.dumps((None, traceback.format_exc(10)))
+    T.send(params, tid, blob)
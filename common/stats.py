@@ -0,0 +1,82 @@
+"""
+An incrementally updated sample statistics table. Usage:
+---
+table = StatsTable(['s1', 's2'], csv_path='stats.csv', snapshot_path='stats.json', interval=5)
+table.add('s1', {'n_reads': 100})  # files are rewritten at most once every 5 seconds
+table.flush()  # e.g. at stage boundaries, or when done
+---
+Both files are replaced atomically, so a reader (or a monitoring script) never sees a partially written table. The
+snapshot is a json of the form {"updated": <time>, "columns": [...], "samples": {<sample>: {<stat>: <value>}}}.
+"""
+
+import csv
+import json
+import os
+import threading
+import time
+from collections import Counter, OrderedDict
+
+FLUSH = 'flush'  # a message for table consumers, requesting a flush
+REQUEST = 'request'  # a message for table consumers, (REQUEST, row) requests a copy of the row
+
+
+class StatsTable(object):
+
+    def __init__(self, rows=(), csv_path=None, snapshot_path=None, interval=5.):
+        """
+        :param rows: row (sample) names, determines the row order (rows of unknown samples are appended)
+        :param interval: minimal number of seconds between automatic flushes
+        """
+        self.rows = OrderedDict((r, Counter()) for r in rows)
+        self.cols = OrderedDict()  # an ordered set, first appearance order
+        self.csv_path = csv_path
+        self.snapshot_path = snapshot_path
+        self.interval = interval
+        self.dirty = False
+        self.last_flush = 0
+        self.lock = threading.RLock()
+
+    def add(self, row, counter):
+        """
+        add the counter values to the row, and flush if the last flush is older than the interval
+        """
+        with self.lock:
+            for k in counter: self.cols.setdefault(k, None)
+            if row not in self.rows: self.rows[row] = Counter()
+            self.rows[row].update(counter)
+            self.dirty = True
+            self.flush(force=False)
+
+    def columns(self):
+        return list(self.cols)
+
+    def snapshot(self):
+        """
+        :return: a json-able copy of the table
+        """
+        with self.lock:
+            return OrderedDict([('updated', time.strftime('%Y-%m-%d %H:%M:%S')),
+                                ('columns', self.columns()),
+                                ('samples', OrderedDict((r, dict(c)) for r, c in self.rows.items()))])
+
+    def flush(self, force=True):
+        """
+        :param force: if False, files are written only if the last flush is older than the interval
+        """
+        with self.lock:
+            if not self.dirty: return
+            if not force and time.time() - self.last_flush < self.interval: return
+            if self.csv_path is not None:
+                with open(self.csv_path + '.tmp', 'w') as fout:
+                    wrtr = csv.DictWriter(f=fout, fieldnames=['sample'] + self.columns())
+                    wrtr.writeheader()
+                    for s, cntr in self.rows.items():
+                        row = dict(cntr)
+                        row.update({'sample': s})
+                        wrtr.writerow(row)
+                os.replace(self.csv_path + '.tmp', self.csv_path)
+            if self.snapshot_path is not None:
+                with open(self.snapshot_path + '.tmp', 'w') as fout: json.dump(self.snapshot(), fout, indent=1)
+                os.replace(self.snapshot_path + '.tmp', self.snapshot_path)
+            self.dirty = False
+            self.last_flush = time.time()
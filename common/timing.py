@@ -0,0 +1,101 @@
+"""
+Resource usage measurement of pipeline tasks. Usage:
+---
+out, m = run_timed(f, *args, **kwargs)  # m holds wall and cpu time, max rss and io of f (and its subprocesses)
+with Timer() as t:
+    do_stuff()
+timeline = Timeline()
+timeline.add('sample1', 'align', t.m)
+timeline.write('timeline.json')  # chrome://tracing (or https://ui.perfetto.dev) format
+---
+CPU time, max RSS and IO are taken from getrusage of the process and its waited-for children, so measurements are
+accurate when a task runs in a process of its own (as WorkManager tasks do). IO is block IO, cache hits excluded.
+Max RSS is a lifetime peak of the process, it is the peak of the measured block only if it was reached within the
+block (maxrss_own), otherwise the block's own peak is unknown and at most maxrss_mb (the process peak so far).
+"""
+
+import json
+import os
+import resource
+import socket
+import threading
+import time
+from collections import OrderedDict
+
+
+def usage():
+    s, c = resource.getrusage(resource.RUSAGE_SELF), resource.getrusage(resource.RUSAGE_CHILDREN)
+    return {'cpu': s.ru_utime + s.ru_stime + c.ru_utime + c.ru_stime,
+            'maxrss': max(s.ru_maxrss, c.ru_maxrss),  # KB
+            'io': (s.ru_inblock + s.ru_oublock + c.ru_inblock + c.ru_oublock) * 512}
+
+
+class Timer(object):
+
+    def __enter__(self):
+        self.start, self.u0 = time.time(), usage()
+        return self
+
+    def __exit__(self, *exc):
+        u = usage()
+        self.m = OrderedDict([('start', self.start),
+                              ('wall', time.time() - self.start),
+                              ('cpu', u['cpu'] - self.u0['cpu']),
+                              ('maxrss_mb', u['maxrss'] / 1024.),
+                              ('maxrss_own', u['maxrss'] > self.u0['maxrss']),
+                              ('io_mb', (u['io'] - self.u0['io']) / 2. ** 20),
+                              ('host', socket.gethostname()),
+                              ('pid', os.getpid())])
+
+
+def run_timed(f, *args, **kwargs):
+    """
+    :return: (f(*args, **kwargs), resource usage measurement)
+    """
+    with Timer() as t: out = f(*args, **kwargs)
+    return out, t.m
+
+
+def rss_key(m):
+    """
+    :return: "maxrss_mb" if the max RSS of measurement m is its own peak, "process_peak_rss_mb" otherwise
+    """
+    return 'maxrss_mb' if m.get('maxrss_own', True) else 'process_peak_rss_mb'
+
+
+def stats_from_measurement(name, m):
+    """
+    :return: a statistics map for the stats file, e.g. align_wall, align_cpu, align_maxrss_mb, align_io_mb (or
+             align_process_peak_rss_mb, if the peak was not reached by the task, see rss_key)
+    """
+    return OrderedDict([('%s_%s' % (name, k), round(m[k], 2)) for k in ['wall', 'cpu']] +
+                       [('%s_%s' % (name, rss_key(m)), round(m['maxrss_mb'], 2)),
+                        ('%s_io_mb' % name, round(m['io_mb'], 2))])
+
+
+class Timeline(object):
+    """
+    Collects measurements as complete ("X") events of the chrome trace event format, with a "process" per group
+    (e.g. a sample) and a "thread" per host.
+    """
+
+    def __init__(self):
+        self.events = []
+        self.groups = OrderedDict()
+        self.hosts = OrderedDict()
+        self.lock = threading.Lock()
+
+    def add(self, group, name, m):
+        with self.lock:
+            pid = self.groups.setdefault(group, len(self.groups))
+            tid = self.hosts.setdefault(m['host'], len(self.hosts))
+            self.events.append({'name': name, 'cat': str(group), 'ph': 'X', 'pid': pid, 'tid': tid,
+                                'ts': int(m['start'] * 1e6), 'dur': int(m['wall'] * 1e6), 'args': m})
+
+    def write(self, path):
+        with self.lock:
+            meta = [{'name': 'process_name', 'ph': 'M', 'pid': pid, 'args': {'name': str(group)}}
+                    for group, pid in self.groups.items()]
+            meta += [{'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': tid, 'args': {'name': host}}
+                     for pid in self.groups.values() for host, tid in self.hosts.items()]
+            with open(path, 'w') as OUT: json.dump({'traceEvents': meta + self.events}, OUT)
@@ -0,0 +1,123 @@
+"""
+TTS counting windows, computed from a TTS annotation (tab delimited acc, chr, orf_start, orf_end, tts) over the whole
+table at once, and cached on disk by the annotation and chromosome lengths content, the count window and the start
+bounding. Usage:
+---
+w = TTSWindows.cached(tts_file, count_window=[-750, 250], dont_bound_start=True)
+w.write_bed(tmp_dir + '/tts.bed')  # for bedtools
+w.acc, w.chr, w.start, w.end, w.strand  # as arrays, for counting engines
+---
+"""
+
+import hashlib
+import json
+import os
+import shutil
+
+import numpy as np
+
+from common.cache import file_fingerprint
+from common.config import COMMON_GENOMES
+
+CACHE_PATH = os.path.join(os.path.expanduser('~'), '.cache', 'tts_windows')
+CHR_ALIASES = {'chrXVII': 'chrM'}
+
+
+def read_chrlens(path):
+    with open(path) as IN:
+        return dict((c, int(l)) for c, l in (line.strip().split('\t') for line in IN if line.strip()))
+
+
+class TTSWindows(object):
+
+    FIELDS = ['acc', 'chr', 'start', 'end', 'strand']
+
+    def __init__(self, acc, chr, start, end, strand):
+        """
+        :param strand: a boolean array, True for the watson (+) strand
+        """
+        self.acc, self.chr, self.start, self.end, self.strand = acc, chr, start, end, strand
+        self.key = None  # the cache key, for cached windows
+        self.bed = None  # a bed file of the windows, for cached windows
+
+    def __len__(self):
+        return len(self.acc)
+
+    @classmethod
+    def compute(cls, tts_file, count_window, dont_bound_start, chrlens):
+        """
+        :param count_window: window limits relative to the TTS, in the direction of transcription
+        :param dont_bound_start: if False, windows are trimmed to start at the ORF start
+        :param chrlens: a map from chromosome name to length
+        """
+        annot = np.loadtxt(tts_file, dtype=str, delimiter='\t', ndmin=2)
+        acc = annot[:, 0]
+        chr = annot[:, 1].copy()
+        for alias, name in CHR_ALIASES.items(): chr[chr == alias] = name
+        orf_start, orf_end = annot[:, 2].astype(np.int64), annot[:, 3].astype(np.int64)
+        tts = annot[:, 4].astype(float)  # "NaN" where unknown
+        strand = orf_start < orf_end
+        with np.errstate(invalid='ignore'):
+            problem = np.isnan(tts) | (strand & (tts < orf_end)) | (~strand & (tts > orf_end))
+        tts = np.where(problem, orf_end, np.nan_to_num(tts)).astype(np.int64)
+
+        sign = np.where(strand, 1, -1)
+        cw = np.array(count_window, dtype=np.int64)
+        w = strand.astype(int)
+        names, inv = np.unique(chr, return_inverse=True)
+        lens = np.array([chrlens[c] for c in names], dtype=np.int64)[inv]
+        start = np.maximum(0, tts + sign * cw[1 - w])
+        end = np.minimum(lens, tts + sign * cw[w])
+        if not dont_bound_start:
+            start = np.where(strand, np.maximum(start, orf_start), start)
+            end = np.where(strand, end, np.minimum(end, orf_start))
+        return cls(acc, chr, start, end, strand)
+
+    @classmethod
+    def cached(cls, tts_file, count_window, dont_bound_start, chrlens_path=None, cache_path=CACHE_PATH):
+        """
+        as compute, with chromosome lengths read from chrlens_path (default is the sacCer3 sizes). The windows are
+        loaded from the cache if they were computed before with the same inputs, and cached otherwise.
+        """
+        if chrlens_path is None: chrlens_path = COMMON_GENOMES['SCER']['chrlens']
+        key = hashlib.sha1(json.dumps([file_fingerprint(tts_file), file_fingerprint(chrlens_path),
+                                       list(count_window), bool(dont_bound_start)]).encode('utf8')).hexdigest()
+        path = cache_path + os.sep + key + '.npz'
+        if os.path.isfile(path):
+            w = cls.load(path)
+        else:
+            w = cls.compute(tts_file, count_window, dont_bound_start, read_chrlens(chrlens_path))
+            try:
+                os.makedirs(cache_path, exist_ok=True)
+                w.write_bed(cache_path + os.sep + key + '.bed')
+                w.save(path)  # written last, marks a complete entry
+            except OSError:
+                pass  # caching is an optimization, e.g. the cache folder may not be writable
+        w.key, w.bed = key, cache_path + os.sep + key + '.bed'
+        return w
+
+    def save(self, path):
+        tmp = path + '.%i.tmp.npz' % os.getpid()
+        np.savez(tmp, **dict((f, getattr(self, f)) for f in TTSWindows.FIELDS))
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as npz:
+            return cls(*[npz[f] for f in TTSWindows.FIELDS])
+
+    def write_bed(self, path):
+        """
+        write the windows as a 6 column bed file, in annotation order (the bed of a cached table is copied)
+        """
+        if self.bed is not None and os.path.isfile(self.bed):
+            shutil.copy(self.bed, path)
+            return path
+        strands = np.where(self.strand, '+', '-')
+        tmp = path + '.%i.tmp' % os.getpid()
+        with open(tmp, 'w') as OUT:
+            OUT.writelines('%s\t%i\t%i\t%s\t1\t%s\n' % r for r in
+                           zip(self.chr.tolist(), self.start.tolist(), self.end.tolist(), self.acc.tolist(),
+                               strands.tolist()))
+        os.replace(tmp, path)
+        return path
@@ -1,128 +1,178 @@
 """
-Given a collection of samples and paths to their BAM files, and an annotation reference file,
-generate a corresponding multidimensional matlab file.
+Given a collection of samples and paths to their BAM files, and an annotation reference file, generate a
+corresponding multidimensional array - the reshaped reads (see reshape_bam.py) of every sample, under every
+transform. Usage:
+---
+python future/bam2stats.py samples.csv annots.tsv -o out_dir -T "cov();5p()" -w [-500,250]
+---
+samples.csv has a header of the form "bam,<name>(<short_name>):<type>[units],...", as in a sample_db, and a row
+per sample, with the path of its (indexed) bam file and its feature values. annots.tsv has "id, chr, pos, strand"
+rows.
+
+Every (sample, transform) pair is reshaped in a separate job, through a WorkManager, and every result is written
+to the output array as it arrives, so the whole array is never held in memory. The output folder holds:
+data.npy (or data.h5 with -f h5): a (transforms x feature1 x feature2 ... x annotations x window) array, every
+    job is a contiguous block (an h5 chunk), NaN where a job failed. Load with np.load(path, mmap_mode='r').
+done.npy: a (transforms x feature1 x ...) boolean array, set where the job completed
+legend.json: the values of every dimension
+The exit code is 1 if any job failed.
 """
-from work import *
 
-from common.utils import *
-from future.reshape_bam import *
+import argparse
+import json
+import os
+import re
+import shutil
+import sys
+from collections import OrderedDict
+
+project_dir = os.path.sep.join(sys.modules[__name__].__file__.split(os.path.sep)[:-2])
+sys.path.append(project_dir)
+
+from common.config import *
+
+if not sys.executable == INTERPRETER:  # divert to the "right" interpreter
+    import subprocess as sp
+    scriptpath = os.path.abspath(sys.modules[__name__].__file__)
+    sp.Popen([INTERPRETER, scriptpath] + sys.argv[1:]).wait()
+    exit()
+
+import numpy as np
+
+from common import slurm
+from future.reshape_bam import reshape_job, transform_from_string
+from transeq.manage import WorkManager
+
+FEATURE_PAT = re.compile(r'\s*(?P<name>\w+)\s*(?:\((?P<short_name>\w+)\))?\s*:(?P<type>\w+)(:?\[(?P<units>\w+)\])?')
+TYPES = {'str': str, 'int': int, 'float': float}
+
+
+def parse_samples(path):
+    """
+    :return: the feature names, a map from feature name to type, and a list of (feature values, bam path) pairs
+    """
+    with open(path) as IN:
+        hdr = IN.readline().strip().split(SAMPLEDB_DELIM)
+        if hdr[0] != 'bam': raise ValueError('first column in %s needs to be the "bam" column' % path)
+        features = OrderedDict()
+        for f in hdr[1:]:
+            m = re.match(FEATURE_PAT, f)
+            if m is None or m.group('type').lower() not in TYPES:
+                raise ValueError("couldn't understand feature '%s', format should be: "
+                                 "<name>(<short_name>):(str|int|float)[units]" % f)
+            features[m.group('name')] = TYPES[m.group('type').lower()]
+        samples, bams = [], {}
+        for line in IN:
+            if not line.strip(): continue
+            row = line.strip().split(SAMPLEDB_DELIM)
+            fvals = OrderedDict((f, t(v)) for (f, t), v in zip(features.items(), row[1:]))
+            k = tuple(fvals.values())
+            if k in bams:
+                raise ValueError('could not differentiate between two samples: %s and %s' % (bams[k], row[0]))
+            bams[k] = row[0]
+            samples.append((fvals, row[0]))
+    return list(features), features, samples
+
+
+class OutputArray(object):
+    """
+    An on-disk (transforms x features... x annotations x window) array, written a (sample, transform) block at a time
+    """
+
+    def __init__(self, path, shape, fmt='npy'):
+        self.fmt = fmt
+        if fmt == 'h5':
+            try:
+                import h5py
+            except ImportError:
+                raise ValueError('h5 output requires the h5py package')
+            self.path = path + os.sep + 'data.h5'
+            self.h5 = h5py.File(self.path, 'w')
+            self.arr = self.h5.create_dataset('data', shape=shape, dtype=np.double, fillvalue=np.nan,
+                                              chunks=(1,) * (len(shape) - 2) + shape[-2:], compression='gzip')
+        else:
+            self.path = path + os.sep + 'data.npy'
+            self.arr = np.lib.format.open_memmap(self.path, mode='w+', dtype=np.double, shape=shape)
+            self.arr[...] = np.nan  # as in h5, blocks of failed jobs are NaN rather than 0
+        self.done = np.zeros(shape[:-2], dtype=bool)
+
+    def write(self, idx, d):
+        self.arr[idx] = d
+        self.done[idx] = True
+
+    def close(self, path):
+        np.save(path + os.sep + 'done.npy', self.done)
+        if self.fmt == 'h5':
+            self.h5.close()
+        else:
+            self.arr.flush()
+            del self.arr
 
 
 class MainHandler(object):
 
     def __init__(self, args):
-        self.comq = mp.Queue()
         self.a = args
-        self.wm = WorkManager(self.comq, self.exec_on=='slurm')
-
-    def split(self):
-        """
-        generate psuedo-samples by in-silico splitting of data (e.g. by quality, read length, strand,
-        etc.)
-        :return: None. Updates the samples structure
-        """
-        pass
-
-    def reduce(self):
-        """
-        reduce data dimensions - select a specific value in a speicific feature, sum/avg/median/ over
-        some feature, etc, ignore certain features, etc.
-        :return: None. Updates the samples structure.
-        """
-        pass
-
-    def hub(self):
-        """
-        Generate a track hub according to specifications. These include formats and colors, and collating
-        of tracks to composite tracks (e.g. overlaying tracks from different time points, or repeats, etc.)
-        :return:
-        """
-        pass
-
-    def reshape_genome(self):
-        """
-        Reshape genome with respect to certain annotations, according to specifications, specificaly, which
-        ReadTransform is used when collecting the reads, and wehter collection is strand-aware or not.
-        :return:
-        """
-    pass
-
-
-    def export(self):
-        """
-        Export all data according to specifications.
-        :return:
-        """
-        pass
-
-    def count(self):
-        """
-        Count reads with respect to certain annotations.
-        :return:
-        """
-    pass
-
-    def meta(self):
-        """
-        Produce average graphs of sets of annotations according to specifications. These include, locus
-        normaliztion (yes/no), which variable is collated on same plot, whether to subplot, and which feature
-        is subplotted.
-        :return:
-        """
+        self.fnames, self.ftypes, self.samples = parse_samples(args.samples)
+        self.transforms = [transform_from_string(t) for t in args.transforms.split(';') if t.strip()]
+        with open(args.annot_in) as IN:
+            self.annots = [line.strip().split(ANNOT_DELIM)[0] for line in IN if line.strip()]
+        self.tmp_dir = args.output_dir + os.sep + TMP_DIR
+        os.makedirs(self.tmp_dir, exist_ok=True)
+        executor = None
+        if args.cluster == 'local':
+            executor = slurm.SlurmBackend(self.tmp_dir, cluster=slurm.LocalCluster())
+        self.wm = WorkManager(max_w=args.max_workers, tmp_path=self.tmp_dir, executor=executor,
+                              default_slurm_spec={'cpus-per-task': 1, 'mem': '4G'})
+
+    def legend(self):
+        lg = OrderedDict([('dims', ['transform'] + self.fnames + ['annot', 'pos']),
+                          ('transform', [t.name for t in self.transforms])])
+        for f in self.fnames: lg[f] = sorted(set(fvals[f] for fvals, _ in self.samples))
+        lg['annot'] = self.annots
+        lg['pos'] = list(range(self.a.w[0], self.a.w[1] + 1))
+        return lg
 
     def main(self):
-        self.split()
-        self.reduce()
-        self.hub()
-        self.reshape_genome()
-        self.count
-        token_map = {}
-        for s, path in self.split():
-            for t in self.transforms:
-                self.sample.files['tmp_pkl'] = self.tmp_dir + os.sep + s.short_name() + '.tmp.pkl'
-                args = dict(bam_path=s.files['bam'], annot_file=open(self.annot_file),
-                            transform=t, out_name='x', output_file=self.sample.files['tmp_pkl'],
-                            w=self.w)
-                token_map[self.wm.run(reshape, kwargs=args)] = (s, t)
-        annots = [line.strip().split('\t')[3] for line in open(self.a.annot_file)]
-        dims = (len(annots), self.a.w[1] - self.a.w[0] + 1, len(self.a.transforms)) + \
-               tuple([len(f.vals) for f in self.features])
-        arr = np.empty(dims)  # a very large array
-        leg = OrderedDict()
-        for f in self.features: leg[f.name] = sorted(f.vals)
-        leg['annot'] = annots
-        leg['trans'] = [t.name for t in self.transforms]
-        while token_map:
-            tok, e, info = self.comq.get()
-            sample, transform = token_map.pop(tok)
-            if e is not None:
-                print('Error while reshaping sample %s with %s '
-                      'transform' % (str(sample), transform.name))
-                exit()
-            else:
-                ti = self.transforms.index(transform)
-                sidx = tuple(leg[fname].index(sample.fvals[f])
-                             for f, fname in zip(self.features, leg.keys()))
-                itup = (slice(None), slice(None), ti) + sidx
-                arr[itup] = info
-        for key, vals in leg.items():
-            dtype = np.object if str(vals[0])==vals[0] else np.double
-            leg[key] = np.array(vals, dtype=dtype)
-        sio.savemat(self.output_file, dict(name=dict(arr=arr, w=self.w, leg=leg)))
+        lg = self.legend()
+        shape = tuple(len(lg[d]) for d in lg['dims'])
+        out = OutputArray(self.a.output_dir, shape, self.a.format)
+        pos = [{v: i for i, v in enumerate(lg[f])} for f in self.fnames]
+        c = self.wm.get_channel()
+        n = 0
+        for si, (fvals, bam) in enumerate(self.samples):
+            sidx = tuple(p[fvals[f]] for f, p in zip(self.fnames, pos))
+            for ti, t in enumerate(self.transforms):
+                key = (ti,) + sidx
+                tmp = self.tmp_dir + os.sep + '%i-%i.npy' % (si, ti)
+                args = (key, bam, self.a.annot_in, t, self.a.w, self.a.is_paired, not self.a.not_same_strand,
+                        self.a.use_tlen, tmp)
+                self.wm.execute(func=reshape_job, args=args, c=c, name='reshape-%s' % t.name)
+                n += 1
+        errors = 0
+        for _ in range(n):  # results are written as they arrive
+            res, err = c.get()
+            if err is None: key, path, err = res
+            if err is not None:
+                errors += 1
+                print('Error while reshaping:\n%s' % err)
+                continue
+            out.write(key, np.load(path, mmap_mode='r'))
+            os.remove(path)
+            print('%i/%i done' % (out.done.sum(), n))
+        self.wm.join()
+        out.close(self.a.output_dir)
+        with open(self.a.output_dir + os.sep + 'legend.json', 'w') as OUT: json.dump(lg, OUT)
+        shutil.rmtree(self.tmp_dir)
+        print('wrote %s (%i failed jobs)' % (out.path, errors))
+        return errors
 
 
 def parse_arguments(p):
     args = p.parse_args()
-    if args.annot_in is None:
-        args.__dict__['annot_in'] = sys.stdin
-    else:
-        args.__dict__['annot_in'] = open(args.annot_in)
     args.__dict__['w'] = [int(x) for x in args.w[1:-1].split(',')]
-
-    if args.out_name is None:
-        args.__dict__['out_name'] = os.path.split(args.output_file)[1].split(os.path.extsep)[0]
-
-    args.__dict__['transform'] = transform_from_string(args.transform)
+    args.__dict__['output_dir'] = os.path.abspath(args.output_dir)
+    os.makedirs(args.output_dir, exist_ok=True)
     return args
 
 
@@ -130,25 +180,30 @@ def build_parser():
     p = argparse.ArgumentParser()
 
     g = p.add_argument_group('Input')
-    g.add_argument('bam_in', type=str, default=None, help='path to an indexed bam file')
-    g.add_argument('--annot_in', '-ain', type=str, default=None,
-                   help='path to a "chr,pos,strand" annotation file, default is stdin')
-    g.add_argument('--delim', '-d', type=str, default=',', dest='d',
-                   help='annotation input delimiter')
+    g.add_argument('samples', type=str, help='a csv with a "bam" column and a column per feature, see above')
+    g.add_argument('annot_in', type=str, help='path to a "id\tchr\tpos\tstrand" annotation file')
+    g.add_argument('--is_paired', '-p', action='store_true', help='whether data is paired reads or not.')
+    g.add_argument('--use_tlen', '-tl', action='store_true',
+                   help='for paired data, take fragment ends from the TLEN field instead of pairing mates')
+    g.add_argument('--not_same_strand', '-s', action='store_true',
+                   help='should directionality be flipped relative to annotation?')
 
     g = p.add_argument_group('Output')
-    g.add_argument('--output_file', '-o', type=str, default='reshaped.mat',
-                   help='to which output is written.')
-    g.add_argument('--out_name', '-on', type=str, default=None,
-                   help='name of matrix in matlab struct, default is the suffix of output_name (excluding .mat)')
+    g.add_argument('--output_dir', '-o', type=str, default='reshaped', help='to which output is written.')
+    g.add_argument('--format', '-f', type=str, choices=['npy', 'h5'], default='npy',
+                   help='output array format, h5 requires h5py')
     g.add_argument('--window', '-w', type=str, default='[-500,250]', dest='w',
                    help='Comma separated limits for the areas around annotations to be collected')
-    g.add_argument('--transform', '-T', type=str, default='cov()',
-                   help='the transform applied to each read. See -th for details.')
-
+    g.add_argument('--transforms', '-T', type=str, default='cov()',
+                   help='semicolon separated transforms applied to each read, e.g. "cov();spike(a=2)"')
+
+    g = p.add_argument_group('Execution')
+    g.add_argument('--max_workers', '-mw', type=int, default=100,
+                   help='maximal number of simultaneous reshaping jobs')
+    g.add_argument('--cluster', '-cl', type=str, choices=['slurm', 'local'], default='slurm',
+                   help='where jobs are executed. "local" runs them on this machine through a stand-in for slurm')
     return p
 
 
 if __name__ == '__main__':
-    c = Collector(parse_arguments(build_parser()))
-    c.collect()
\ No newline at end of file
+    exit(1 if MainHandler(parse_arguments(build_parser())).main() else 0)
@@ -1,10 +1,13 @@
 import sys
 import scipy.io as sio
 import numpy as np
+from itertools import islice
 from scipy import sparse
 import argparse
+from collections import OrderedDict
 
 SPARSE_PERCENT = 0.1
+BED_CHUNK = 10 ** 6  # lines parsed at once
 INTERPRETER = '/cs/bd/tools/nflab_env/bin/python3.4'
 if not sys.executable == INTERPRETER:  # divert to the "right" interpreter
     import subprocess as sp
@@ -23,47 +26,123 @@ def parse_chrlen(chrlen_file):
     return cl
 
 
-def read_bed(bed_in):
-    data = {}
-    for line in bed_in:
-        parts = line.strip().split('\t')
-        if len(parts) == 4:
-            chr, fr, to, val = parts
-        else:
-            chr, fr, val = parts
-        fr = int(fr)
-        to = int(to) if len(parts) == 4 else fr + 1
-        if chr not in data:
-            data[chr] = ([],[])
-        for i in range(fr,to):
-            data[chr][0].append(int(i))
-            data[chr][1].append(float(val))
-    return data
-
-
-def write_mat(out_to, data, strand, meta, chr_lengths):
-    s = {}
-    for chr, (poss, vals) in data.items():
-        if len(poss)/chr_lengths[chr] < SPARSE_PERCENT:
-            s[chr] = sparse.csc_matrix((vals, (poss, np.zeros(len(poss)))), shape=(chr_lengths[chr],1), dtype=float)
-            sp = True
+def read_bed(bed_in, chunk=BED_CHUNK):
+    """
+    parse a bedGraph (chr, from, to, value) or a (chr, pos, value) file, chunk lines at a time
+
+    :return: a map from chromosome to (from, to, value) arrays of its intervals, memory is O(intervals)
+    """
+    parts = {}
+    while True:
+        lines = list(islice(bed_in, chunk))
+        if not lines: break
+        cols = np.loadtxt(lines, dtype=str, delimiter='\t', ndmin=2)
+        chrs, fr = cols[:, 0], cols[:, 1].astype(np.int64)
+        if cols.shape[1] == 4:
+            to, val = cols[:, 2].astype(np.int64), cols[:, 3].astype(float)
         else:
-            s[chr] = np.zeros(chr_lengths[chr])
-            s[chr][poss] = vals
-            sp = False
+            to, val = fr + 1, cols[:, 2].astype(float)
+        names, first = np.unique(chrs, return_index=True)
+        for c in names[np.argsort(first)]:  # in order of appearance
+            m = chrs == c
+            parts.setdefault(str(c), []).append((fr[m], to[m], val[m]))
+    return {c: tuple(np.concatenate(x) for x in zip(*ps)) for c, ps in parts.items()}
+
+
+def expand(fr, to, vals):
+    """
+    :return: the positions covered by the intervals, and their values
+    """
+    lens = to - fr
+    poss = np.repeat(fr - np.cumsum(lens) + lens, lens) + np.arange(lens.sum())
+    return poss, np.repeat(vals, lens)
+
+
+def chr_vector(fr, to, vals, length):
+    """
+    build the vector of a chromosome from its intervals. The representation is chosen from the interval lengths
+    before anything is built: a (length x 1) sparse matrix if the intervals cover less than SPARSE_PERCENT of the
+    chromosome, a dense array otherwise.
+
+    :return: the vector, and whether it is sparse
+    """
+    is_sparse = (to - fr).sum() / length < SPARSE_PERCENT
+    poss, vals = expand(fr, to, vals)
+    if is_sparse:
+        v = sparse.csc_matrix((vals, poss.astype(np.int32), np.array([0, len(poss)], dtype=np.int32)),
+                              shape=(length, 1), dtype=float)
+        v.sum_duplicates()  # sorted indices, as when built from triplets
+        return v, True
+    v = np.zeros(length)
+    v[poss] = vals
+    return v, False
+
+
+def build_vectors(data, chr_lengths):
+    """
+    :return: a map from chromosome to its (vector, is sparse) pair, see chr_vector
+    """
+    return OrderedDict((chr, chr_vector(fr, to, vals, chr_lengths[chr])) for chr, (fr, to, vals) in data.items())
+
+
+def write_mat(out_to, vectors, strand, meta):
+    """
+    write a MATLAB v5 .mat file (limited to 2GB), with a "data" struct holding a field per chromosome, "meta",
+    "strand", and an "is_sparse" struct with a flag per chromosome
+    """
+    s = dict((chr, v) for chr, (v, _) in vectors.items())
     s['meta'] = meta
-    s['is_sparse'] = sp
+    s['is_sparse'] = dict((chr, sp) for chr, (_, sp) in vectors.items())
     s['strand'] = strand
     sio.savemat(out_to, mdict=dict(data=s))
 
 
+def write_npz(out_to, vectors, strand, meta):
+    """
+    write a compressed .npz file, with no size limit. A dense chromosome is stored under its name, a sparse one as
+    "<chr>.index" and "<chr>.value" arrays of its non-zero positions. Read it back with read_npz.
+    """
+    d = {'chrs': np.array(list(vectors), dtype=str), 'meta': np.array(meta), 'strand': np.array(strand),
+         'lengths': np.array([v.shape[0] for v, _ in vectors.values()], dtype=np.int64),
+         'is_sparse': np.array([sp for _, sp in vectors.values()], dtype=bool)}
+    for chr, (v, sp) in vectors.items():
+        if sp:
+            d[chr + '.index'], d[chr + '.value'] = v.indices, v.data
+        else:
+            d[chr] = v
+    np.savez_compressed(out_to, **d)
+
+
+def read_npz(path):
+    """
+    :return: a map from chromosome to its vector (a csc_matrix if sparse), "meta", "strand", and "is_sparse" - a
+             map from chromosome to its flag, as in the "data" struct of a .mat output
+    """
+    out = {}
+    with np.load(path) as npz:
+        flags = OrderedDict(zip(npz['chrs'].tolist(), npz['is_sparse'].tolist()))
+        for (chr, sp), l in zip(flags.items(), npz['lengths']):
+            if sp:
+                idx = npz[chr + '.index']
+                out[chr] = sparse.csc_matrix((npz[chr + '.value'], idx, np.array([0, len(idx)])), shape=(l, 1))
+            else:
+                out[chr] = npz[chr]
+        out['meta'], out['strand'], out['is_sparse'] = str(npz['meta']), str(npz['strand']), flags
+    return out
+
+
+WRITERS = {'mat': write_mat, 'npz': write_npz}
+
+
 def parse_args():
     p = argparse.ArgumentParser()
     p.add_argument('--input', '-i', type=str, default=None,
                    help='bed input file: chr\tpos(\tto)\tvalue, default is stdin')
     p.add_argument('name', type=str, help='sample name')
     p.add_argument('--output', '-o', type=str, default=None,
-                   help='to which .mat output is written. default is name.mat')
+                   help='to which output is written. default is name.mat (or name.npz)')
+    p.add_argument('--format', '-f', type=str, choices=list(WRITERS), default='mat',
+                   help='output format, .mat files are limited to 2GB, use npz for larger outputs')
     p.add_argument('--strand', '-s', type=str, choices=['w','c','no'], default='no',
                    help='bed input strand ("no" if not strand-specific)')
     p.add_argument('--chr_len_file', '-clf', type=str, default='/cs/wetlab/genomics/scer/genome/sacCer3.sizes',
@@ -75,10 +154,11 @@ def parse_args():
         args.__dict__['input'] = open(args.input)
 
     if args.output is None:
-        args.__dict__['output'] = args.name + '.mat'
+        args.__dict__['output'] = args.name + '.' + args.format
 
     return args
 
 if __name__ == '__main__':
     args = parse_args()
-    write_mat(args.output, read_bed(args.input), args.strand, args.name, parse_chrlen(args.chr_len_file))
\ No newline at end of file
+    vectors = build_vectors(read_bed(args.input), parse_chrlen(args.chr_len_file))
+    WRITERS[args.format](args.output, vectors, args.strand, args.name)
@@ -2,9 +2,9 @@ import sys
 import os
 sys.path.append(os.path.split(os.path.split(__file__)[0])[0])
 import argparse
-import subprocess as sp
+import numpy as np
 from common.config import *
-import shlex
+from common.bigwig import BigWig
 
 
 INTERPRETER = '/cs/bd/tools/nflab_env/bin/python3.4'
@@ -25,56 +25,27 @@ def parse_chrlen(chrlen_file):
     return cl
 
 
-def parse_fixedstep(input, out_f, cl):
-    rm, csl, chr = 0, 0, None
-    with open(input) as IN:
-        for i, line in enumerate(IN):
-            if line.startswith('fixedStep') or line.startswith('variableStep'):
-                rm += 1 # remove line from position count
-                c = line.strip().split(' ')[1].split('=')[1]
-                if c != chr: # new chromsome
-                    chr = c
-                    l = cl[chr]
-                    csl += l
+def bw2bed(bw_in, cl, out_f, intervals=False, bin_size=None):
+    """
+    write the non-zero values of a BigWig file, a "chr\tpos\tvalue" line per position (0-based), or with
+    intervals, "chr\tfrom\tto\tvalue" bedGraph lines. With bin_size, the values are the bin means (taken from the zoom
+    levels of the file), and positions are bin starts.
+    """
+    with BigWig(bw_in) as bw:
+        for chr in cl:
+            if bin_size is None and not intervals:
+                pos, vals = bw.positions(chr)
+                out_f.writelines('%s\t%i\t%.2f\n' % r for r in zip([chr] * len(pos), pos.tolist(), vals.tolist()))
+                continue
+            if bin_size is not None:
+                vals = bw.binned(chr, bin_size)
+                fr = np.arange(len(vals), dtype=np.int64) * bin_size
+                to = np.minimum(fr + bin_size, cl[chr])
             else:
-                val = float(line.strip())
-                if val > 0:
-                    pos = i - rm - csl + l
-                    out_f.write('%s\t%i\t%.2f\n' % (chr, pos, val))
-
-
-def parse_variablestep(input, out_f, cl):
-    rm, csl, chr = 0, 0, None
-    with open(input) as IN:
-        for line in IN:
-            if line.startswith('variableStep'):
-                chr = line.strip().split(' ')[1].split('=')[1]
-            else:
-                pos, val = line.strip().split('\t')
-                pos = int(pos)
-                out_f.write('%s\t%i\t%.2f\n' % (chr, pos, float(val)))
-
-
-def parse_bedgraph(input, out_f):
-    with open(input) as IN:
-        for i, line in enumerate(IN):
-            if line.startswith('#bedGraph'): continue
-            chr, frm, to, val = line.strip().split('\t')
-            for p in range(int(frm),int(to)):
-                out_f.write('%s\t%i\t%s\n' % (chr, p, val))
-
-
-def bw2bed(bw_in, cl, tmp_name, out_f):
-    comm = '%s %s %s' % (EXEC['BW2W'], bw_in, tmp_name)
-    sp.Popen(shlex.split(comm)).communicate()
-    t = open(tmp_name)
-    hdr = t.readline()
-    t.close()
-    if hdr.startswith('fixedstep'): parse_fixedstep(tmp_name, out_f, cl)
-    elif hdr.startswith('variableStep'): parse_variablestep(tmp_name, out_f, cl)
-    elif hdr.startswith('#bedGraph'): parse_bedgraph(tmp_name, out_f)
-    else: raise IOError('unknown Wig format: %s' % hdr)
-    os.remove(tmp_name)
+                fr, to, vals = bw.intervals(chr)
+            keep = (vals != 0) & ~np.isnan(vals)
+            rows = zip([chr] * keep.sum(), fr[keep].tolist(), to[keep].tolist(), vals[keep].tolist())
+            out_f.writelines('%s\t%i\t%i\t%.2f\n' % r for r in rows)
 
 
 def parse_args():
@@ -84,6 +55,10 @@ def parse_args():
                    help='to which bed output is written. default is stdout')
     p.add_argument('--chr_len_file', '-clf', type=str, default='/cs/wetlab/genomics/scer/genome/sacCer3.sizes',
                    help='path to chromosome lengths file')
+    p.add_argument('--intervals', '-iv', action='store_true',
+                   help='write chr\tfrom\tto\tvalue intervals instead of a line per position')
+    p.add_argument('--bin_size', '-b', type=int, default=None,
+                   help='write the mean value of every bin of this size (from the BigWig zoom levels)')
     args = p.parse_args()
     if args.output is None:
         args.__dict__['output'] = sys.stdout
@@ -94,5 +69,4 @@ def parse_args():
 
 if __name__ == '__main__':
     args = parse_args()
-    tmpname = os.path.extsep.join(args.bw_in.split(os.path.extsep))[:-1] + '.tmp'
-    bw2bed(args.bw_in, parse_chrlen(args.chr_len_file), tmpname, args.output)
+    bw2bed(args.bw_in, parse_chrlen(args.chr_len_file), args.output, args.intervals, args.bin_size)
@@ -3,8 +3,10 @@
 import sys
 import os
 import re
-import shlex
-import subprocess as sp
+import json
+import shutil
+import tempfile
+import multiprocessing as mp
 import scipy.io as sio
 import numpy as np
 from scipy import sparse
@@ -14,11 +16,11 @@ from collections import OrderedDict
 CHRMAP = '/cs/wetlab/genomics/scer/genome/sacCer3_ordered.sizes'
 if not os.path.exists(CHRMAP):
     CHRMAP =  '/Users/user/gdrive_huji/scer_data/genome/sacCer3.ordered.chr.size'
-BW2W = '/cs/bd/tools/bigWigToWig'
-if not os.path.exists(BW2W):
-    BW2W = '/Users/user/nflab_scripts/shell/bigWigToWig'
 
-# sys.path.append(os.path.split(os.path.split(__file__)[0])[0])
+sys.path.append(os.path.split(os.path.split(__file__)[0])[0])
+from common.bigwig import BigWig
+from common.chr_columns import fill_dense_chr, save_column, sparse_chr
+
 # INTERPRETER = '/cs/bd/tools/nflab_env/bin/python3.4'
 # if not sys.executable == INTERPRETER:  # divert to the "right" interpreter
 #     import subprocess as sp
@@ -28,67 +30,6 @@ if not os.path.exists(BW2W):
 #     exit()
 
 
-def cpv_iter(bw_in, chr_map, tmp_suff='.tmp'):
-    """
-    given a bigwig file, iterate over (chr, pos, val) triplets
-    :param bw_in: bigwig input
-    :param tmp_name: temporary file suffix
-    :param chr_map: an OrderedDict of chr -> length
-    :return: yields triplets of chromsome, position, value over all non-zero positions
-    """
-    def parse_fixed_step(input, chr_map):
-        rm, csl, chr = 0, 0, None
-        with open(input) as IN:
-            for i, line in enumerate(IN):
-                if line.startswith('fixedStep') or line.startswith('variableStep'):
-                    rm += 1  # remove line from position count
-                    c = line.strip().split(' ')[1].split('=')[1]
-                    if c != chr:  # new chromsome
-                        chr = c
-                        l = chr_map[chr]
-                        csl += l
-                else:
-                    val = float(line.strip())
-                    if val > 0:
-                        pos = i - rm - csl + l
-                        yield chr, int(pos), float(val)
-
-    def parse_variable_step(input, chr_map):
-        rm, csl, chr = 0, 0, None
-        with open(input) as IN:
-            for line in IN:
-                if line.startswith('variableStep'):
-                    chr = line.strip().split(' ')[1].split('=')[1]
-                else:
-                    pos, val = line.strip().split('\t')
-                    pos = int(pos)
-                    yield chr, int(pos), float(val)
-
-    def parse_bed_graph(input, chr_map):
-        with open(input) as IN:
-            for i, line in enumerate(IN):
-                if line.startswith('#bedGraph'): continue
-                chr, frm, to, val = line.strip().split('\t')
-                for p in range(int(frm), int(to)):
-                    yield chr, int(p), float(val)
-
-    tmp_name = bw_in + tmp_suff
-    comm = '%s %s %s' % (BW2W, bw_in, tmp_name)
-    _, err = sp.Popen(shlex.split(comm), stderr=sp.PIPE).communicate()
-    if not err:
-        t = open(tmp_name)
-        hdr = t.readline()
-        t.close()
-        if hdr.startswith('fixedstep'): iter = parse_fixed_step
-        elif hdr.startswith('variableStep'): iter = parse_variable_step
-        elif hdr.startswith('#bedGraph'): iter = parse_bed_graph
-        else: raise IOError('unknown Wig format: %s' % hdr)
-        for cpv in iter(tmp_name, chr_map): yield cpv
-        os.remove(tmp_name)
-    else:
-        sys.stderr.write('\terror (is it empty?): %s' % err)
-
-
 def organize_files(path, var_parsers):
     """
     Parse the files in path in light of given regexps
@@ -123,23 +64,84 @@ def organize_files(path, var_parsers):
     return vars, file_list, var_lists
 
 
-def bw2py(bw_in, chr_map):
+def chr_iter(bw_in, chr_map, bin_size=None):
     """
-    Read a bw file and convert it to a map: chr -> (positions, values)
+    iterate over the chromosomes of a bw file, one at a time
     :param bw_in: bigwig (.bw) file path
     :param chr_map:  A chr -> length map
-    :return: map chr -> (positions, values)
+    :param bin_size: if given, positions are bins of this size, and values are bin means (from the zoom levels)
+    :return: yields (chr, positions, values) of the non-zero positions, as arrays
+    """
+    with BigWig(bw_in) as bw:
+        for c in chr_map:
+            if bin_size is None:
+                pos, vals = bw.positions(c)
+            else:
+                vals = bw.binned(c, bin_size)
+                pos = np.flatnonzero(vals)
+                vals = vals[pos]
+            yield c, pos, vals
+
+
+def bw2py(bw_in, chr_map, bin_size=None):
+    """
+    Read a bw file and convert it to a map: chr -> (positions, values)
+    :return: map chr -> (positions, values) arrays, of the non-zero positions, see chr_iter
+    """
+    return {c: (pos, vals) for c, pos, vals in chr_iter(bw_in, chr_map, bin_size)}
+
+
+def convert_sample(bw_in, chr_map, bin_size, out_dir):
+    """
+    write the non-zero positions and values of every chromosome of a bw file to out_dir (see common.chr_columns),
+    holding one chromosome in memory at a time
+    :return: out_dir
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    for c, pos, vals in chr_iter(bw_in, chr_map, bin_size): save_column(out_dir, c, pos, vals)
+    return out_dir
+
+
+def convert_sample_job(job):
+    return convert_sample(*job)
+
+
+def convert_samples(file_list, tmp_dir, args):
+    """
+    convert all bw files in parallel (args.n_workers processes), see convert_sample
+    :return: a list of the sample folders, in file_list order
+    """
+    jobs = [(f, args.chr_map, args.bin_size, tmp_dir + os.sep + str(si)) for si, f in enumerate(file_list)]
+    dirs = []
+    with mp.Pool(args.n_workers) as pool:
+        for f, d in zip(file_list, pool.imap(convert_sample_job, jobs)):
+            if args.verbose:
+                sys.stderr.write('processed %s...\n' % f)
+            dirs.append(d)
+    return dirs
+
+
+def build_legend(vars, file_list, var_lists, args):
+    """
+    :return: the legend of the output, see build_matlab_objects
     """
-    map = {c: ([],[]) for c in chr_map}
-    for c, p, v in cpv_iter(bw_in, chr_map):
-        map[c][0].append(p)
-        map[c][1].append(v)
-    return map
+    return {'samples': [os.path.split(f)[1][:-3] for f in file_list],
+            'sample_vars': {v: list(var_lists[v]) for v in vars.keys()},
+            'vars': {v : list(vals) for v, vals in vars.items()},
+            'c': list(args.chr_map.keys())}
+
+
+def chr_rows(args):
+    """
+    :return: the number of rows of every chromosome matrix, positions or bins
+    """
+    return [L if args.bin_size is None else (L - 1) // args.bin_size + 1 for L in args.chr_map.values()]
 
 
 def build_matlab_objects(vars, file_list, var_lists, args):
     """
-    prep the output MATLAB objects
+    prep the output MATLAB objects. Samples are converted in parallel to temporary per chromosome arrays, and every
+    chromosome matrix is assembled from them a column at a time.
 
     :param vars: an OrderedDict of variable name -> variable values
     :param file_list: an ordered list of files
@@ -155,34 +157,52 @@ def build_matlab_objects(vars, file_list, var_lists, args):
                       * vars - a struct with variables values in order
                       * c - chromosome names, in order of "d"
     """
-    S, C = len(file_list), len(args.chr_map)
-    d = [np.zeros((L,S)) for L in args.chr_map.values()] if not args.sparse else [([],[],[]) for _ in args.chr_map]
+    S = len(file_list)
+    tmp_dir = tempfile.mkdtemp(prefix='bwhub2mat.', dir=args.tmp_dir)
+    try:
+        dirs = convert_samples(file_list, tmp_dir, args)
+        d = []
+        for ch, L in zip(args.chr_map, chr_rows(args)):
+            d.append(sparse_chr(dirs, ch, L) if args.sparse else fill_dense_chr(dirs, ch, np.zeros((L, S))))
+    finally:
+        shutil.rmtree(tmp_dir)
+    lg = build_legend(vars, file_list, var_lists, args)
     out = {'d': d,
-           'l': {'samples': np.asarray([os.path.split(f)[1][:-3] for f in file_list], dtype='object'),
-                 'sample_vars': {v: np.asarray(var_lists[v],dtype='object') for v in vars.keys()},
-                 'vars': {v : np.asarray(vals, dtype='object') for v, vals in vars.items()},
-                 'c': np.asarray(args.chr_map.keys(),dtype='object')}
+           'l': {'samples': np.asarray(lg['samples'], dtype='object'),
+                 'sample_vars': {v: np.asarray(vals, dtype='object') for v, vals in lg['sample_vars'].items()},
+                 'vars': {v: np.asarray(vals, dtype='object') for v, vals in lg['vars'].items()},
+                 'c': np.asarray(lg['c'], dtype='object')}
            }
-    for si, f in enumerate(file_list):
-        if args.verbose:
-            sys.stderr.write('processing %s...\n' % f)
-        fdata = bw2py(f, args.chr_map)
-        for chi, (ch, _) in enumerate(args.chr_map.items()):
-            if ch not in fdata: continue
-            pos, vals = fdata[ch]
-            if not args.sparse:
-                out['d'][chi][pos,si] = vals
-            else:
-                out['d'][chi][0].extend(pos) #rows
-                out['d'][chi][1].extend([si]*len(pos)) #cols
-                out['d'][chi][2].extend(vals) #values
-    if args.sparse:
-        for chi, (chr, chL) in enumerate(args.chr_map.items()):
-            R, C, V = out['d'][chi]
-            out['d'][chi] = sparse.csc_matrix((V, (R, C)), shape=(chL,S), dtype=float)
     return {args.outname: out}
 
 
+def write_npy(vars, file_list, var_lists, args):
+    """
+    as build_matlab_objects, but every chromosome matrix is written to the args.output folder as it is assembled - a
+    <chr>.npy array (column major, filled through a memory map), or a <chr>.npz sparse matrix (see scipy.sparse.
+    save_npz) - with the legend in legend.json. Peak memory is a single chromosome of a single sample for dense output,
+    and a single sparse chromosome matrix otherwise.
+    """
+    S = len(file_list)
+    os.makedirs(args.output, exist_ok=True)
+    tmp_dir = tempfile.mkdtemp(prefix='bwhub2mat.', dir=args.tmp_dir)
+    try:
+        dirs = convert_samples(file_list, tmp_dir, args)
+        for ch, L in zip(args.chr_map, chr_rows(args)):
+            path = args.output + os.sep + ch
+            if args.sparse:
+                sparse.save_npz(path + '.npz', sparse_chr(dirs, ch, L))
+            else:
+                out = np.lib.format.open_memmap(path + '.npy', mode='w+', dtype=np.double, shape=(L, S),
+                                                fortran_order=True)
+                fill_dense_chr(dirs, ch, out).flush()
+                del out
+    finally:
+        shutil.rmtree(tmp_dir)
+    with open(args.output + os.sep + 'legend.json', 'w') as OUT:
+        json.dump(build_legend(vars, file_list, var_lists, args), OUT)
+
+
 def reorder_samples(file_list, var_lists, vars, args):
     for v, type in args.order_by[::-1]:
         vals = [float(vv) for vv in var_lists[v]] if type == 'num' else var_lists[v]
@@ -227,7 +247,16 @@ def parse_args():
     p.add_argument('--verbose', '-v', action='store_false', help='do not output processing info to stderr')
     p.add_argument('--sparse', '-ns', action='store_false', help='should output NOT be in sparse format')
     p.add_argument('--output', '-o', type=str, default=None,
-                   help='output file name, default is stdout')
+                   help='output file name, default is stdout. An output folder for npy format')
+    p.add_argument('--format', '-f', type=str, choices=['mat', 'npy'], default='mat',
+                   help=('output format. mat holds all chromosomes in memory, npy writes a file per chromosome as it '
+                         'is built (see write_npy)'))
+    p.add_argument('--n_workers', '-nw', type=int, default=4, help='number of bw files converted in parallel')
+    p.add_argument('--tmp_dir', '-t', type=str, default=None,
+                   help='where converted samples are kept until they are merged, default is the system temp folder')
+    p.add_argument('--bin_size', '-b', type=int, default=None,
+                   help='collect the mean value of every bin of this size (from the BigWig zoom levels), instead of '
+                        'every position')
     p.add_argument('--var_regexp', '-ve', type=str, default=None,
                    help=('Name matching python regexps that also defines the named variables. Semicolon-separated, '
                          'first matching regexp counts. '
@@ -241,7 +270,9 @@ def parse_args():
                          'files, the given order will determine the order in the output cell array. If a valid file '
                          'path is given, the data is read from file, one line per chr, tab delimited name\tlength.'))
     args = p.parse_args()
-    if args.output is None:
+    if args.format == 'npy':
+        if args.output is None: p.error('an output folder (-o) is required for npy format')
+    elif args.output is None:
         args.__dict__['output'] = sys.stdout
     else:
         args.__dict__['output'] = open(args.__dict__['output'], 'wb')
@@ -266,6 +297,9 @@ if __name__ == '__main__':
     file_list, var_lists, vars = reorder_samples(file_list, var_lists, vars, args)
     if args.verbose:
         sys.stderr.write('marging %i files...\n' % len(file_list))
-    mdict = build_matlab_objects(vars, file_list, var_lists, args)
-    sio.savemat(args.output, mdict)
+    if args.format == 'npy':
+        write_npy(vars, file_list, var_lists, args)
+    else:
+        mdict = build_matlab_objects(vars, file_list, var_lists, args)
+        sio.savemat(args.output, mdict)
 
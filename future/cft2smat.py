@@ -3,8 +3,11 @@ import scipy.io as sio
 import numpy as np
 from scipy import sparse
 import argparse
+from itertools import islice
 
 
+CFT_CHUNK = 10 ** 6  # lines parsed at once
+FLUSH_SIZE = 10 ** 7  # fragments buffered per chromosome before they are merged into the counts
 INTERPRETER = '/cs/bd/tools/nflab_env/bin/python3.4'
 if not sys.executable == INTERPRETER:  # divert to the "right" interpreter
     import subprocess as sp
@@ -23,24 +26,77 @@ def parse_chrlen(chrlen_file):
     return cl
 
 
-def read_cft(cft_in):
+class PairCounter(object):
+    """
+    Counts of (row, column) pairs, kept as sorted unique int64 keys (row << 32 | column) and their counts. Added pairs
+    are buffered, and merged into the counts every flush_size pairs, so memory is O(distinct pairs + flush_size)
+    rather than O(pairs).
+    """
+
+    def __init__(self, flush_size=FLUSH_SIZE):
+        self.keys, self.counts = np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        self.buf, self.n_buf, self.flush_size = [], 0, flush_size
+
+    def add(self, rows, cols):
+        self.buf.append((rows.astype(np.int64) << 32) | cols.astype(np.int64))
+        self.n_buf += len(rows)
+        if self.n_buf >= self.flush_size: self.flush()
+
+    def flush(self):
+        if not self.buf: return
+        keys, counts = np.unique(np.concatenate(self.buf), return_counts=True)
+        self.buf, self.n_buf = [], 0
+        keys, inv = np.unique(np.concatenate([self.keys, keys]), return_inverse=True)
+        self.counts = np.bincount(inv, weights=np.concatenate([self.counts, counts])).astype(np.int64)
+        self.keys = keys
+
+    def matrix(self, shape):
+        self.flush()
+        return sparse.csc_matrix((self.counts.astype(float), (self.keys >> 32, self.keys & 0xffffffff)),
+                                 shape=shape, dtype=float)
+
+
+def read_cft(cft_in, vplot=None, chunk=CFT_CHUNK):
+    """
+    parse a chr, from, to (1-based) fragment file, chunk lines at a time
+
+    :param vplot: a (max_len, band) pair to count fragments by length band and center (a V-plot) instead of by their
+                  from and to positions. Fragments longer than max_len are ignored.
+    :return: a map from chromosome to a PairCounter of its fragments
+    """
     data = {}
-    for line in cft_in:
-        chr, fr, to = line.strip().split('\t')
-        if chr not in data:
-            data[chr] = ([],[])
-        data[chr][0].append(int(fr))
-        data[chr][1].append(int(to))
+    while True:
+        lines = list(islice(cft_in, chunk))
+        if not lines: break
+        cols = np.loadtxt(lines, dtype=str, delimiter='\t', ndmin=2)
+        chrs, fr, to = cols[:, 0], cols[:, 1].astype(np.int64), cols[:, 2].astype(np.int64)
+        if vplot is None:
+            rows, pos = fr - 1, to - 1
+        else:
+            max_len, band = vplot
+            l = to - fr + 1
+            keep = l <= max_len
+            chrs, rows, pos = chrs[keep], (l[keep] - 1) // band, (fr[keep] + to[keep]) // 2 - 1
+        names, first = np.unique(chrs, return_index=True)
+        for chr in names[np.argsort(first)]:  # in order of appearance
+            m = chrs == chr
+            data.setdefault(str(chr), PairCounter()).add(rows[m], pos[m])
     return data
 
 
-def write_mat(out_to, data, strand, meta, chr_lengths):
+def write_mat(out_to, data, strand, meta, chr_lengths, vplot=None):
+    """
+    every chromosome is a (length x length) sparse matrix of fragment counts by from (row) and to (column) position,
+    or for a V-plot, a (#bands x length) matrix of counts by length band (row) and center position (column)
+    """
     s = {}
-    for chr, (frs, tos) in data.items():
-        s[chr] = sparse.csc_matrix((np.ones(len(frs)), (np.asarray(frs)-1, np.asarray(tos)-1)),
-                                   shape=(chr_lengths[chr],chr_lengths[chr]), dtype=float)
+    for chr, counts in data.items():
+        l = chr_lengths[chr]
+        shape = (l, l) if vplot is None else ((vplot[0] - 1) // vplot[1] + 1, l)
+        s[chr] = counts.matrix(shape)
     s['meta'] = meta
     s['strand'] = strand
+    if vplot is not None: s['vplot'] = {'max_len': vplot[0], 'band': vplot[1]}
     sio.savemat(out_to, mdict=dict(data=s))
 
 
@@ -50,11 +106,15 @@ def parse_args():
                    help='cft input file: chr\tfrom\tto, default is stdin')
     p.add_argument('name', type=str, help='sample name')
     p.add_argument('--output', '-o', type=str, default=None,
-                   help='to which .mat output is written. default is name.cft.mat')
+                   help='to which .mat output is written. default is name.cft.mat (name.vplot.mat for V-plots)')
     p.add_argument('--strand', '-s', type=str, choices=['w','c','no'], default='no',
                    help='cft strand ("no" if not strand-specific)')
     p.add_argument('--chr_len_file', '-clf', type=str, default='/cs/wetlab/genomics/scer/genome/sacCer3.sizes',
                    help='path to chromosome lengths file')
+    p.add_argument('--vplot', '-vp', type=int, default=None,
+                   help='count fragments up to this length by length and center position (a V-plot), instead of by '
+                        'from and to positions')
+    p.add_argument('--band', '-b', type=int, default=1, help='V-plot fragment length band width')
     args = p.parse_args()
     if args.input is None:
         args.__dict__['input'] = sys.stdin
@@ -62,10 +122,13 @@ def parse_args():
         args.__dict__['input'] = open(args.input)
 
     if args.output is None:
-        args.__dict__['output'] = args.name + '.cft.mat'
+        args.__dict__['output'] = args.name + ('.cft.mat' if args.vplot is None else '.vplot.mat')
+    args.__dict__['vplot'] = None if args.vplot is None else (args.vplot, args.band)
 
     return args
 
 if __name__ == '__main__':
     args = parse_args()
-    write_mat(args.output, read_cft(args.input), args.strand, args.name, parse_chrlen(args.chr_len_file))
+    write_mat(args.output, read_cft(args.input, args.vplot), args.strand, args.name, parse_chrlen(args.chr_len_file),
+              args.vplot)
+
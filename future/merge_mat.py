@@ -2,12 +2,18 @@
 import sys
 import os
 import re
+import json
+import shutil
+import tempfile
 import scipy.io as sio
 import numpy as np
 from scipy import sparse
 import argparse
 from collections import OrderedDict
 
+sys.path.append(os.path.split(os.path.split(os.path.abspath(__file__))[0])[0])
+from common.chr_columns import fill_dense_chr, save_column, sparse_chr
+
 # INTERPRETER = '/cs/bd/tools/nflab_env/bin/python3.4'
 # if not sys.executable == INTERPRETER:  # divert to the "right" interpreter
 #     import subprocess as sp
@@ -61,26 +67,100 @@ def mat2py(f):
     """
     Read a MATLAB and convert it to a python object
     :param f:  .mat file name / handle file generated by the bed2mat.py script
-    :return: map chr -> data
+    :return: map field -> data (chromosomes, "meta", "strand" and "is_sparse")
     """
     d = sio.loadmat(f)['data']
     return {n: v for n, v in zip(d.dtype.names, d[0][0])}
 
 
-def is_sparse(f):
+def convert_sample(f, chr_map, out_dir):
     """
-    Is the given matlab file in sparse format
-    :param f:  .mat file name / handle file generated by the bed2mat.py script
-    :return: True/False
+    write the non-zero positions and values of every chromosome of a bed2mat output (.mat or .npz) to out_dir (see
+    common.chr_columns). A .npz file is read a chromosome at a time, a .mat file is read whole (MATLAB structs can't
+    be read a field at a time), and released before the next sample is read.
+
+    :param f: .mat / .npz file generated by the bed2mat.py script
+    :param chr_map: an OrderedDict of chr -> length
+    :return: the sample name (its "meta" field), and a map from chr -> whether it is sparse in this sample
     """
-    d = sio.loadmat(f)['data']
-    i = d.dtype.names.index('is_sparse')
-    return d[0][0][19][0][0] == 1
+    npz = None
+    if f.endswith('.npz'):
+        npz = np.load(f)
+        meta = str(npz['meta'])
+
+        def get(ch):
+            if ch + '.index' in npz:
+                idx = npz[ch + '.index']
+                return sparse.csc_matrix((npz[ch + '.value'], idx, [0, len(idx)]))
+            return npz[ch] if ch in npz else None
+    else:
+        fdata = mat2py(f)
+        meta = str(fdata['meta'][0])
+        get = fdata.get
+
+    os.makedirs(out_dir, exist_ok=True)
+    flags = OrderedDict()
+    try:
+        for ch in chr_map:
+            v = get(ch)
+            if v is None:  # missing chromosomes are empty
+                pos, vals = np.zeros(0, dtype=np.int64), np.zeros(0)
+            elif sparse.issparse(v):
+                v = v.tocsc()
+                v.sum_duplicates()
+                pos, vals = v.indices, v.data
+            else:
+                v = np.ravel(v)
+                pos = np.flatnonzero(v)
+                vals = v[pos]
+            flags[ch] = v is None or sparse.issparse(v)
+            save_column(out_dir, ch, pos, vals)
+    finally:
+        if npz is not None: npz.close()
+    return meta, flags
+
+
+def convert_samples(file_list, tmp_dir, args):
+    """
+    convert all files, one at a time, see convert_sample
+
+    :return: a list of sample folders, a list of sample names, and a map from chr -> whether it is sparse in all samples
+    """
+    dirs, names, as_sparse = [], [], OrderedDict((ch, True) for ch in args.chr_map)
+    for si, f in enumerate(file_list):
+        if args.verbose:
+            sys.stderr.write('processing %s...\n' % f)
+        d = tmp_dir + os.sep + str(si)
+        meta, flags = convert_sample(f, args.chr_map, d)
+        dirs.append(d)
+        names.append(meta)
+        for ch, sp in flags.items(): as_sparse[ch] &= sp
+    return dirs, names, as_sparse
+
+
+def chr_matrices(dirs, as_sparse, args):
+    """
+    :return: yields (chr, matrix) pairs, every matrix is built when requested, from the sample columns
+    """
+    for ch, L in args.chr_map.items():
+        if as_sparse[ch]: yield ch, sparse_chr(dirs, ch, L)
+        else: yield ch, fill_dense_chr(dirs, ch, np.zeros((L, len(dirs))))
+
+
+def build_legend(samples, vars, var_lists, args):
+    """
+    :return: the legend of the output, see build_matlab_objects
+    """
+    return {'samples': samples,
+            'sample_vars': OrderedDict((v, var_lists[i]) for i, v in enumerate(vars)),
+            'vars': OrderedDict((v, vals) for v, vals in vars.items()),
+            'c': list(args.chr_map.keys())}
 
 
 def build_matlab_objects(vars, file_map, file_list, var_lists, args):
     """
-    prep the output MATLAB objects
+    prep the output MATLAB objects. Samples are converted one at a time to temporary per chromosome arrays, and every
+    chromosome matrix is assembled from them a column at a time, it is sparse if it is sparse in all samples.
 
     :param vars: an OrderedDict of variable name -> variable values
     :param file_map: a map from variable values tuple -> file name
@@ -92,74 +172,59 @@ def build_matlab_objects(vars, file_map, file_list, var_lists, args):
                       length, and S is the number of samples.
                 * l - a legend for the data, a struct, with following fields:
                       * samples - a list of sample names in the order they appear in "d{i}"
-                      * vars - a struct with every field corresponding to a variable of the samples, mapping to a list
-                               of values of that variable in the order of samples in "d"
-                      * r - a struct with variables reshaped to a multi-dimensional array for easy access to subsets of
-                            samples.
-                      * c - chromosome names
-                * r - a mapping of indices from the N_ixS structure of the data to multidimensional array, with every
-                      dimension corresponding to a different variable, for for easy access to subsets of samples.
-    """
-    S = len(file_list)
-    as_sparse = True
-    for f in file_list:
-        if not is_sparse(f):
-            as_sparse = False
-            break
-    # init = sparse.csc_matrix if as_sparse else np.zeros
-    out = {'d': [] * len(args.chr_map),
-           'l': {'samples':[], 'vars': {}, 'r': {}, 'c': []},
-           'r': []}
-    for si, f in enumerate(file_list):
-        print('xxx')
-        if args.verbose:
-            print('xxx')
-            sys.stderr.write('processing %s...\n' % f)
-        fdata = mat2py(f)
-        out['l']['samples'].append(fdata['meta'])
-        for chi, (ch, _) in enumerate(args.chr_map.iteritems()):
-            if as_sparse:
-                out['d'][]
-            if ch not in fdata: continue
-            out['d'][chi][:,si] = fdata[ch]
-    # print(d)
-    #
-    #
-    # if self.r:
-    #     lg = OrderedDict()
-    #     r = {}
-    #     for f in features: lg[f.name] = sorted(f.vals)
-    #     for name, _, _ in sample_stats:
-    #         dims = (s[name].shape[0],) + tuple([len(f.vals) for f in features])
-    #         arr = np.empty(dims)
-    #         for si, arri in enumerate(MatExporter.sample2arr(samples, features, lg)):
-    #             itup = (slice(None),) + arri
-    #             arr[itup] = s[name][:, si]
-    #         r[name] = arr
-    #     for f in features:
-    #         dtype = np.object if f.type is str else np.double
-    #         lg[f.name] = np.array(sorted(f.vals), dtype=dtype)
-    #     r['lg'] = lg
-    #     s['r'] = r
-    # s['doc'] = np.array('"lg" is a short for "legend", there is a complex one ("lg") for the samples'
-    #                     ' and then another one for the rows of each table. "r_" is a prefix for reshaped '
-    #                     'data or respective legends', dtype=str)
-    # sio.savemat(fpath, {self.name: s})
-    # return [self.name + '.mat']
-    return {args.out_name: out}
+                      * sample_vars - a struct with every field corresponding to a variable of the samples, mapping to a
+                                      list of values of that variable in the order of samples in "d"
+                      * vars - a struct with variables values in order
+                      * c - chromosome names, in order of "d"
+    """
+    tmp_dir = tempfile.mkdtemp(prefix='merge_mat.', dir=args.tmp_dir)
+    try:
+        dirs, samples, as_sparse = convert_samples(file_list, tmp_dir, args)
+        d = [m for _, m in chr_matrices(dirs, as_sparse, args)]
+    finally:
+        shutil.rmtree(tmp_dir)
+    lg = build_legend(samples, vars, var_lists, args)
+    out = {'d': d,
+           'l': {'samples': np.asarray(lg['samples'], dtype='object'),
+                 'sample_vars': {v: np.asarray(vals, dtype='object') for v, vals in lg['sample_vars'].items()},
+                 'vars': {v: np.asarray(vals, dtype='object') for v, vals in lg['vars'].items()},
+                 'c': np.asarray(lg['c'], dtype='object')}
+           }
+    return {args.name: out}
+
+
+def write_npy(vars, file_map, file_list, var_lists, args):
+    """
+    as build_matlab_objects, but every chromosome matrix is written to the args.output folder as soon as it is
+    assembled, as a <chr>.npy array or a <chr>.npz sparse matrix (see scipy.sparse.save_npz), with the legend in
+    legend.json. Peak memory is a single input file and a single chromosome matrix.
+    """
+    os.makedirs(args.output, exist_ok=True)
+    tmp_dir = tempfile.mkdtemp(prefix='merge_mat.', dir=args.tmp_dir)
+    try:
+        dirs, samples, as_sparse = convert_samples(file_list, tmp_dir, args)
+        for ch, m in chr_matrices(dirs, as_sparse, args):
+            if args.verbose:
+                sys.stderr.write('writing %s...\n' % ch)
+            if sparse.issparse(m): sparse.save_npz(args.output + os.sep + ch + '.npz', m)
+            else: np.save(args.output + os.sep + ch + '.npy', m)
+    finally:
+        shutil.rmtree(tmp_dir)
+    with open(args.output + os.sep + 'legend.json', 'w') as OUT:
+        json.dump(build_legend(samples, vars, var_lists, args), OUT)
 
 
 def parse_args():
 
     def parse_chrmap(chr_map):
         cm = OrderedDict()
-        if os.path.exists(args.chr_map):
-            with open(args.chr_map) as CM:
+        if os.path.exists(chr_map):
+            with open(chr_map) as CM:
                 for line in CM:
                     c, l = line.strip().split('\t')
                     cm[c] = int(l)
         else:
-            for cl in args.chr_map.split(';'):
+            for cl in chr_map.split(';'):
                 c, l = cl.split(':')
                 cm[c] = int(l)
         return cm
@@ -168,21 +233,26 @@ def parse_args():
         vars = set([])
         pat_str = ''
         for f in os.listdir(path):
-            if not f.endswith('.mat'): continue
-            for var_val in f.replace('.mat','').split('_'):
+            if not f.endswith('.mat') and not f.endswith('.npz'): continue
+            for var_val in f[:-4].split('_'):
                 if '-' not in var_val: continue
                 var, _ = var_val.split('-')
                 if var in vars: continue
                 vars.add(var)
                 pat_str += '%s-(?P<%s>\w+)_' % (var, var)
-        return re.compile(pat_str[:-1] + '.mat')
+        return re.compile(pat_str[:-1] + r'\.(?:mat|npz)$')
 
     p = argparse.ArgumentParser()
-    p.add_argument('path', type=str, help='path to a folder containing the .mat files to merge')
+    p.add_argument('path', type=str, help='path to a folder containing the .mat (or .npz) bed2mat files to merge')
     p.add_argument('name', type=str, help=('The name of the resulting matlab struct'))
     p.add_argument('--verbose', '-v', action='store_false', help='output processing info to stderr')
     p.add_argument('--output', '-o', type=str, default=None,
-                   help='output file name, default is stdout')
+                   help='output file name, default is stdout. An output folder for npy format')
+    p.add_argument('--format', '-f', type=str, choices=['mat', 'npy'], default='mat',
+                   help=('output format. mat holds all chromosomes in memory, npy writes a file per chromosome as it '
+                         'is built (see write_npy)'))
+    p.add_argument('--tmp_dir', '-t', type=str, default=None,
+                   help='where converted samples are kept until they are merged, default is the system temp folder')
     p.add_argument('--var_regexp', '-ve', type=str, default=None,
                    help=('Name matching python regexps that also defines the named variables. Semicolon-separated, '
                          'first matching regexp counts. '
@@ -193,8 +263,10 @@ def parse_args():
                          'files, the given order will determine the order in the output cell array. If a valid file '
                          'path is given, the data is read from file, one line per chr, tab delimited name\tlength.'))
     args = p.parse_args()
-    if args.output is None:
-        args.__dict__['output'] = sys.stdout
+    if args.format == 'npy':
+        if args.output is None: p.error('an output folder (-o) is required for npy format')
+    elif args.output is None:
+        args.__dict__['output'] = sys.stdout.buffer
     else:
         args.__dict__['output'] = open(args.__dict__['output'], 'wb')
     args.__dict__['chr_map'] = parse_chrmap(args.chr_map)
@@ -208,6 +280,9 @@ def parse_args():
 if __name__ == '__main__':
     args = parse_args()
     vars, file_map, file_list, var_lists = organize_files(args.path, args.var_regexp)
-    mdict = build_matlab_objects(vars, file_map, file_list, var_lists, args)
-    print mdict
-    #sio.savemat(args.output, mdict)
\ No newline at end of file
+    if args.verbose:
+        sys.stderr.write('merging %i files...\n' % len(file_list))
+    if args.format == 'npy':
+        write_npy(vars, file_map, file_list, var_lists, args)
+    else:
+        sio.savemat(args.output, build_matlab_objects(vars, file_map, file_list, var_lists, args))
@@ -6,7 +6,9 @@ specified format in command line arguments.
 import argparse
 import os
 import sys
+import traceback
 from abc import ABCMeta, abstractmethod
+from collections import OrderedDict
 
 project_dir = os.path.sep.join(sys.modules[__name__].__file__.split(os.path.sep)[:-2])
 sys.path.append(project_dir)
@@ -40,71 +42,278 @@ class Segment(object):
             self.fr = r.reference_start
             self.to = r.reference_end
 
+    @classmethod
+    def from_span(cls, fr, to):
+        s = cls.__new__(cls)
+        s.fr, s.to = fr, to
+        return s
+
     def __len__(self):
         return self.to - self.fr
 
 
+class Segments(object):
+    """
+    All the segments (reads, or fragments of read pairs) of a chromosome as arrays, ordered as in the bam file
+    """
+
+    def __init__(self, rfr, rto, fr, to, rev):
+        """
+        :param rfr, rto: the alignment span of the read (to which fetching a region applies)
+        :param fr, to: the segment span
+        :param rev: the read strand
+        """
+        order = np.argsort(rfr, kind='stable')  # a no-op for a sorted bam
+        self.rfr, self.rto, self.fr, self.to, self.rev = [np.asarray(x)[order] for x in (rfr, rto, fr, to, rev)]
+        self.max_span = int((self.rto - self.rfr).max()) if len(self.rfr) else 0
+
+    @classmethod
+    def from_bam(cls, bam_in, chr, is_paired, use_tlen=False):
+        """
+        :param is_paired: if set, segments are the fragments of properly paired read1s (see paired_fragments)
+        """
+        if is_paired: return cls(*paired_fragments(bam_in, chr, use_tlen))
+        rfr, rto, rev = [], [], []
+        for r in bam_in.fetch(chr):
+            if r.is_unmapped: continue
+            rfr.append(r.reference_start)
+            rto.append(r.reference_end)
+            rev.append(r.is_reverse)
+        rfr, rto = np.array(rfr, dtype=np.int64), np.array(rto, dtype=np.int64)
+        return cls(rfr, rto, rfr, rto, np.array(rev, dtype=bool))
+
+    def overlapping(self, fr, to):
+        """
+        :return: the indices of the reads overlapping [fr, to), as fetched by pysam, in bam order
+        """
+        i0 = np.searchsorted(self.rfr, fr - self.max_span, 'right')
+        i1 = np.searchsorted(self.rfr, to, 'left')
+        i = np.arange(i0, i1)
+        return i[self.rto[i0:i1] > fr]
+
+
+def paired_fragments(bam_in, chr, use_tlen=False):
+    """
+    the fragments of the properly paired read1s of a chromosome, read in a single pass. A fragment spans both mates,
+    which are paired through a name hash - a read waits in the hash only until its mate is read (a few reads later,
+    in a coordinate sorted bam), so memory is bounded by the reads of pairs that are open at any position.
+
+    :param use_tlen: if set, the fragment of a read1 is taken from its template length (TLEN), as reported by the
+                     aligner, and mates are paired through the hash only where TLEN is 0
+    :return: read1 start, read1 end, fragment start, fragment end and read1 strand arrays, in bam order. Read1s
+             whose mate is missing are dropped.
+    """
+    rfr, rto, fr, to, rev = [], [], [], [], []
+    open1 = {}  # read1 name -> its index in the arrays, waiting for its mate
+    open2 = {}  # read2 name -> its span, waiting for its mate
+    for r in bam_in.fetch(chr):
+        if r.is_unmapped or not r.is_proper_pair or r.is_secondary or r.is_supplementary: continue
+        start, end = r.reference_start, r.reference_end
+        if r.is_read1:
+            tlen = r.template_length
+            rfr.append(start)
+            rto.append(end)
+            rev.append(r.is_reverse)
+            if use_tlen and tlen != 0:
+                f = min(start, r.next_reference_start)
+                fr.append(f)
+                to.append(f + abs(tlen))
+                continue
+            mate = open2.pop(r.query_name, None)
+            if mate is None:
+                fr.append(start)
+                to.append(None)  # completed by the mate
+                open1[r.query_name] = len(rfr) - 1
+            else:
+                fr.append(min(start, mate[0]))
+                to.append(max(end, mate[1]))
+        elif r.is_read2:
+            i = open1.pop(r.query_name, None)
+            if i is None:
+                if not use_tlen or r.template_length == 0: open2[r.query_name] = (start, end)
+            else:
+                fr[i] = min(fr[i], start)
+                to[i] = max(rto[i], end)
+    keep = np.array([x is not None for x in to], dtype=bool)
+    to = np.array([-1 if x is None else x for x in to], dtype=np.int64)
+    return [np.array(x, dtype=np.int64)[keep] for x in (rfr, rto, fr)] + [to[keep], np.array(rev, dtype=bool)[keep]]
+
+
+TRANSFORMS = OrderedDict()
+
+
+def register_transform(cls):
+    """
+    a class decorator, making a transform available by name, e.g. in the -T argument
+    """
+    TRANSFORMS[cls.name] = cls
+    return cls
+
+
 class SegmentTransform(object):
+    """
+    A transform maps a segment to a vector over the segment positions, that depends only on the segment length.
+    Vectors are computed once per length (make_kernel) and cached.
+    """
     __metaclass__ = ABCMeta
 
     name = None
     args = {}
     desc = None
+    convolvable = False  # see ConvolvableTransform
 
     def __init__(self, **kwargs):
         self.__dict__.update(kwargs)
+        self.kernels = {}  # segment length -> vector
 
     @abstractmethod
-    def transform(self, s): pass
+    def make_kernel(self, l):
+        """
+        :return: the transform of a segment of length l
+        """
+        pass
+
+    def kernel(self, l):
+        k = self.kernels.get(l)
+        if k is None:
+            k = self.kernels[l] = self.make_kernel(l)
+            k.setflags(write=False)  # shared by all segments of this length
+        return k
+
+    def transform(self, s):
+        return self.kernel(len(s))
 
     def __call__(self, *args, **kwargs):
         return self.transform(*args, **kwargs)
 
+    def add_to(self, w, offs, lens, rev, lo=0):
+        """
+        add the transforms of many segments to a window at once. The transform of the i-th segment (reversed if rev
+        is set) is added to w[offs[i]:offs[i] + lens[i]], where only positions within w[lo:] are updated. Transforms
+        with a simple form override this with event arrays, this default scatters the kernel of every length.
+        """
+        if not len(lens): return w
+        vecs = {}
+        for l in np.unique(lens):
+            v = self.kernel(int(l))
+            vecs[l] = (v[::-1] if rev else v)[:l]
+        vals = np.concatenate([vecs[l] for l in lens])
+        n = np.array([len(vecs[l]) for l in lens], dtype=np.int64)
+        idx = np.repeat(offs, n) + np.arange(n.sum()) - np.repeat(np.cumsum(n) - n, n)
+        keep = (idx >= lo) & (idx < len(w))
+        w += np.bincount(idx[keep], vals[keep], minlength=len(w))
+        return w
+
+    @staticmethod
+    def add_intervals(w, fr, to, lo=0):
+        """
+        add 1 to w[fr[i]:to[i]] for every i, within w[lo:]
+        """
+        fr, to = np.clip(fr, lo, len(w)), np.clip(to, lo, len(w))
+        to = np.maximum(fr, to)
+        d = np.bincount(fr, minlength=len(w) + 1) - np.bincount(to, minlength=len(w) + 1)
+        w += np.cumsum(d)[:len(w)]
+        return w
+
+
+class ConvolvableTransform(SegmentTransform):
+    """
+    A fixed kernel placed at an anchor of every segment - its 5' end ("5p"), 3' end ("3p") or center. The transforms
+    of all the segments of a window are then a single convolution of the kernel with the anchor counts. The kernel
+    of a single segment is clipped to the segment, while the convolution is not, so a kernel should fit within the
+    segments it is applied to.
+    """
+    convolvable = True
+    anchor = '5p'
+
+    @abstractmethod
+    def conv_kernel(self):
+        """
+        :return: the kernel, and the index of the anchor in it
+        """
+        pass
+
+    def anchor_pos(self, lens):
+        if self.anchor == '5p': return np.zeros_like(lens)
+        if self.anchor == '3p': return lens - 1
+        return np.round(lens / 2).astype(np.int64)  # half to even, as round
+
+    def make_kernel(self, l):
+        k, origin = self.conv_kernel()
+        t = np.zeros(l)
+        fr = int(self.anchor_pos(np.array([l]))[0]) - origin
+        lo, hi = max(0, fr), min(l, fr + len(k))
+        t[lo:hi] = k[lo - fr:hi - fr]
+        return t
 
+    def add_to(self, w, offs, lens, rev, lo=0):
+        k, origin = self.conv_kernel()
+        a = self.anchor_pos(lens)
+        if rev: a, k, origin = lens - 1 - a, k[::-1], len(k) - 1 - origin
+        starts = offs + a - origin  # of the kernel
+        base = lo - len(k) + 1  # the first kernel start that reaches w[lo:]
+        starts = starts[(starts >= base) & (starts < len(w))]
+        track = np.bincount(starts - base, minlength=len(w) - base)
+        w[lo:] += np.convolve(track, k)[lo - base:len(w) - base]
+        return w
+
+
+@register_transform
 class Step(SegmentTransform):
     name = 'step'
     args = {'w': (int, 1, 'half-width to extend from center (to each side)')}
     desc = 'step function around read center'
 
-    def transform(self, s):
-        l = len(s)
+    def make_kernel(self, l):
         t = np.zeros(l)
         c = round(l/2)
         t[max(0,c-self.w):min(c+self.w,l)] = 1
         return t
 
+    def add_to(self, w, offs, lens, rev, lo=0):
+        c = np.round(lens / 2).astype(np.int64)  # half to even, as round
+        fr, to = np.maximum(0, c - self.w), np.minimum(c + self.w, lens)
+        to = np.maximum(fr, to)
+        if rev: fr, to = lens - to, lens - fr
+        return SegmentTransform.add_intervals(w, offs + fr, offs + to, lo)
+
 
+@register_transform
 class Coverage(SegmentTransform):
     name = 'cov'
     args = {}
     desc = 'uniform 1 coverage'
 
-    def transform(self, s):
-        return np.ones(len(s))
+    def make_kernel(self, l):
+        return np.ones(l)
+
+    def add_to(self, w, offs, lens, rev, lo=0):
+        return SegmentTransform.add_intervals(w, offs, offs + lens, lo)
 
 
-class FivePrime(SegmentTransform):
+@register_transform
+class FivePrime(ConvolvableTransform):
     name = '5p'
     args = {}
     desc = "indicator at read start (5')"
+    anchor = '5p'
 
-    def transform(self, s):
-        t = np.zeros(len(s))
-        t[0] = 1
-        return t
+    def conv_kernel(self):
+        return np.ones(1), 0
 
 
-class ThreePrime(SegmentTransform):
+@register_transform
+class ThreePrime(ConvolvableTransform):
     name = '3p'
     args = {}
     desc = "indicator at read end (3')"
+    anchor = '3p'
 
-    def transform(self, s):
-        t = np.zeros(len(s))
-        t[-1] = 1
-        return t
+    def conv_kernel(self):
+        return np.ones(1), 0
 
 
+@register_transform
 class Spike(SegmentTransform):
     name = 'spike'
     args = {'a': (float, 5, 'the steepness of the pike, the higher the more spiky the transform')}
@@ -114,19 +323,30 @@ class Spike(SegmentTransform):
         super(Spike, self).__init__(**kwargs)
         self.halfspike = 1 / (np.array(range(1,round(MAX_INSERT/2)+1)) ** self.a)
 
-    def transform(self, s):
-        sl = len(s)
-        h1 = self.halfspike[:round(sl/2)]
-        if sl % 2 == 0:
-            t = np.hstack((h1[::-1], h1))
-        else:
-            t = np.hstack((h1[::-1], h1[1], h1))
-        return t
+    def make_kernel(self, l):
+        h1 = self.halfspike[:round(l/2)]
+        if l % 2 == 0:
+            return np.concatenate((h1[::-1], h1))
+        return np.concatenate((h1[::-1], h1[1:2], h1))
 
 
-def reshape(bam_path, annot_file, transform, out_name, output_file, win=[-500,250], is_paired=True, same_strand=True):
+def reshape(bam_path, annot_file, transform, out_name, output_file, win=[-500,250], is_paired=True, same_strand=True,
+            use_tlen=False):
+    annot, d = reshape_matrix(bam_path, annot_file, transform, win, is_paired, same_strand, use_tlen)
+    s = {'d': d, 'w': np.zeros(win[1] - win[0] + 1) if not len(d) else d[-1], 'l': annot}
+    sio.savemat(output_file, {out_name: s})
+
+
+def reshape_matrix(bam_path, annot_file, transform, win=[-500,250], is_paired=True, same_strand=True, use_tlen=False):
+    """
+    collect the transformed reads around every annotation to a row of a (annotations x window) matrix. The reads of
+    a chromosome are read once, to arrays, and every window is computed at once with transform.add_to
+
+    :return: the annotation ids, and the matrix
+    """
     bam_in = pysam.AlignmentFile(bam_path)
     chrlens = chr_lengths()
+    segments = {}
     vectors = []
     annot = []
     for line in annot_file:
@@ -138,27 +358,31 @@ def reshape(bam_path, annot_file, transform, out_name, output_file, win=[-500,25
         fd = abs(min(0, fr))  # >0 only in case that reached end of chromosome
         fr, to = max(0, fr), min(to, chrlens[chr])
         w = np.zeros(win[1] - win[0]+1)
-        wl = len(w)
-        for r in bam_in.fetch(chr, fr, to):
-            if is_paired:
-                if not r.is_read1 or not r.is_proper_pair: continue
-                s = Segment(r, should_pair=True, afile=bam_in)
-            else:
-                if not same_strand and r.is_reverse == is_rev: continue
-                if same_strand and not r.is_reverse == is_rev: continue
-                s = Segment(r)
-            add = transform(s)
-            if is_rev: add = add = add[::-1]
-            if strand == 1:
-                wfr, wto = s.fr - fr, s.to - fr
-            else:
-                wfr, wto = to - s.to, to - s.fr
-            sfr, sto = abs(min(wfr, 0)), len(s) - abs(min(len(w) - wto, 0))
-            wfr, wto = max(0, wfr), min(wto, wl)
-            w[fd+wfr:fd+wto] += add[sfr:sto]
+        if chr not in segments: segments[chr] = Segments.from_bam(bam_in, chr, is_paired, use_tlen)
+        segs = segments[chr]
+        i = segs.overlapping(fr, to)
+        if not is_paired: i = i[segs.rev[i] == is_rev] if same_strand else i[segs.rev[i] != is_rev]
+        sfr, sto = segs.fr[i], segs.to[i]
+        offs = fd + (sfr - fr if strand == 1 else to - sto)
+        transform.add_to(w, offs, sto - sfr, is_rev, lo=fd)
         vectors.append(w)
-    s = {'d': np.vstack(vectors), 'w': w, 'l': annot}
-    sio.savemat(output_file, {out_name: s})
+    return annot, np.vstack(vectors) if vectors else np.zeros((0, win[1] - win[0] + 1))
+
+
+def reshape_job(key, bam_path, annot_path, transform, win, is_paired, same_strand, use_tlen, out_path):
+    """
+    reshape a sample with a transform, the matrix is written to out_path (.npy). Defined here rather than in a
+    driver script, so it is pickled by reference and runs on cluster workers.
+
+    :return: key, out_path and an error message (None if successful)
+    """
+    try:
+        with open(annot_path) as IN:
+            _, d = reshape_matrix(bam_path, IN, transform, win, is_paired, same_strand, use_tlen)
+        np.save(out_path, d)
+        return key, out_path, None
+    except Exception:
+        return key, None, traceback.format_exc(10)
 
 
 def parse_arguments(p):
@@ -182,6 +406,8 @@ def build_parser():
     g.add_argument('bam_in', type=str, default=None, help='path to an indexed bam file')
     g.add_argument('--is_paired', '-p', action='store_true',
                    help='whether data is paired reads or not.')
+    g.add_argument('--use_tlen', '-tl', action='store_true',
+                   help='for paired data, take fragment ends from the TLEN field instead of pairing mates')
     g.add_argument('--not_same_strand', '-s', action='store_true',
                    help='should directionality be flipped relative to annotation?')
     g.add_argument('--annot_in', '-ain', type=str, default=None,
@@ -199,16 +425,10 @@ def build_parser():
 
 
 def collect_transforms():
-    transforms = {}
-    transform_module = sys.modules[__name__]
-    for x in dir(transform_module):
-        try:
-            if issubclass(transform_module.__dict__[x], SegmentTransform):
-                tname = transform_module.__dict__[x].name
-                if tname is not None:
-                    transforms[tname] = transform_module.__dict__[x]
-        except TypeError: pass
-    return transforms
+    """
+    :return: a map from name to transform class, of all registered transforms
+    """
+    return OrderedDict(TRANSFORMS)
 
 
 def transform_from_string(tstring):
@@ -242,5 +462,5 @@ if __name__ == '__main__':
     args = parse_arguments(build_parser())
     print('reshaping %s...' % args.bam_in)
     reshape(args.bam_in, args.annot_in, args.transform,
-            args.out_name, args.output_file, args.w, args.is_paired, not args.not_same_strand)
+            args.out_name, args.output_file, args.w, args.is_paired, not args.not_same_strand, args.use_tlen)
     print('wrote file: %s' % args.output_file)
\ No newline at end of file
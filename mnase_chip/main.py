@@ -27,6 +27,7 @@ from transeq.exporters import *
 from transeq.filters import *
 from transeq.manage import WorkManager
 from transeq.secure_smtp import ThreadedTlsSMTPHandler
+from common.tts import TTSWindows
 from common.utils import *
 
 
@@ -364,30 +365,12 @@ class ExperimentHandler(object):
         return sq, st
 
     def build_tts_file(self):
-        tts_bed_name = self.tmp_dir + os.sep + 'tts.tmp.bed'
-        tts_bed = open(tts_bed_name, 'w')
-        chrlens = chr_lengths()
-        tts_accs = []
-        for line in open(self.a.tts_file):
-            acc, chr, orf_start, orf_end, tts = line.strip().split('\t')
-            if chr == 'chrXVII': chr = 'chrM'
-            orf_start, orf_end = int(orf_start), int(orf_end)
-            strand = orf_start < orf_end
-            tts_annot_problem = tts == 'NaN' or \
-                                (strand and int(tts) < orf_end) or \
-                                (not strand and int(tts) > orf_end)
-            tts = orf_end if tts_annot_problem else int(tts)
-            w_fr = max(0, tts + ((-1) ** (1 - strand)) * self.a.count_window[1 - strand])
-            w_to = min(chrlens[chr], tts + ((-1) ** (1 - strand)) * self.a.count_window[strand])
-            if not self.a.dont_bound_start:
-                if strand:
-                    w_fr = max(w_fr, orf_start)
-                else:
-                    w_to = min(w_to, orf_start)
-            tts_bed.write('\t'.join([chr, str(w_fr), str(w_to), acc, '1', '+' if strand else '-']) + '\n')
-            tts_accs.append(acc)
-        tts_bed.close()
-        return tts_bed_name, tts_accs
+        """
+        :return: the path of a bed file with the counting window of every TTS, and the TTS accessions
+        """
+        self.tts_windows = TTSWindows.cached(self.a.tts_file, self.a.count_window, self.a.dont_bound_start)
+        tts_bed_name = self.tts_windows.write_bed(self.tmp_dir + os.sep + 'tts.tmp.bed')
+        return tts_bed_name, self.tts_windows.acc.tolist()
 
     def write_stats_file(self, stats, stat_order):
         with open(self.a.output_dir+os.path.sep+'stats.csv','w') as fout:
@@ -736,13 +719,9 @@ class ExperimentHandler(object):
         self.log(lg.CRITICAL, 'Hub available at %s' % mainurl)
 
     def export(self, tts_cnts, out_stats, stat_order):
-        stats = OrderedDict()
-        cnts = OrderedDict()
-        for s in self.samples.values():
-            stats[s] = out_stats[s.base_name()]
-            cnts[s] = tts_cnts[s.barcode]
-        all = [('stats', stats, stat_order),
-               ('tts', cnts, self.tts_accs)]
+        samples = list(self.samples.values())
+        all = [Table.from_dict('stats', {s: out_stats[s.base_name()] for s in samples}, samples, stat_order),
+               Table.from_dict('tts', {s: tts_cnts[s.barcode] for s in samples}, samples, self.tts_accs)]
 
         for e in self.exporters:
             fs = e.export(self.features.values(), self.samples.values(), all)
@@ -0,0 +1,323 @@
+#! /bin/python
+"""
+Benchmarks of the pipeline stages on synthetic data (see synthetic.py). Usage:
+---
+python transeq/benchmark.py <work_dir> -s 1e4,1e5,1e6
+---
+For every scale (number of read pairs), a synthetic experiment is generated in the work folder (once), and every
+stage - barcode splitting, fastq formatting, alignment, filtering, tracks, counting and every exporter - is run on
+all samples, one after the other, and timed with common.timing. Results are appended to <work_dir>/benchmarks.jsonl
+along with the code version (git describe), and compared to the results of a previous version (-b, default is the
+last other version in the file). Stages that are slower than the baseline by more than a given tolerance (-t) are
+reported, and the exit code is 1 (as it is when a stage fails). Stages run in a single process, so the max RSS of a
+stage is only known (maxrss_mb) when it exceeds that of earlier stages, otherwise the process peak so far is recorded
+(process_peak_rss_mb).
+
+The cluster path is benchmarked with the local stand-in cluster (slurm.LocalCluster):
+---
+python transeq/benchmark.py <work_dir> -s '' -ct 100,1000 -tr auto
+---
+pushes no-op tasks (slurm.ping) through a WorkManager over the stand-in cluster, and reports the number of sbatch
+(job arrays) and squeue calls, the queueing time beyond the cluster latency, the task run time beyond the task itself
+(worker startup and transport) and the total overhead per task, compared to ideal scheduling.
+"""
+
+import os
+import sys
+
+project_dir = os.path.sep.join(sys.modules[__name__].__file__.split(os.path.sep)[:-2])
+sys.path.append(project_dir)
+
+from transeq.config import *
+
+if not sys.executable == INTERPRETER:  # divert to the "right" interpreter
+    import subprocess as sp
+    scriptpath = os.path.abspath(sys.modules[__name__].__file__)
+    sp.Popen([INTERPRETER, scriptpath] + sys.argv[1:]).wait()
+    exit()
+
+import argparse
+import json
+import queue
+import shlex as sh
+import shutil
+import socket
+import subprocess as sp
+import time
+import traceback
+from collections import Counter, OrderedDict
+
+from transeq.main import ExperimentHandler, Sample, build_parser, parse_args
+from transeq.monitor import StatusMonitor
+from transeq.exporters import Table, exporters_from_string
+from transeq.filters import build_filter_schemes
+from transeq.synthetic import ToyGenome, plate_barcodes, simulate_reads, write_sample_db
+from transeq.manage import WorkManager
+from common import slurm, timing
+
+RESULTS_FNAME = 'benchmarks.jsonl'
+
+
+def code_version():
+    p = sp.Popen(['git', '-C', project_dir, 'describe', '--always', '--dirty'], stdout=sp.PIPE, stderr=sp.DEVNULL)
+    out = p.communicate()[0].decode('utf8').strip()
+    return out if out else 'NA'
+
+
+def build_index(genome):
+    prefix = genome.path + os.sep + 'genome'
+    if not os.path.isfile(prefix + '.1.bt2'):
+        sp.Popen(sh.split('%s %s %s' % (EXEC['BOWTIE_BUILD'], genome.fasta, prefix)), stdout=sp.DEVNULL).wait()
+    return prefix
+
+
+def experiment_args(a, genome, index, n_reads):
+    """
+    generate the synthetic experiment of the given scale (if it was not generated before)
+
+    :return: pipeline arguments for the experiment, as parsed by the pipeline
+    """
+    d = a.work_dir + os.sep + 'reads-%i' % n_reads
+    if not os.path.isfile(d + os.sep + 'sample_db.csv'):
+        os.makedirs(d, exist_ok=True)
+        bcs = plate_barcodes()[:a.n_samples]
+        simulate_reads(genome, bcs, n_reads, d + os.sep + 'bench', umi_len=a.umi_length)
+        write_sample_db(d + os.sep + 'sample_db.csv', bcs, 'reads-%i' % n_reads)  # written last, marks completion
+    argv = [d + os.sep, '-od', d + os.sep + 'out', '-aip', index, '-tf', genome.tts, '-ul', str(a.umi_length),
+            '-an', str(a.n_threads), '-F', a.filter, '-E', a.exporters]
+    return parse_args(build_parser(), argv)
+
+
+def bench_handler(args):
+    """
+    :return: an experiment handler with the state used by the pipeline stages, without the logging, hub, and
+             worker setup of a pipeline run (stages are executed directly, in this process and its children)
+    """
+    h = ExperimentHandler.__new__(ExperimentHandler)
+    h.a = args
+    h.logq, h.statq = queue.Queue(), queue.Queue()  # not consumed
+    _, h.bc_len, h.samples, h.features = h.parse_sample_db()
+    d = args.output_dir
+    if os.path.isdir(d): shutil.rmtree(d)
+    h.tmp_dir, h.fastq_dir = d + os.sep + TMP_DIR, d + os.sep + FASTQ_DIR
+    h.bam_dir, h.bw_dir = d + os.sep + BAM_DIR, d + os.sep + BW_DIR
+    for p in [h.tmp_dir, h.fastq_dir, h.bam_dir, h.bw_dir]: os.makedirs(p)
+    h.tts_bed_path, h.tts_accs = h.build_tts_file()
+    h.fpipe = build_filter_schemes('filter:' + args.filter)['filter']
+    h.status = StatusMonitor(d + os.sep + 'status.json', [s.base_name() for s in h.samples.values()], [])  # not run
+    h.exporters = exporters_from_string(args.exporters, d)
+    return h
+
+
+def stage_runs(h):
+    """
+    :return: a list of (stage name, function) pairs, in pipeline order. Every function runs the stage for all samples.
+    """
+    a = h.a
+    stats = OrderedDict((s.base_name(), Counter()) for s in h.samples.values())
+    cnts = OrderedDict()
+
+    def split():
+        h.collect_input_fastqs()
+        for s, n in h.split_barcodes().items():
+            if s in stats: stats[s]['n_reads'] = n
+
+    def per_sample(f):
+        def run():
+            for s in h.samples.values():
+                out = f(s)
+                if isinstance(out, dict): stats[s.base_name()].update(out)
+        return run
+
+    def fastq(s):
+        s.files = {'in1': h.tmp_dir + os.sep + s.base_name() + '-1', 'in2': h.tmp_dir + os.sep + s.base_name() + '-2'}
+        s.files.update(s.file_map())
+        return Sample.format_fastq(s.files, a.umi_length, h.bc_len)
+
+    def count(s):
+        cnts[s] = Sample.count(h.tts_bed_path, s.files)
+
+    def export(e):
+        def run():
+            samples = list(h.samples.values())
+            sorder = sorted(set(k for c in stats.values() for k in c))
+            e.export(h.features.values(), samples,
+                     [Table.from_dict('stats', {s: stats[s.base_name()] for s in samples}, samples, sorder),
+                      Table.from_dict('tts', cnts, samples, h.tts_accs)])
+        return run
+
+    runs = [('split', split),
+            ('fastq', per_sample(fastq)),
+            ('align', per_sample(lambda s: Sample.make_bam(s.files, a.n_threads, a.align_index_path))),
+            ('filter', per_sample(lambda s: Sample.filter_bam(s.files, h.fpipe, False))),
+            ('tracks', per_sample(lambda s: Sample.make_tracks(s.files))),
+            ('count', per_sample(count))]
+    runs += [('export-' + type(e).name, export(e)) for e in h.exporters]
+    return runs
+
+
+def benchmark(h, n_reads, version):
+    """
+    run and time all stages, stop at the first failing stage
+
+    :return: a list of result records
+    """
+    records = []
+    for stage, run in stage_runs(h):
+        rec = OrderedDict([('version', version), ('time', time.strftime('%Y-%m-%d %H:%M:%S')),
+                           ('host', socket.gethostname()), ('n_reads', n_reads), ('n_samples', len(h.samples)),
+                           ('stage', stage)])
+        try:
+            with timing.Timer() as t: run()
+        except Exception:
+            rec['error'] = traceback.format_exc()
+            records.append(rec)
+            print('%s failed:\n%s' % (stage, rec['error']))
+            break
+        for k in ['wall', 'cpu', 'io_mb']: rec[k] = round(t.m[k], 3)
+        rec[timing.rss_key(t.m)] = round(t.m['maxrss_mb'], 3)  # stages share a process, see common.timing
+        rec['reads_per_sec'] = round(n_reads / t.m['wall']) if t.m['wall'] else None
+        records.append(rec)
+        rss = 'maxrss: %8.1fMB' if t.m['maxrss_own'] else 'maxrss: <=%.1fMB (peak of earlier stages)'
+        rss %= t.m['maxrss_mb']
+        print('%10i %-12s wall: %8.2fs  cpu: %8.2fs  %s' % (n_reads, stage, rec['wall'], rec['cpu'], rss))
+    return records
+
+
+def cluster_benchmark(a, n_tasks, version):
+    """
+    push n_tasks no-op tasks (slurm.ping) through a WorkManager over a slurm.LocalCluster, and time the scheduling,
+    batching, polling and transport overheads of the cluster path
+
+    :return: a list with a single result record
+    """
+    tmp = a.work_dir + os.sep + 'cluster-%i' % n_tasks
+    if os.path.isdir(tmp): shutil.rmtree(tmp)
+    os.makedirs(tmp)
+    cluster = slurm.LocalCluster(cpus=a.cluster_cpus, latency=a.cluster_latency)
+    backend = slurm.SlurmBackend(tmp, cluster=cluster, transport=a.transport)
+    profq = queue.Queue()  # reported from the backend poller, in this process
+    wm = WorkManager(max_w=a.max_workers, tmp_path=tmp, executor=backend, profq=profq)
+    c, payload = wm.get_channel(), bytes(a.payload_kb * 1024)
+    rec = OrderedDict([('version', version), ('time', time.strftime('%Y-%m-%d %H:%M:%S')),
+                       ('host', socket.gethostname()), ('n_tasks', n_tasks), ('stage', 'cluster-' + a.transport)])
+    with timing.Timer() as t:
+        for _ in range(n_tasks):
+            wm.execute(slurm.ping, args=(payload, a.task_time), c=c, slurm_spec={'cpus-per-task': 1, 'mem': '100M'})
+        errors = [err for out, err in [c.get() for _ in range(n_tasks)] if err is not None]
+        wm.join()
+    time.sleep(cluster.interval * 2)  # let the scheduler reap the last tasks
+    st, task_wall = cluster.stats, 0.
+    while not profq.empty(): task_wall += profq.get()[1]['wall']
+    if errors:
+        rec['error'] = errors[0]
+        print('cluster benchmark (%i tasks): %i tasks failed, first error:\n%s' % (n_tasks, len(errors), errors[0]))
+        return [rec]
+    slots = min(cluster.cpus, a.max_workers)
+    ideal = cluster.latency + -(-n_tasks // slots) * a.task_time  # waves of tasks on all slots
+    rec['wall'] = round(t.m['wall'], 3)
+    for k in ['sbatch', 'squeue', 'tasks']: rec[k] = st[k]
+    rec['queue_sec'] = round(st['queue_time'] / st['tasks'], 3)
+    rec['sched_sec'] = round(rec['queue_sec'] - cluster.latency, 3)  # beyond the cluster latency
+    rec['task_overhead_sec'] = round((st['run_time'] - task_wall) / st['tasks'], 3)  # startup and transport
+    rec['overhead_sec'] = round((t.m['wall'] - ideal) / n_tasks, 3)
+    rec['tasks_per_sec'] = round(n_tasks / t.m['wall'], 2)
+    print('%10i %-12s wall: %8.2fs  (ideal %.2fs)  %.2f tasks/s  overhead/task: %.3fs' %
+          (n_tasks, rec['stage'], rec['wall'], ideal, rec['tasks_per_sec'], rec['overhead_sec']))
+    print('%10s sbatch: %i (%.1f tasks/job)  squeue: %i (%.2f/task)  queued: %.3fs (%.3fs over latency)  '
+          'run overhead: %.3fs' % ('', st['sbatch'], n_tasks / st['sbatch'], st['squeue'], st['squeue'] / n_tasks,
+                                  rec['queue_sec'], rec['sched_sec'], rec['task_overhead_sec']))
+    return [rec]
+
+
+def load_records(path):
+    if not os.path.isfile(path): return []
+    with open(path) as IN:
+        return [json.loads(line, object_pairs_hook=OrderedDict) for line in IN if line.strip()]
+
+
+def compare(records, version, baseline, tolerance):
+    """
+    :param records: all result records, the latest result of every (version, scale, stage) is used, the scale is
+                    n_reads for pipeline stages, and n_tasks for cluster benchmarks
+    :param tolerance: relative slowdown (of wall time) that is considered a regression
+    :return: a list of (scale, stage, baseline wall, wall) for the regressed stages
+    """
+    walls = {}
+    for r in records:
+        if 'error' not in r: walls[(r['version'], r.get('n_reads', r.get('n_tasks')), r['stage'])] = r['wall']
+    regressions = []
+    for (v, n, stage), wall in sorted(walls.items(), key=lambda x: (x[0][1], x[0][2])):
+        if v != version or (baseline, n, stage) not in walls: continue
+        bwall = walls[(baseline, n, stage)]
+        if wall > bwall * (1 + tolerance) and wall - bwall > .5:  # ignore sub-second noise
+            regressions.append((n, stage, bwall, wall))
+    return regressions
+
+
+def build_bench_parser():
+    p = argparse.ArgumentParser(description='benchmark the pipeline stages on synthetic data')
+    p.add_argument('work_dir', type=str,
+                   help='synthetic data, pipeline outputs and the %s results file are written here' % RESULTS_FNAME)
+    p.add_argument('--scales', '-s', type=str, default='1e4,1e5,1e6',
+                   help='comma separated numbers of read pairs to benchmark with, empty to skip the pipeline stages')
+    p.add_argument('--n_samples', '-ns', type=int, default=12, help='number of samples (barcodes)')
+    p.add_argument('--genome_scale', '-gs', type=float, default=1., help='toy genome size, relative to sacCer3')
+    p.add_argument('--umi_length', '-ul', type=int, default=8, help='UMI length')
+    p.add_argument('--n_threads', '-an', type=int, default=4, help='number of alignment threads')
+    p.add_argument('--filter', '-F', type=str, default='dup(),qual()', help='pipeline filter scheme')
+    p.add_argument('--exporters', '-E', type=str, default='tab();mat(r=True)', help='pipeline exporters')
+    p.add_argument('--cluster_tasks', '-ct', type=str, default='',
+                   help='comma separated numbers of tasks to benchmark the cluster path with, default is none')
+    p.add_argument('--task_time', '-tt', type=float, default=.1, help='seconds every cluster benchmark task takes')
+    p.add_argument('--payload_kb', '-pk', type=int, default=1,
+                   help='size of the input and output of every cluster benchmark task')
+    p.add_argument('--cluster_cpus', '-cc', type=int, default=None,
+                   help='cpus of the local stand-in cluster, default is all local cpus')
+    p.add_argument('--cluster_latency', '-cl', type=float, default=1.,
+                   help='seconds tasks wait in the queue of the local stand-in cluster')
+    p.add_argument('--max_workers', '-mw', type=int, default=100, help='maximal number of concurrent cluster tasks')
+    p.add_argument('--transport', '-tr', type=str, default='auto', choices=['auto', 'tcp', 'files'],
+                   help='how cluster tasks receive their inputs and send their outputs')
+    p.add_argument('--baseline', '-b', type=str, default=None,
+                   help='version to compare to, default is the last version in the results file')
+    p.add_argument('--tolerance', '-t', type=float, default=.2,
+                   help='relative slowdown considered a regression, default is 0.2')
+    return p
+
+
+if __name__ == '__main__':
+    a = build_bench_parser().parse_args()
+    a.work_dir = os.path.abspath(a.work_dir)
+    os.makedirs(a.work_dir, exist_ok=True)
+    version = code_version()
+    scales = [int(float(x)) for x in a.scales.split(',') if x]
+    if scales:
+        genome = ToyGenome.generate(a.work_dir + os.sep + 'genome', scale=a.genome_scale)
+        COMMON_GENOMES['SCER']['chrlens'] = genome.sizes  # tracks and count windows are computed on the toy genome
+        index = build_index(genome)
+
+    results_path = a.work_dir + os.sep + RESULTS_FNAME
+    records, failed = load_records(results_path), False
+    runs = [(lambda n: benchmark(bench_handler(experiment_args(a, genome, index, n)), n, version), n) for n in scales]
+    runs += [(lambda n: cluster_benchmark(a, n, version), int(float(x))) for x in a.cluster_tasks.split(',') if x]
+    for run, n in runs:
+        new = run(n)
+        with open(results_path, 'a') as OUT:
+            for r in new: OUT.write(json.dumps(r) + '\n')
+        failed |= any('error' in r for r in new)
+        records += new
+
+    baseline = a.baseline
+    if baseline is None:
+        versions = [r['version'] for r in records if r['version'] != version]
+        baseline = versions[-1] if versions else None
+    if baseline is None:
+        print('No baseline version to compare to.')
+        exit(1 if failed else 0)
+    regressions = compare(records, version, baseline, a.tolerance)
+    print('Compared to %s:' % baseline)
+    for n, stage, bwall, wall in regressions:
+        print('REGRESSION %10i %-12s %8.2fs -> %8.2fs' % (n, stage, bwall, wall))
+    if not regressions: print('No regressions.')
+    exit(1 if regressions or failed else 0)
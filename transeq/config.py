@@ -6,4 +6,6 @@ sys.path.append(project_dir)
 
 from common.config import *
 
-RNA_DATA_PATH = DATA_PATH + os.path.sep + 'RNA'
\ No newline at end of file
+RNA_DATA_PATH = DATA_PATH + os.path.sep + 'RNA'
+STATS_INTERVAL = 5  # sec, minimal interval between stats.csv rewrites
+STATUS_INTERVAL = 10  # sec, interval between status.json rewrites
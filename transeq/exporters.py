@@ -1,9 +1,11 @@
+import json
 import os
 import sys
 import numpy as np
 from scipy import io as sio
 from abc import ABCMeta, abstractmethod
 from collections import OrderedDict
+from operator import itemgetter
 
 def collect_exporters():
     exporters = {}
@@ -32,37 +34,70 @@ class Exporter(object):
         self.__dict__.update(kwargs)
 
     @abstractmethod
-    def export(self, features, sample_stats):
+    def export(self, features, samples, tables):
         """
-        export statistics to output_dir
+        export statistics to output_dir. Exporters may run in parallel, in other processes.
 
         :param features: the feature collection associated with the statistics
         :param samples: a list of samples, determines output order of all stats
-        :param stats: a list of 3-tuples: name - used for identyifing the exported data, sdict - the statistics
-        dictionary, indexed by sample, and then by statistic, and stats - the statistic ordered names.
+        :param tables: a list of Table objects, with a column per sample
         :return: generated file names
         """
         pass
 
+    def add_sample(self, features, samples, sample, tables):
+        """
+        called whenever a sample is done, for exporters that write incrementally (export is still called when all
+        samples are done). Arguments are as in export, with tables holding a single column, of the given sample.
+        """
+        pass
+
+
+class Table(object):
+    """
+    A named (rows x samples) array, the data passed to exporters
+    """
+
+    def __init__(self, name, rows, data):
+        self.name = name
+        self.rows = list(rows)
+        self.data = data
+
+    @classmethod
+    def from_dict(cls, name, sdict, samples, rows):
+        """
+        :param sdict: a map from a sample to a map from row name to value
+        """
+        return cls(name, rows, table_array(sdict, samples, rows))
+
 
 class TabExporter(Exporter):
     name = 'tab'
     description = 'export to tab delimited files'
     args = {}
 
-    def export(self, features, samples, sample_stats):
+    BUFFER = 2 ** 20
+
+    def export(self, features, samples, tables):
         fnames = []
-        for name, sdict, stats in sample_stats:
-            fname = name + '.tab'
+        samples = list(samples)
+        for t in tables:
+            fname = t.name + '.tab'
             fnames.append(fname)
-            fout = open(self.out_path + os.sep + fname, 'w')
-            # header:
-            for f in features:
-                fout.write(str(f) + '\t' + '\t'.join(str(s.fvals[f]) for s in samples) + '\n')
-            # counts
-            for stat in stats:
-                fout.write(stat + '\t' + '\t'.join(str(sdict[s][stat]) for s in samples) + '\n')
-            fout.close()
+            with open(self.out_path + os.sep + fname, 'w', buffering=TabExporter.BUFFER) as fout:
+                # header:
+                for f in features:
+                    fout.write(str(f) + '\t' + '\t'.join(str(s.fvals[f]) for s in samples) + '\n')
+                # counts, as str() of the original values: whole numbers as integers, the rest as floats
+                data = np.asarray(t.data, dtype=np.double)
+                whole = np.isfinite(data).all() and (data == np.round(data)).all() and (np.abs(data) < 2 ** 53).all()
+                if whole:  # e.g. counts, a single formatting operation per row
+                    fmt = '%s' + '\t%d' * len(samples) + '\n'
+                    rows = zip(t.rows, data.astype(np.int64).tolist())
+                    fout.writelines(fmt % ((r,) + tuple(vals)) for r, vals in rows)
+                else:
+                    fout.writelines(r + '\t' + '\t'.join(str(int(v)) if v.is_integer() else repr(v) for v in vals)
+                                    + '\n' for r, vals in zip(t.rows, data.tolist()))
         return fnames
 
 
@@ -72,31 +107,28 @@ class MatExporter(Exporter):
     args = {'r': (bool, True, 'whether to include a multidimensional array version of the data'),
             'name': (str, 'tts', 'used as the file name and the matlab struct name.')}
 
-    def export(self, features, samples, sample_stats):
+    def export(self, features, samples, tables):
         fpath = self.out_path + os.sep + self.name
         lg = {}
         for f in features:
-            dtype = np.object if f.type is str else np.double
+            dtype = object if f.type is str else np.double
             lg[f.name] = np.array([s.fvals[f] for s in samples], dtype=dtype)
 
         s = dict(lg=lg)
-        for name, sdict, stats in sample_stats:
-            lg[name] = np.array(stats, dtype=np.object)
-            s[name] = np.array([[float(sdict[s][stat]) for s in samples] for stat in stats])
+        for t in tables:
+            lg[t.name] = np.array(t.rows, dtype=object)
+            s[t.name] = t.data
 
         if self.r:
             lg = OrderedDict()
             r = {}
             for f in features: lg[f.name] = sorted(f.vals)
-            for name, _, _ in sample_stats:
-                dims = (s[name].shape[0],) + tuple([len(f.vals) for f in features])
-                arr = np.empty(dims)
-                for si, arri in enumerate(MatExporter.sample2arr(samples, features, lg)):
-                    itup = (slice(None),) + arri
-                    arr[itup] = s[name][:,si]
-                r[name] = arr
+            idx = MatExporter.sample_index(samples, features, lg)
+            shape = tuple(len(vals) for vals in lg.values())
+            for t in tables:
+                r[t.name] = MatExporter.reshape(t.data, idx, shape)
             for f in features:
-                dtype = np.object if f.type is str else np.double
+                dtype = object if f.type is str else np.double
                 lg[f.name] = np.array(sorted(f.vals), dtype=dtype)
             r['lg'] = lg
             s['r'] = r
@@ -107,19 +139,330 @@ class MatExporter(Exporter):
         return [self.name+'.mat']
 
     @staticmethod
-    def sample2arr(samples, features, rlg):
-        for s in samples:
-            r_idx = tuple(rlg[fname].index(s.fvals[f]) for f, fname in zip(features, rlg.keys()))
-            yield r_idx
+    def sample_index(samples, features, rlg):
+        """
+        :param rlg: the sorted values of every feature
+        :return: a tuple with an index array per feature, holding the position of every sample along its axis
+        """
+        pos = [{v: i for i, v in enumerate(vals)} for vals in rlg.values()]
+        return tuple(np.array([p[s.fvals[f]] for s in samples], dtype=int) for f, p in zip(features, pos))
+
+    @staticmethod
+    def reshape(data, idx, shape):
+        """
+        :param data: a (rows x samples) array
+        :param idx: index arrays, as returned from sample_index
+        :param shape: the number of values of every feature
+        :return: a (rows x feature1 x feature2 ...) array, NaN where no sample has the feature combination. If the
+                 samples are a full design in row-major order (as in a sample_db ordered by features), this is a view
+                 of data and nothing is copied.
+        """
+        rshape = (data.shape[0],) + shape
+        flat = np.ravel_multi_index(idx, shape) if len(shape) else np.zeros(len(data[0]), dtype=int)
+        if len(flat) == int(np.prod(shape)) and np.array_equal(flat, np.arange(len(flat))):
+            return data.reshape(rshape)
+        arr = np.full(rshape, np.nan)
+        arr[(slice(None),) + idx] = data
+        return arr
+
+
+class H5Exporter(Exporter):
+    """
+    Every table ("stats" and "tts") is a group holding a "values" dataset (rows x samples, NaN for samples not done
+    yet), its "rows" names and a "done" flag per sample. The sample names and features in the "samples" group are
+    attached as dimension scales of the sample axis. To read one gene across all samples:
+    with h5py.File('experiment.h5', 'r') as h5:
+        i = list(h5['tts/rows'].asstr()).index('YAL001C')  # or: np.where(h5['tts/rows'][:] == b'YAL001C')
+        h5['tts/values'][i, :]
+    """
+    name = 'h5'
+    description = 'export to a chunked and compressed HDF5 file (requires h5py), samples are added as they complete'
+    args = {'name': (str, 'experiment', 'the file name'),
+            'compression': (str, 'gzip', 'chunk compression - "gzip", "lzf" or "none"')}
+
+    ROW_CHUNK = 512
+    SAMPLE_CHUNK = 64
+
+    def __init__(self, out_path, **kwargs):
+        super(H5Exporter, self).__init__(out_path, **kwargs)
+        try:
+            import h5py
+        except ImportError:
+            raise ValueError('The h5 exporter requires the h5py package')
+        self.fname = self.name + '.h5'
+
+    def export(self, features, samples, tables):
+        self.write(features, list(samples), tables)
+        return [self.fname]
+
+    def add_sample(self, features, samples, sample, tables):
+        samples = list(samples)
+        self.write(features, samples, tables, samples.index(sample))
+
+    def write(self, features, samples, tables, si=None):
+        """
+        :param si: if given, tables hold only the column of this sample index
+        """
+        import h5py
+        with h5py.File(self.out_path + os.sep + self.fname, 'a') as h5:
+            scales = self.sample_scales(h5, features, samples)
+            for t in tables:
+                if si is None:
+                    values, done = self.table(h5, t.name, t.rows, scales)
+                    values[...] = t.data
+                    done[...] = True
+                    continue
+                rows = H5Exporter.strings(h5[t.name]['rows']) if t.name in h5 else []
+                ri = {r: i for i, r in enumerate(rows)}
+                rows += [r for r in t.rows if r not in ri]  # rows of earlier samples are kept
+                values, done = self.table(h5, t.name, rows, scales)
+                if rows == t.rows: values[:, si] = t.data[:, 0]
+                else:
+                    ri = {r: i for i, r in enumerate(rows)}
+                    col = np.full(len(rows), np.nan)
+                    col[[ri[r] for r in t.rows]] = t.data[:, 0]
+                    values[:, si] = col
+                done[si] = True
+
+    def sample_scales(self, h5, features, samples):
+        """
+        :return: the samples group, which is (re)created, along with all tables, if its samples or features changed
+        """
+        import h5py
+        strtype = h5py.special_dtype(vlen=str)
+        cols = OrderedDict([('name', [s.base_name() for s in samples])])
+        cols.update((f.name, [s.fvals[f] for s in samples]) for f in features)
+        if 'samples' in h5:
+            g = h5['samples']
+            if set(g.keys()) == set(cols) and all(H5Exporter.column(g[k]) == v for k, v in cols.items()): return g
+            for k in list(h5.keys()): del h5[k]  # tables of other samples are mislabelled
+        g = h5.create_group('samples')
+        g.create_dataset('name', data=cols['name'], dtype=strtype)
+        for f in features:
+            dtype = strtype if f.type is str else np.int64 if f.type is int else np.double
+            g.create_dataset(f.name, data=cols[f.name], dtype=dtype)
+            g[f.name].attrs['units'] = str(f.units)
+        return g
+
+    def table(self, h5, name, rows, scales):
+        """
+        :return: the values and done datasets of the table, which is (re)created if its rows changed, with the
+                 values of rows it already had
+        """
+        import h5py
+        g = h5.require_group(name)
+        ns = len(scales['name'])
+        old = None
+        if 'values' in g and g['values'].shape[1] == ns:
+            orows = H5Exporter.strings(g['rows'])
+            if orows == list(rows): return g['values'], g['done']
+            old = orows, g['values'][:], g['done'][:]
+        for k in list(g.keys()): del g[k]
+        g.create_dataset('rows', data=list(rows), dtype=h5py.special_dtype(vlen=str))
+        comp = None if self.compression == 'none' else self.compression
+        chunks = (max(1, min(len(rows), H5Exporter.ROW_CHUNK)), min(ns, H5Exporter.SAMPLE_CHUNK))
+        values = g.create_dataset('values', shape=(len(rows), ns), dtype=np.double, fillvalue=np.nan, chunks=chunks,
+                                  compression=comp)
+        g.create_dataset('done', shape=(ns,), dtype=bool)
+        values.dims[0].label, values.dims[1].label = 'rows', 'samples'
+        H5Exporter.attach_scale(values, 0, g['rows'], 'rows')
+        for k in scales: H5Exporter.attach_scale(values, 1, scales[k], k)
+        if old is not None:
+            ri = {r: i for i, r in enumerate(rows)}
+            keep = [(i, ri[r]) for i, r in enumerate(old[0]) if r in ri]
+            if keep:
+                fr, to = zip(*keep)
+                data = np.full((len(rows), ns), np.nan)
+                data[list(to)] = old[1][list(fr)]
+                values[...] = data
+            g['done'][...] = old[2]
+        return values, g['done']
+
+    @staticmethod
+    def strings(ds):
+        return [v.decode('utf8') if type(v) is bytes else v for v in ds[:]]
+
+    @staticmethod
+    def column(ds):
+        """
+        :return: the values of a samples dataset, as a list of python values
+        """
+        return H5Exporter.strings(ds) if ds.dtype.kind in 'OSU' else ds[:].tolist()
+
+    @staticmethod
+    def attach_scale(ds, dim, scale, label):
+        if hasattr(scale, 'make_scale'): scale.make_scale(label)  # h5py >= 2.9
+        else: ds.dims.create_scale(scale, label)
+        ds.dims[dim].attach_scale(scale)
 
 
 class NumpyExporter(Exporter):
+    """
+    Every table is written to <table>.npy (rows x samples), and if r is set, its reshaped version (see MatExporter)
+    to r_<table>.npy. The legend - sample names, feature values per sample, sorted feature values (the axes of the
+    reshaped arrays) and table row names - is written to legend.json. Load with NumpyExporter.load(path), arrays are
+    memory mapped.
+    """
     name = 'np'
-    description = 'pickle numpy versions of the data'
+    description = 'export to memory-mappable numpy (.npy) files with a json legend'
     args = {'r': (bool, True, 'whether to include a multidimensional array version of the data')}
+    LEGEND_FNAME = 'legend.json'
 
-    def export(self, stats, counts):
-        pass
+    def export(self, features, samples, tables):
+        features, samples = list(features), list(samples)
+        lg = OrderedDict([('samples', [s.base_name() for s in samples]),
+                          ('features', OrderedDict()),
+                          ('tables', OrderedDict())])
+        rlg = OrderedDict()
+        for f in features:
+            rlg[f.name] = sorted(f.vals)
+            lg['features'][f.name] = OrderedDict([('type', f.strtype), ('units', f.units),
+                                                  ('values', [s.fvals[f] for s in samples]),
+                                                  ('r_values', rlg[f.name])])
+        if self.r:
+            idx = MatExporter.sample_index(samples, features, rlg)
+            shape = tuple(len(vals) for vals in rlg.values())
+        fnames = []
+        for t in tables:
+            tlg = OrderedDict([('rows', t.rows), ('file', t.name + '.npy')])
+            np.save(self.out_path + os.sep + tlg['file'], t.data)
+            fnames.append(tlg['file'])
+            if self.r:
+                tlg['r_file'] = 'r_' + t.name + '.npy'
+                np.save(self.out_path + os.sep + tlg['r_file'], MatExporter.reshape(t.data, idx, shape))
+                fnames.append(tlg['r_file'])
+            lg['tables'][t.name] = tlg
+        with open(self.out_path + os.sep + NumpyExporter.LEGEND_FNAME, 'w') as OUT: json.dump(lg, OUT)
+        return fnames + [NumpyExporter.LEGEND_FNAME]
+
+    @staticmethod
+    def load(path, mmap_mode='r'):
+        """
+        :param path: the folder of an np export
+        :return: the legend, with a "data" (and "r_data") array added to every table
+        """
+        with open(path + os.sep + NumpyExporter.LEGEND_FNAME) as IN:
+            lg = json.load(IN, object_pairs_hook=OrderedDict)
+        for t in lg['tables'].values():
+            t['data'] = np.load(path + os.sep + t['file'], mmap_mode=mmap_mode)
+            if 'r_file' in t: t['r_data'] = np.load(path + os.sep + t['r_file'], mmap_mode=mmap_mode)
+        return lg
+
+
+class ParquetExporter(Exporter):
+    """
+    Every table is written to <table>.parquet. In the long form there is a row per (sample, table row) pair, with
+    columns: sample (dictionary encoded), a typed column per feature, the table row names in a column named after the
+    table (e.g. "tts", dictionary encoded) and value. In the wide
+    form there is a row per sample with the sample and feature columns followed by a column per table row.
+    Rows are ordered by sample and split into row groups, so filters on features skip row groups using their
+    statistics rather than reading them, e.g. to load only the samples with t=11:
+    ParquetExporter.load('tts.parquet', filters=[('t', '=', 11)])
+    or a single gene: ParquetExporter.load('tts.parquet', filters=[('tts', '=', 'YAL001C')])
+    """
+    name = 'parquet'
+    description = 'export to columnar parquet files (requires pyarrow)'
+    args = {'form': (str, 'long', 'table layout - "long" (sample, features, row, value) or "wide" (a column per row)'),
+            'compression': (str, 'zstd', 'column compression - "zstd", "snappy", "gzip" or "none"')}
+
+    ROW_GROUP_SAMPLES = 8  # samples per row group in the long form
+
+    def __init__(self, out_path, **kwargs):
+        super(ParquetExporter, self).__init__(out_path, **kwargs)
+        try:
+            import pyarrow
+        except ImportError:
+            raise ValueError('The parquet exporter requires the pyarrow package')
+        if self.form not in ('long', 'wide'):
+            raise ValueError('parquet exporter form should be "long" or "wide", not %s' % self.form)
+
+    def export(self, features, samples, tables):
+        import pyarrow.parquet as pq
+        features, samples = list(features), list(samples)
+        fnames = []
+        for t in tables:
+            fname = t.name + '.parquet'
+            if self.form == 'long':
+                pat, group_size = self.long_table(features, samples, t), len(t.rows) * ParquetExporter.ROW_GROUP_SAMPLES
+            else:
+                pat, group_size = self.wide_table(features, samples, t), None
+            pq.write_table(pat, self.out_path + os.sep + fname, row_group_size=group_size,
+                           compression=None if self.compression == 'none' else self.compression)
+            fnames.append(fname)
+        return fnames
+
+    @staticmethod
+    def sample_columns(features, samples, repeat=1):
+        """
+        :return: the names and arrays of the sample and feature columns, every value repeated "repeat" times
+        """
+        import pyarrow as pa
+        rep = np.arange(len(samples)).repeat(repeat).astype(np.int32)
+        names = ['sample'] + [f.name for f in features]
+        cols = [pa.DictionaryArray.from_arrays(rep, [s.base_name() for s in samples])]
+        for f in features:
+            vals = [s.fvals[f] for s in samples]
+            if f.type is str:  # a dictionary of the distinct values
+                uniq, inv = np.unique(vals, return_inverse=True)
+                cols.append(pa.DictionaryArray.from_arrays(inv.astype(np.int32)[rep], uniq.tolist()))
+            else:
+                cols.append(pa.array(np.array(vals, dtype=np.int64 if f.type is int else np.double)[rep]))
+        return names, cols
+
+    @staticmethod
+    def metadata(features, t):
+        return {'table': t.name, 'features': json.dumps([str(f) for f in features])}
+
+    def long_table(self, features, samples, t):
+        import pyarrow as pa
+        nr = len(t.rows)
+        names, cols = ParquetExporter.sample_columns(features, samples, nr)
+        names += [t.name, 'value']
+        cols += [pa.DictionaryArray.from_arrays(np.tile(np.arange(nr, dtype=np.int32), len(samples)), t.rows),
+                 pa.array(t.data.T.ravel())]  # sample major
+        return ParquetExporter.arrow_table(features, t, names, cols)
+
+    def wide_table(self, features, samples, t):
+        import pyarrow as pa
+        names, cols = ParquetExporter.sample_columns(features, samples)
+        names += [str(r) for r in t.rows]
+        cols += [pa.array(vals) for vals in t.data]
+        return ParquetExporter.arrow_table(features, t, names, cols)
+
+    @staticmethod
+    def arrow_table(features, t, names, cols):
+        import pyarrow as pa
+        if len(set(names)) < len(names):
+            raise ValueError('parquet columns of table %s are not unique (a feature named as the table, "sample" '
+                             'or "value"?)' % t.name)
+        return pa.Table.from_arrays(cols, names=names).replace_schema_metadata(ParquetExporter.metadata(features, t))
+
+    @staticmethod
+    def load(path, filters=None, columns=None):
+        """
+        :param filters: pyarrow filters, e.g. [('t', '=', 11)] or [('tts', 'in', ['YAL001C', 'YAL002W'])]
+        :param columns: columns to read, default is all
+        :return: a pyarrow Table, use .to_pandas() for a data frame
+        """
+        import pyarrow.parquet as pq
+        return pq.read_table(path, columns=columns, filters=filters)
+
+
+def table_array(sdict, samples, rows):
+    """
+    :param sdict: a map from a sample to a map from row name to value (missing values are NaN)
+    :return: a (rows x samples) array
+    """
+    rows = list(rows)
+    if not rows: return np.empty((0, len(samples)))
+    get = itemgetter(*rows) if len(rows) > 1 else lambda d: (d[rows[0]],)
+    cols = []
+    for s in samples:
+        try:
+            cols.append(get(sdict[s]))
+        except KeyError:  # e.g. a failed sample
+            cols.append([sdict[s].get(r, np.nan) for r in rows])
+    return np.ascontiguousarray(np.array(cols, dtype=float).T)
 
 
 def exporters_from_string(estring, out_path):
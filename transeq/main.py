@@ -16,19 +16,26 @@ if not sys.executable == INTERPRETER:  # divert to the "right" interpreter
     exit()
 
 import argparse
-import csv
 import logging as lg
 import threading as th
 import multiprocessing as mp
 import threading
 import pickle
+import queue
 import shutil
 from collections import Counter
 
 from transeq.exporters import *
 from transeq.filters import *
 from transeq.manage import WorkManager
+from transeq.monitor import PROGRESS_EVERY, StatusMonitor
+from transeq.store import CountStore
 from transeq.secure_smtp import ThreadedTlsSMTPHandler
+from common import slurm
+from common import timing
+from common.cache import StageCache, file_fingerprint, tool_versions
+from common.stats import FLUSH, REQUEST, StatsTable
+from common.tts import TTSWindows
 from common.utils import *
 
 
@@ -89,7 +96,8 @@ class Sample(object):
             'cbw': self.context.bw_dir + os.sep + self.base_name() + '.c.bw',
             'wbw': self.context.bw_dir + os.sep + self.base_name() + '.w.bw',
             'tmp_bed': self.context.tmp_dir + os.sep + self.base_name() + TMP_BED_SUFF,
-            'tmp_cnt': self.context.tmp_dir + os.sep + self.base_name() + TMP_CNT_SUFF
+            'tmp_cnt': self.context.tmp_dir + os.sep + self.base_name() + TMP_CNT_SUFF,
+            'align_progress': self.context.tmp_dir + os.sep + self.base_name() + '.align.progress'
         }
         if self.context.a.keep_filtered:
             fs['bam_f'] = self.context.filtered_dir + os.sep + self.base_name() + BAM_SUFF
@@ -107,16 +115,70 @@ class Sample(object):
     def __hash__(self):
         return hash(tuple(self.fvals.values()))
 
+    def detached(self):
+        """
+        :return: a copy of the sample without its context, that can be sent to other processes (e.g. exporters)
+        """
+        s = Sample(context=None)
+        s.fvals, s.barcode = self.fvals, self.barcode
+        return s
+
     def critical(self, msg, err, countq):
         msg += '\n' + err
         self.context.logq.put((lg.CRITICAL, msg))
+        self.context.status.sample_failed(self.base_name())
         countq.put((self.barcode, {}))
         exit()
 
+    def stage_keys(self):
+        """
+        :return: the cache key of every sample stage, each key chains the key of the stage it depends on
+        """
+        ctx, a = self.context, self.context.a
+        keys = OrderedDict()
+        keys['fastq'] = ctx.cache.key(ctx.split_key, self.barcode, a.umi_length, ctx.bc_len)
+        keys['align'] = ctx.cache.key(keys['fastq'], a.align_index_path, ctx.versions)
+        keys['align_count'] = ctx.cache.key(keys['fastq'], a.count_index_paths, ctx.versions)
+        keys['filter'] = ctx.cache.key(keys['align'], a.filter, a.keep_filtered, ctx.versions)
+        keys['tracks'] = ctx.cache.key(keys['filter'], ctx.chrlens_key, ctx.versions)
+        keys['count'] = ctx.cache.key(keys['filter'], ctx.tts_key, ctx.versions)
+        return keys
+
+    def stage_outputs(self, stage):
+        return {'fastq': [self.files['fastq']],
+                'align': [self.files['unfiltered_bam'], self.files['sam_hdr']],
+                'align_count': [],
+                'filter': [self.files['bam'], self.files['bam'] + '.bai'] +
+                          ([self.files['bam_f']] if self.files['bam_f'] is not None else []),
+                'tracks': [self.files['wbw'], self.files['cbw']],
+                'count': []}[stage]
+
+    def run_stage(self, stage, key, func, args, c, slurm_spec=None, check_outputs=True):
+        """
+        execute func with the work manager, unless a valid cached result exists, in which case it is put in c
+        :return: whether the result was taken from the cache
+        """
+        hit, out = self.context.cache.lookup(stage, self.base_name(), key, check_outputs)
+        self.context.status.stage_started(self.base_name(), stage, cached=hit,
+                                          progress_path=self.files['align_progress'] if stage == 'align' else None)
+        if hit:
+            msg = 'Using cached %s results for sample %s' % (stage, self.base_name())
+            self.context.logq.put((lg.INFO, msg))
+            c.put((out, None))
+        else:
+            self.context.w_manager.execute(func=func, args=args, c=c, slurm_spec=slurm_spec,
+                                           name=(self.base_name(), stage))
+        return hit
+
+    def stage_done(self, stage, key, hit, out):
+        if not hit: self.context.cache.store(stage, self.base_name(), key, self.stage_outputs(stage), out)
+        self.context.status.stage_done(self.base_name(), stage)
+
     def handle(self, in_files, tts_file, countq):
         self.files['in1'] = in_files[0]
         self.files['in2'] = in_files[1]
         self.files.update(self.file_map())
+        keys = self.stage_keys()
         c = self.context.w_manager.get_channel()
         cp = self.context.w_manager.get_channel() #for parallel tasks
 
@@ -125,58 +187,79 @@ class Sample(object):
 
         # fastq
         args = (self.files, self.context.a.umi_length, self.context.bc_len)
-        self.context.w_manager.execute(func=Sample.format_fastq, args=args, c=c)
+        hit = self.run_stage('fastq', keys['fastq'], Sample.format_fastq, args, c)
         out, err = c.get()
         if err is not None:
             msg = 'Error while formatting fastq for sample %s' % self.base_name()
             self.critical(msg, err, countq)
+        self.stage_done('fastq', keys['fastq'], hit, out)
+        if hit:  # barcode splitting may have been re-done for other samples
+            for f in in_files:
+                if os.path.isfile(f): os.remove(f)
         msg = 'Fastq for sample %s is ready: %s' % (self.base_name(), self.files['fastq'])
         self.context.logq.put((lg.INFO, msg))
 
         # alignment
-        args = (self.files, self.context.a.n_threads, self.context.a.align_index_path, self.context.fpipe)
-        self.context.w_manager.execute(func=Sample.make_bam, args=args, c=c,
-                                       slurm_spec={'cpus-per-task':self.context.a.n_threads,
-                                                   'mem':'8G'})
+        fhit, _ = self.context.cache.lookup('filter', self.base_name(), keys['filter'])
+        args = (self.files, self.context.a.n_threads, self.context.a.align_index_path)
+        ahit = self.run_stage('align', keys['align'], Sample.make_bam, args, c,
+                              slurm_spec={'cpus-per-task':self.context.a.n_threads, 'mem':'8G'},
+                              check_outputs=not fhit)
         if self.context.a.count_index_paths is not None:
             args = (self.files, self.context.a.count_index_paths, self.context.a.n_threads)
-            self.context.w_manager.execute(func=Sample.alignment_count, args=args, c=cp,
-                                           slurm_spec={'cpus-per-task': self.context.a.n_threads,
-                                                       'mem':'8G'})
+            achit = self.run_stage('align_count', keys['align_count'], Sample.alignment_count, args, cp,
+                                   slurm_spec={'cpus-per-task': self.context.a.n_threads, 'mem':'8G'})
             stats, err = cp.get()
             if err is not None:
                 msg = ('Error while counting alignment for sample %s' % self.base_name()) + '\n' + err
+                self.context.status.stage_done(self.base_name(), 'align_count', failed=True)
             else:
                 msg = 'Counted alignments for sample %s' % self.base_name()
+                self.stage_done('align_count', keys['align_count'], achit, stats)
             self.context.logq.put((lg.INFO, msg))
             self.context.statq.put((self.base_name(), stats))
         stats, err = c.get()
         if err is not None:
             msg = 'Error while aligning sample %s' % self.base_name()
             self.critical(msg, err, countq)
+        self.stage_done('align', keys['align'], ahit, stats)
+        self.context.statq.put((self.base_name(), stats))
+
+        # filter
+        args = (self.files, self.context.fpipe, self.context.a.keep_unfiltered)
+        fhit = self.run_stage('filter', keys['filter'], Sample.filter_bam, args, c)
+        stats, err = c.get()
+        if err is not None:
+            msg = 'Error while filtering sample %s' % self.base_name()
+            self.critical(msg, err, countq)
+        self.stage_done('filter', keys['filter'], fhit, stats)
         msg = 'BAM for sample %s is ready: %s' % (self.base_name(), self.files['bam'])
         self.context.logq.put((lg.INFO, msg))
         self.context.statq.put((self.base_name(), stats))
 
         # tracks and counts
-        self.context.w_manager.execute(func=Sample.make_tracks, args=(self.files,), c=c)
-        self.context.w_manager.execute(func=Sample.count, args=(tts_file, self.files), c=cp)
-        cnt, err = c.get()
+        thit = self.run_stage('tracks', keys['tracks'], Sample.make_tracks, (self.files,), c)
+        chit = self.run_stage('count', keys['count'], Sample.count, (tts_file, self.files), cp)
+        out, err = c.get()
         if err is not None:
             msg = ('Error while making tracks for sample %s' % self.base_name()) + '\n' + err
+            self.context.status.stage_done(self.base_name(), 'tracks', failed=True)
         else:
             msg = 'BigWig tracks ready for sample %s' % self.base_name()
+            self.stage_done('tracks', keys['tracks'], thit, out)
         self.context.logq.put((lg.INFO, msg))
 
         cnt, err = cp.get()
         if err is not None:
             msg = 'Error while counting tts in sample %s' % self.base_name()
             self.critical(msg, err, countq)
+        self.stage_done('count', keys['count'], chit, cnt)
         ttl = sum(int(val) for val in cnt.values())
         msg = 'Counted tts reads in sample %s, total: %s' % (self.base_name(), ttl)
         self.context.logq.put((lg.INFO, msg))
         stats = {'tts_counted': ttl}
         self.context.statq.put((self.base_name(), stats))
+        self.context.statq.put(FLUSH)
         countq.put((self.barcode, cnt))
 
     @staticmethod
@@ -215,13 +298,14 @@ class Sample(object):
         return stats
 
     @staticmethod
-    def make_bam(files, n_threads, genome_index, fpipe):
+    def make_bam(files, n_threads, genome_index):
         import shlex as sh
         from common.utils import parse_bowtie_stats
         bt = sp.Popen(sh.split('%s --local -p %i -U %s -x %s' % (EXEC['BOWTIE'], n_threads, files['fastq'], genome_index)),
                       stdout=sp.PIPE, stderr=sp.PIPE)
-        awkcmd = ''.join(("""awk '{if (substr($1,1,1) == "@" && substr($2,1,2) == "SN")""",
-                          """{print $0 > "%s";} print; }' """)) % files['sam_hdr']
+        awkcmd = ''.join(("""awk '{if (substr($1,1,1) == "@") {if (substr($2,1,2) == "SN") print $0 > "%s";} """,
+                          """else if (++n %% %i == 0) {print n > "%s"; close("%s");} print; }' """))
+        awkcmd = awkcmd % (files['sam_hdr'], PROGRESS_EVERY, files['align_progress'], files['align_progress'])
         geth = sp.Popen(sh.split(awkcmd), stdin=bt.stdout, stdout=sp.PIPE)
         st = sp.Popen(sh.split('samtools view -b -o %s' % files['tmp_bam']), stdin=geth.stdout)
         st.wait()
@@ -234,12 +318,16 @@ class Sample(object):
                         stdin=aligned.stdout)
         sort.wait()
         os.remove(files['tmp_bam'])
+        if os.path.isfile(files['align_progress']): os.remove(files['align_progress'])
         stats = parse_bowtie_stats(''.join(bt.stderr.read().decode('utf8')).split('\n'))
-        n = fpipe.filter(files['unfiltered_bam'], files['bam'], files['sam_hdr'], files['bam_f'])
-        stats['passed_filter'] = n
-        os.remove(files['unfiltered_bam'])
         return stats
 
+    @staticmethod
+    def filter_bam(files, fpipe, keep_unfiltered):
+        n = fpipe.filter(files['unfiltered_bam'], files['bam'], files['sam_hdr'], files['bam_f'])
+        if not keep_unfiltered: os.remove(files['unfiltered_bam'])
+        return {'passed_filter': n}
+
     @staticmethod
     def make_tracks(files):
         import shlex as sh
@@ -300,12 +388,30 @@ class ExperimentHandler(object):
 
         self.setup_output()
 
-        self.w_manager = WorkManager(max_w=self.a.max_workers, tmp_path=self.tmp_dir,
-                                     default_slurm_spec={'cpus-per-task': 2, 'mem': '4G'})
+        self.cache = StageCache(self.a.output_dir + os.sep + CACHE_DIR, enabled=not self.a.no_cache)
+        self.versions = tool_versions(['BOWTIE', 'SAMTOOLS', 'BEDTOOLS'])
+        self.chrlens_key = file_fingerprint(COMMON_GENOMES['SCER']['chrlens'])
 
         self.statq, self.stat_thread = self.setup_stats()
+        self.timeline = timing.Timeline()
+        self.prof_synced = th.Event()
+        self.profq, self.prof_thread = self.setup_profiling()
+
+        executor = None
+        if self.a.cluster == 'local':
+            executor = slurm.SlurmBackend(self.tmp_dir, cluster=slurm.LocalCluster(), transport=self.a.transport)
+        self.w_manager = WorkManager(max_w=self.a.max_workers, tmp_path=self.tmp_dir, executor=executor,
+                                     default_slurm_spec={'cpus-per-task': 2, 'mem': '4G'}, profq=self.profq,
+                                     transport=self.a.transport)
+        stages = ['fastq', 'align', 'filter', 'tracks', 'count']
+        if self.a.count_index_paths is not None: stages.insert(2, 'align_count')
+        self.status = StatusMonitor(self.a.output_dir + os.sep + 'status.json',
+                                    [s.base_name() for s in self.samples.values()], stages,
+                                    w_manager=self.w_manager, interval=STATUS_INTERVAL)
+        self.status.run()
 
         self.tts_bed_path, self.tts_accs = self.build_tts_file()
+        self.tts_key = file_fingerprint(self.tts_bed_path)
 
         sfname = self.a.output_dir + os.sep + 'sample_db.csv'
         if not os.path.isfile(sfname): shutil.copy(self.a.sample_db, sfname)
@@ -349,59 +455,65 @@ class ExperimentHandler(object):
         self.logq.put((lvl,msg))
 
     def update_stats(self, sq):
-        stats = OrderedDict()
-        stat_order = []
-        for s in self.samples.values(): stats[s.base_name()] = Counter()
-        stats[NO_BC_NAME] = Counter()
-        for sname, counter in iter(sq.get, None):
-            if not counter: continue
-            for k in counter.keys():
-                if k not in stat_order: stat_order.append(k)
-            stats[sname] += counter
-            self.write_stats_file(stats, stat_order)
-        sq.put((stats, stat_order))
+        """
+        aggregate (sample, statistics) messages. stats.csv and the stats.json snapshot are rewritten at most once per
+        STATS_INTERVAL seconds, and on FLUSH messages (stage boundaries)
+        """
+        table = StatsTable([s.base_name() for s in self.samples.values()] + [NO_BC_NAME],
+                           csv_path=self.a.output_dir + os.sep + 'stats.csv',
+                           snapshot_path=self.a.output_dir + os.sep + 'stats.json', interval=STATS_INTERVAL)
+        while True:
+            try:
+                msg = sq.get(timeout=STATS_INTERVAL)
+            except queue.Empty:  # pending updates are written even if no more messages arrive for a while
+                table.flush(force=False)
+                continue
+            if msg is None: break
+            if msg == FLUSH:
+                table.flush()
+                continue
+            if msg[0] == REQUEST and type(msg[1]) is str:  # statistics of a sample so far, see export_sample
+                self.stat_replies.put(Counter(table.rows.get(msg[1], ())))
+                continue
+            sname, counter = msg
+            if counter: table.add(sname, counter)
+        table.flush()
+        sq.put((table.rows, table.columns()))
 
     def setup_stats(self):
         sq = mp.Queue()
+        self.stat_replies = queue.Queue()
         st = th.Thread(target=self.update_stats, args=(sq,))
         st.daemon = True
         st.start()
         return sq, st
 
+    def update_profile(self, pq):
+        """
+        collect task resource usage measurements to the timeline, and sample task measurements to the statistics
+        """
+        for name, m in iter(pq.get, None):
+            if m is None:  # a sync request, all measurements put before it were handled
+                self.prof_synced.set()
+                continue
+            group, stage = name if type(name) is tuple else ('pipeline', name)
+            self.timeline.add(group, stage, m)
+            if type(name) is tuple: self.statq.put((group, timing.stats_from_measurement(stage, m)))
+
+    def setup_profiling(self):
+        pq = mp.Queue()
+        pt = th.Thread(target=self.update_profile, args=(pq,))
+        pt.daemon = True
+        pt.start()
+        return pq, pt
+
     def build_tts_file(self):
-        tts_bed_name = self.tmp_dir + os.sep + 'tts.tmp.bed'
-        tts_bed = open(tts_bed_name, 'w')
-        chrlens = chr_lengths()
-        tts_accs = []
-        for line in open(self.a.tts_file):
-            acc, chr, orf_start, orf_end, tts = line.strip().split('\t')
-            if chr == 'chrXVII': chr = 'chrM'
-            orf_start, orf_end = int(orf_start), int(orf_end)
-            strand = orf_start < orf_end
-            tts_annot_problem = tts == 'NaN' or \
-                                (strand and int(tts) < orf_end) or \
-                                (not strand and int(tts) > orf_end)
-            tts = orf_end if tts_annot_problem else int(tts)
-            w_fr = max(0, tts + ((-1) ** (1 - strand)) * self.a.count_window[1 - strand])
-            w_to = min(chrlens[chr], tts + ((-1) ** (1 - strand)) * self.a.count_window[strand])
-            if not self.a.dont_bound_start:
-                if strand:
-                    w_fr = max(w_fr, orf_start)
-                else:
-                    w_to = min(w_to, orf_start)
-            tts_bed.write('\t'.join([chr, str(w_fr), str(w_to), acc, '1', '+' if strand else '-']) + '\n')
-            tts_accs.append(acc)
-        tts_bed.close()
-        return tts_bed_name, tts_accs
-
-    def write_stats_file(self, stats, stat_order):
-        with open(self.a.output_dir+os.path.sep+'stats.csv','w') as fout:
-            wrtr = csv.DictWriter(f=fout, fieldnames=['sample']+stat_order)
-            wrtr.writeheader()
-            for s, cntr in stats.items():
-                row = dict(cntr)
-                row.update({'sample':s})
-                wrtr.writerow(row)
+        """
+        :return: the path of a bed file with the counting window of every TTS, and the TTS accessions
+        """
+        self.tts_windows = TTSWindows.cached(self.a.tts_file, self.a.count_window, self.a.dont_bound_start)
+        tts_bed_name = self.tts_windows.write_bed(self.tmp_dir + os.sep + 'tts.tmp.bed')
+        return tts_bed_name, self.tts_windows.acc.tolist()
 
     def execute(self):
         self.log(lg.INFO, 'Re-compiling fastq files...')
@@ -409,7 +521,21 @@ class ExperimentHandler(object):
         bcout = None
         if self.a.keep_nobarcode:
             bcout = self.fastq_dir + os.sep + NO_BC_NAME + '.R1R2.fastq.gz'
-        self.split_barcodes(no_bc=bcout)
+        self.split_key = self.cache.key(sorted(file_fingerprint(f) for fs in self.input_files for f in fs),
+                                        [(b, s.base_name()) for b, s in self.samples.items()],
+                                        self.a.hamming_distance, self.a.debug, bcout)
+        hit, read_counts = self.cache.lookup('split', 'all', self.split_key)
+        if hit and all(self.cache.lookup('fastq', s.base_name(), s.stage_keys()['fastq'])[0]
+                       for s in self.samples.values()):
+            self.log(lg.INFO, 'Using cached barcode splitting results.')
+            self.report_read_counts(read_counts)
+            self.status.split_done(read_counts, cached=True)
+        else:
+            with timing.Timer() as t: read_counts = self.split_barcodes(no_bc=bcout)
+            self.profq.put(('split', t.m))
+            self.log(lg.INFO, 'Barcode splitting took %.1f seconds (%.1f cpu seconds).' % (t.m['wall'], t.m['cpu']))
+            self.cache.store('split', 'all', self.split_key, [bcout] if bcout is not None else [], read_counts)
+            self.status.split_done(read_counts)
 
         self.log(lg.INFO, 'Converting files...')
         cq = self.w_manager.get_channel()
@@ -424,6 +550,7 @@ class ExperimentHandler(object):
         while True:
             bc, counter = cq.get()
             tts_counters[bc] = counter
+            if counter: self.export_sample(self.samples[bc], counter)
             if len(tts_counters) == len(self.samples): break
 
         if self.a.no_hub: self.build_hub()
@@ -577,8 +704,12 @@ class ExperimentHandler(object):
         self.bam_dir = d + os.sep + BAM_DIR
 
         if os.path.isdir(self.tmp_dir): shutil.rmtree(self.tmp_dir)
-        if os.path.islink(self.bw_dir): os.remove(self.bw_dir)
-        elif os.path.isdir(self.bw_dir): shutil.rmtree(self.bw_dir)
+        if os.path.islink(self.bw_dir):  # tracks were moved to the hub by a previous run, copy them back
+            hub_bw_dir = os.path.realpath(self.bw_dir)
+            os.remove(self.bw_dir)
+            if os.path.isdir(hub_bw_dir) and not self.a.no_cache:
+                shutil.copytree(hub_bw_dir, self.bw_dir)  # the published hub stays intact until it is rebuilt
+        elif os.path.isdir(self.bw_dir) and self.a.no_cache: shutil.rmtree(self.bw_dir)
 
         # assuming all folder structure exists if check passes
         self.dir_and_log(d, lg.INFO)
@@ -598,12 +729,7 @@ class ExperimentHandler(object):
             self.www_rel = os.sep.join([self.proj, self.exp])
             d = os.sep.join([WWW_PATH, self.proj])
             self.dir_and_log(d, lg.INFO, chto='777')
-            d = os.sep.join([d, self.exp])
-            if os.path.isdir(d):
-                self.log(lg.DEBUG, 'Removing old folder')
-                shutil.rmtree(d)
-            self.dir_and_log(d, lg.INFO, chto='777')
-            self.www_path = d
+            self.www_path = os.sep.join([d, self.exp])  # replaced when the new hub is ready (see build_hub)
 
     def split_barcodes(self, no_bc=None):
         # TODO: make this slurm executed code
@@ -617,55 +743,56 @@ class ExperimentHandler(object):
         """
         :param no_bc: if given, orphan fastq entries are written to this prefix (with R1/R2 interleaved)
         """
-        def compile_awk(it, b2s):
+        def compile_awk(it, b2s, progress=None):
             cnt_path = self.tmp_dir + os.sep + (BC_COUNTS_FNAME % it)
             nobc = NO_BC_NAME + '-' + it
             arraydef = ';\n'.join('a["%s"]="%s-%s"' % (b, s, it) for b, s in b2s.items()) + ';\n'
-            awk_str = (""" 'BEGIN {%s} {x=substr($4,1,%i); if (x in a) """,
+            report, end_report = '', ''
+            if progress is not None:  # number of processed reads, for the status monitor
+                report = 'if (NR %% %i == 0) {print NR > "%s"; close("%s");} ' % (PROGRESS_EVERY, progress, progress)
+                end_report = 'print NR > "%s"; ' % progress
+            awk_str = (""" 'BEGIN {%s} {%sx=substr($4,1,%i); if (x in a) """,
                        """{c[a[x]]++; print >> "%s/"a[x];} else {c["%s"]++; print;} }""",
-                       """END { for (bc in c) print bc, c[bc] >> "%s" } '""")
-            awk_str = ''.join(awk_str) % (arraydef, self.bc_len , self.tmp_dir, nobc, cnt_path)
+                       """END { for (bc in c) print bc, c[bc] >> "%s"; %s} '""")
+            awk_str = ''.join(awk_str) % (arraydef, report, self.bc_len, self.tmp_dir, nobc, cnt_path, end_report)
             return awk_str, cnt_path
 
         def merge_statistics(bc1, bc2):
-            stat = "n_reads"
             cntr = Counter()
             with open(bc1) as IN:
                 for line in IN:
                     sample, cnt = line.strip().split(' ')
                     sample = sample[:-2]
                     if sample == NO_BC_NAME: continue  # only from nobc_counts-2
-                    c = Counter()
-                    c[stat] = int(cnt)
                     cntr[sample] += int(cnt)
-                    self.statq.put((sample, c))
             os.remove(bc1)
             with open(bc2) as IN:
                 for line in IN:
                     sample, cnt = line.strip().split(' ')
-                    c = Counter()
-                    c[stat] = int(cnt)
                     cntr[sample[:-2]] += int(cnt)
-                    self.statq.put((sample[:-2], c))
             os.remove(bc2)
             for s in self.samples.values():
                 if s.base_name() not in cntr:
                     cntr[s.base_name()] += 0
-            msg = '\n'.join(['%s: %i' % (s, c) for s, c in cntr.items()])
-            self.log(lg.CRITICAL, 'read counts:\n' + msg)
+            return cntr
 
         hb = {}
         for b,s in self.samples.items():
             hb.update({eb:s.base_name() for eb in hamming_ball(b, self.a.hamming_distance)})
 
-        awk1p, cnt1 = compile_awk("1", {b: s.base_name() for b,s in self.samples.items()})
+        progress = self.tmp_dir + os.sep + 'split.progress'
+        awk1p, cnt1 = compile_awk("1", {b: s.base_name() for b,s in self.samples.items()}, progress)
         awk2p, cnt2 = compile_awk("2", hb)
         outf = open(os.devnull, 'w') if no_bc is None else open(no_bc, 'wb')
+        self.status.split_started(self.input_files)
         for r1, r2 in self.input_files:
             msg = 'splitting files:\n%s\n%s' % (os.path.split(r1)[1],os.path.split(r2)[1])
             self.log(lg.INFO, msg)
-            paste1 = sp.Popen('paste <(zcat %s) <(zcat %s)' % (r1,r2), stdout=sp.PIPE,
-                              shell=True, executable='/bin/bash')
+            # inputs are read through inherited descriptors, so their offset shows how much was read
+            IN1, IN2 = open(r1, 'rb'), open(r2, 'rb')
+            self.status.split_reading(IN1, progress)
+            paste1 = sp.Popen('paste <(zcat <&%i) <(zcat <&%i)' % (IN1.fileno(), IN2.fileno()), stdout=sp.PIPE,
+                              shell=True, executable='/bin/bash', pass_fds=(IN1.fileno(), IN2.fileno()))
             awkin = sp.Popen(sh.split('paste - - - -'), stdin=paste1.stdout, stdout=sp.PIPE)
             if self.a.debug: # only a subset of reads
                 nlines = round(self.a.db_nlines/4)*4  # making sure it's in fastq units
@@ -676,24 +803,39 @@ class ExperimentHandler(object):
             wfastq = sp.Popen(sh.split(awkcmd), stdin=awk2.stdout, stdout=sp.PIPE)
             gzip = sp.Popen(['gzip'], stdin=wfastq.stdout, stdout=outf)
             wfastq.wait() # to prevent data interleaving
+            self.status.split_pair_done()
+            IN1.close()
+            IN2.close()
         gzip.wait()
         self.log(lg.INFO, 'Barcode splitting finished.')
 
-        merge_statistics(cnt1, cnt2)
+        read_counts = merge_statistics(cnt1, cnt2)
+        self.report_read_counts(read_counts)
+        return read_counts
+
+    def report_read_counts(self, read_counts):
+        for s, n in read_counts.items():
+            self.statq.put((s, Counter({'n_reads': n})))
+        self.statq.put(FLUSH)
+        msg = '\n'.join(['%s: %i' % (s, c) for s, c in read_counts.items()])
+        self.log(lg.CRITICAL, 'read counts:\n' + msg)
 
     def build_hub(self):
         self.log(lg.INFO, 'Generating hub...')
-        hubfile = open(self.www_path + os.path.sep + 'hub.txt', 'w')
+        hub_dir = self.www_path + '.tmp'  # the hub is built aside, and then replaces the previous one
+        if os.path.isdir(hub_dir): shutil.rmtree(hub_dir)
+        self.dir_and_log(hub_dir, lg.INFO, chto='777')
+        hubfile = open(hub_dir + os.path.sep + 'hub.txt', 'w')
         mainurl = os.sep.join([URL_BASE, self.www_rel, 'hub.txt'])
         hubfile.write('\n'.join(["hub %s" % self.a.hub_name,
                                  "shortLabel %s" % self.a.hub_name,
                                  "longLabel %s(%s)" % (self.a.hub_name, self.exp),
                                  "genomesFile genomes.txt",
                                  "email %s" % self.a.hub_email]))
-        genomesfile = open(self.www_path + os.path.sep + 'genomes.txt', 'w')
+        genomesfile = open(hub_dir + os.path.sep + 'genomes.txt', 'w')
         genomesfile.write("genome %s\n"
                           "trackDb trackDB.txt" % COMMON_GENOMES['SCER']['assembly'])
-        trackfile = open(self.www_path + os.path.sep + 'trackDB.txt', 'w')
+        trackfile = open(hub_dir + os.path.sep + 'trackDB.txt', 'w')
         for s in self.samples.values():
             wurl = os.sep.join([URL_BASE, self.www_rel, BW_DIR, s.base_name()+'.w.bw'])
             curl = os.sep.join([URL_BASE, self.www_rel, BW_DIR, s.base_name()+'.c.bw'])
@@ -733,31 +875,68 @@ class ExperimentHandler(object):
             trackfile.write(wentry+'\n\n')
             trackfile.write(centry+'\n\n')
         trackfile.close()
+        hubfile.close()
+        genomesfile.close()
+        shutil.move(self.bw_dir, hub_dir)
+        sp.call('chmod -R 777 %s' % hub_dir, shell=True)
+        if os.path.isdir(self.www_path):
+            self.log(lg.DEBUG, 'Replacing old hub folder')
+            os.rename(self.www_path, self.www_path + '.old')
+        os.rename(hub_dir, self.www_path)
+        if os.path.isdir(self.www_path + '.old'): shutil.rmtree(self.www_path + '.old')
         new_path = self.www_path + os.sep + BW_DIR
-        shutil.move(self.bw_dir, self.www_path)
         os.symlink(new_path, self.bw_dir, target_is_directory=True)
-        sp.call('chmod -R 777 %s' % self.www_path, shell=True)
         msg = 'Transferred bigwig files to %s (link available in %s as well)' % (new_path, self.a.output_dir)
         self.log(lg.DEBUG, msg)
         self.log(lg.CRITICAL, 'Hub available at %s' % mainurl)
 
     def export(self, tts_cnts, out_stats, stat_order):
-        stats = OrderedDict()
-        cnts = OrderedDict()
-        for s in self.samples.values():
-            stats[s] = out_stats[s.base_name()]
-            cnts[s] = tts_cnts[s.barcode]
-        all = [('stats', stats, stat_order),
-               ('tts', cnts, self.tts_accs)]
-
+        """
+        run all exporters in parallel with the work manager, over tables that are built once
+        """
+        samples = list(self.samples.values())
+        tables = [Table.from_dict('stats', {s: out_stats[s.base_name()] for s in samples}, samples, stat_order),
+                  Table.from_dict('tts', {s: tts_cnts[s.barcode] for s in samples}, samples, self.tts_accs)]
+        args = (list(self.features.values()), [s.detached() for s in samples], tables)
+        channels = []
         for e in self.exporters:
-            fs = e.export(self.features.values(), self.samples.values(), all)
+            channels.append(self.w_manager.get_channel())
+            self.w_manager.execute(func=e.export, args=args, c=channels[-1], name='export-' + type(e).name,
+                                   local=True)  # short writes, not worth a place in the cluster queue
+        if self.a.store_path is not None:  # merged into the cross-experiment store along with the exports
+            store_c = self.w_manager.get_channel()
+            self.w_manager.execute(func=CountStore(self.a.store_path).append,
+                                   args=((self.user, self.proj, self.exp),) + args + (self.a.output_dir,),
+                                   c=store_c, name='store', slurm_spec={'cpus-per-task': 1, 'mem': '8G'})
+        for e, c in zip(self.exporters, channels):
+            fs, err = c.get()
+            if err is not None:
+                self.log(lg.ERROR, 'Error while exporting with %s:\n%s' % (type(e).name, err))
+                continue
             for f in fs:
                 self.log(lg.INFO, 'Exported data to file: %s' % (self.a.output_dir+os.sep+f,))
                 if self.a.export_path is not None:
                     target = self.a.export_path + os.sep + self.exp + '-' + f
                     shutil.copy(self.a.output_dir + os.sep + f, target)
                     self.log(lg.DEBUG, 'Copied data to: %s' % target)
+        if self.a.store_path is not None:
+            seg, err = store_c.get()
+            if err is not None: self.log(lg.ERROR, 'Error while adding counts to the store:\n%s' % err)
+            else: self.log(lg.INFO, 'Counts added to the store at %s (segment %s)' % (self.a.store_path, seg))
+
+    def export_sample(self, sample, tts_cnt):
+        """
+        pass the statistics and counts of a completed sample to exporters that write incrementally
+        """
+        self.statq.put((REQUEST, sample.base_name()))  # handled after all statistics the sample reported so far
+        stats = self.stat_replies.get()
+        tables = [Table.from_dict('stats', {sample: stats}, [sample], list(stats)),
+                  Table.from_dict('tts', {sample: tts_cnt}, [sample], self.tts_accs)]
+        for e in self.exporters:
+            try:
+                e.add_sample(self.features.values(), self.samples.values(), sample, tables)
+            except Exception as ex:  # export() writes everything again when all samples are done
+                self.log(lg.ERROR, 'Could not export sample %s (%s): %s' % (sample.base_name(), e.name, ex))
 
     def aftermath(self, tts_counters):
         # remove temp folder
@@ -766,20 +945,28 @@ class ExperimentHandler(object):
         # store pipeline code?
         # merge and report statistics
         # merge data to single (usable) files
+        pickle.dump(self.a, open(self.a.output_dir + os.sep + 'args.pkl', 'wb'))
+
+        # measurements of sample tasks are passed on to the statistics, so they are collected before stats are final
+        self.profq.put(('sync', None))
+        self.prof_synced.wait()
+        self.statq.put(None)
+        self.stat_thread.join()
+        all_stats, sord = self.statq.get()
+        self.export(tts_counters, all_stats, sord)
+        self.w_manager.join()
+        self.profq.put(None)
+        self.prof_thread.join()
+        self.timeline.write(self.a.output_dir + os.sep + 'timeline.json')
+        self.status.stop()
+
         if self.a.debug is None:
             shutil.rmtree(self.tmp_dir)
 
-        pickle.dump(self.a, open(self.a.output_dir + os.sep + 'args.pkl', 'wb'))
-
         self.log(lg.CRITICAL, 'All done.')
         shutil.copy(self.logfile, self.a.output_dir + os.sep + 'full.log')
         self.logq.put(None)
         self.logger.join()
-        self.statq.put(None)
-        all_stats, sord = self.statq.get()
-        self.export(tts_counters, all_stats, sord)
-        self.stat_thread.join()
-        self.w_manager.close()
 
     def dir_and_log(self, path, level=lg.DEBUG, chto='770'):
         self.log(level, 'creating folder %s' % path)
@@ -797,6 +984,13 @@ def build_parser():
                         'all files in the path with the prefix are considered')
     g.add_argument('--max_workers', '-mw', type=int, default=100,
                    help='maximal number of simultaneous working processes in this pipeline')
+    g.add_argument('--cluster', '-cl', type=str, choices=['slurm', 'local'], default='slurm',
+                   help='where cluster jobs are executed. "local" runs them on this machine through a stand-in '
+                        'for slurm (with the same job specifications), for testing and benchmarking')
+    g.add_argument('--transport', '-tr', type=str, choices=['auto', 'tcp', 'files'], default='auto',
+                   help='how cluster jobs get their inputs and return outputs: over tcp connections to this machine, '
+                        'through files in the (shared) output folder, or "auto" - tcp, and files for jobs on nodes '
+                        'that can\'t connect')
     g = p.add_argument_group('Output')
     g.add_argument('--output_dir', '-od', default=None, type=str,
                    help='path to the folder in which most files are written. '
@@ -805,6 +999,9 @@ def build_parser():
     g.add_argument('--user_emails', '-ue', default=None, type=str,
                    help="if provided these comma separated emails will receive notifications of ctitical "
                         "events (checkpoints, fatal errors, etc.)")
+    g.add_argument('--no_cache', '-nc', action='store_true',
+                   help='ignore stage results cached by a previous run in the same output folder (-od), and '
+                        'recompute everything')
     g.add_argument('--debug', '-d', default=None, type=str,
                    help='Highly recommended. Use this mode with a pair of comma separated integers:'
                         '<numlines>,<numsamples>. The pipeline will extract this number of lines from '
@@ -838,6 +1035,9 @@ def build_parser():
                         '"klac:/cs/wetlab/genomics/klac/bowtie/genome,human:/cs/wetlab/genomics/human/bowtie/genome"')
     g.add_argument('--n_threads', '-an', type=int, default=4,
                    help='number of threads used for alignment per bowtie instance')
+    g.add_argument('--keep_unfiltered', '-kuf', action='store_true',
+                   help='if set, the BAM file of aligned reads is kept before filtering (in the BAM folder), '
+                        'so that a re-run with a different filter (-F) does not re-align reads')
     g.add_argument('--keep_unaligned', '-ku', action='store_true',
                    help='if set, unaligned reads are written to '
                         'output_folder/%s/<sample_name>.bam' % UNALIGNED_DIR)
@@ -883,6 +1083,9 @@ def build_parser():
                    help='specify a exporters for the pipeline data and statistics. default = "tab();mat(r=True)"')
     g.add_argument('--export_path', '-ep', default=None,
                    help='if given, exported data is copied to this path as well')
+    g.add_argument('--store_path', '-sp', default=None,
+                   help='if given, counts and statistics are appended to the cross-experiment count store in this '
+                        'folder (see transeq/store.py)')
     g.add_argument('--exporter_specs', '-eh', action='store_true',
                    help='print available exporters, exporter help and exit')
     return p
@@ -905,12 +1108,13 @@ def pprint_class_with_args_dict(dict):
     return '\n'.join(slist)
 
 
-def parse_args(p):
+def parse_args(p, argv=None):
     """
     :param p: argument parser
+    :param argv: arguments to parse, default is the command line
     :return: the arguments parsed, after applying all argument logic and conversion
     """
-    args = p.parse_args()
+    args = p.parse_args(argv)
 
     if args.filter_specs:
         h = ('Any collection of filters can be applied. The only reads that are written to the BAM '
@@ -965,6 +1169,9 @@ def parse_args(p):
     if args.export_path is not None:
         args.__dict__['export_path'] = canonic_path(args.export_path)
 
+    if args.store_path is not None:
+        args.__dict__['store_path'] = canonic_path(args.store_path)
+
     if args.count_index_paths is not None:
         args.__dict__['count_index_paths'] = [pair.split(':') for pair in args.count_index_paths.split(',')]
 
@@ -11,11 +11,13 @@ import multiprocessing as mp
 import sys
 import threading
 import traceback
+from collections import OrderedDict
 from queue import Empty
 
 import dill
 
 from common import slurm
+from common import timing
 
 
 def dict_annotated_function(default_setter=None):
@@ -90,6 +92,29 @@ def dict_annotated_function(default_setter=None):
 class ExecError(Exception): pass
 
 
+class ProcessExecutor(object):
+    """
+    Runs every task in a new local process. Like slurm.SlurmBackend, it implements the executor interface used by
+    WorkManager - submit(tasks), with each task a (f, args, kwargs, slurm_spec, callback) tuple, and close().
+    Here, callback(out, err) is called from the child process, and the slurm specification is ignored.
+    """
+
+    def submit(self, tasks):
+        for f, args, kwargs, _, callback in tasks:
+            mp.Process(target=ProcessExecutor.exec_wrapper, args=(f, args, kwargs, callback)).start()
+
+    def close(self): pass
+
+    @staticmethod
+    def exec_wrapper(f, args, kwargs, callback):
+        err = None  # benefit of the doubt
+        try:
+            out = f(*args, **kwargs)
+        except Exception:
+            out, err = None, traceback.format_exc(10)
+        callback(out, err)
+
+
 class WorkManager(object):
     """
     An object that allows one to send parallel tasks without worrying about how, where and when they are executed.
@@ -100,6 +125,14 @@ class WorkManager(object):
     wm.exec(func1, kwargs=dict(), report_q=myQ)
     result, err = myQ.get() # waiting for result
     if err is None: handle(result)
+
+    If a profiling channel is given, every task is timed, and (name, measurement) is put in it when the task is
+    done (see common.timing), name is given to execute, or the function name by default.
+
+    Tasks without a slurm specification are executed in local processes, the rest are passed to the executor,
+    which is a slurm.SlurmBackend by default, with the given transport (see slurm.make_transport, default is "auto" -
+    tcp, falling back to files). For testing and benchmarking, a backend over a slurm.LocalCluster can be given
+    instead.
     """
 
     def dispatch(self):
@@ -110,14 +143,20 @@ class WorkManager(object):
         wid, roster, tasks, incoming = 0, {}, [], True
         intercom = self.get_channel()
         while incoming or roster or tasks:
-            # executing tasks
+            # executing tasks, tasks are submitted together so slurm tasks can be batched to job arrays
+            local, batch = [], []
             while len(roster) < self.max_w and tasks:
-                slurm_spec, func, args, kwargs, c = dill.loads(tasks.pop())
-                w = mp.Process(target=self.exec_wrapper,
-                               args=(func, args, kwargs, c, intercom, wid, slurm_spec, self.tmp_path))
-                w.start()
-                roster[wid] = w
+                slurm_spec, func, args, kwargs, c, name = dill.loads(tasks.pop())
+                if name is None: name = func.__name__
+                if self.profq is not None: func = functools.partial(timing.run_timed, func)
+                callback = functools.partial(self.report, c, intercom, wid, name, self.profq)
+                task = (func, args, kwargs, slurm_spec, callback)
+                if slurm_spec is None: local.append(task)
+                else: batch.append(task)
+                roster[wid] = slurm_spec
                 wid += 1
+            if local: self.local.submit(local)
+            if batch: self.executor.submit(batch)
             # collect new tasks
             if incoming:
                 while True:
@@ -130,15 +169,21 @@ class WorkManager(object):
             while True:
                 try: del roster[intercom.get(timeout=self.delay)]
                 except Empty: break
-        self.work.put(None)
+            self.queued, self.running, self.submitted = len(tasks), len(roster), wid
+        self.executor.close()
 
-    def __init__(self, max_w=sys.maxsize, delay=.01, default_slurm_spec=None, tmp_path=None):
+    def __init__(self, max_w=sys.maxsize, delay=.01, default_slurm_spec=None, tmp_path=None, executor=None,
+                 profq=None, transport=None):
         self.manager = mp.Manager()
         self.tmp_path = tmp_path
         self.work = self.get_channel()
         self.default_slurm_spec = default_slurm_spec
         self.max_w = max_w
         self.delay = delay
+        self.profq = profq
+        self.local = ProcessExecutor()
+        self.executor = slurm.SlurmBackend(tmp_path, transport=transport) if executor is None else executor
+        self.queued, self.running, self.submitted = 0, 0, 0
         self.dispatcher = threading.Thread(target=self.dispatch)
         self.dispatcher.start()
 
@@ -148,24 +193,35 @@ class WorkManager(object):
     def close(self):
         self.work.put(None)
 
+    def status(self):
+        """
+        :return: the number of tasks waiting to be dispatched, running, and dispatched so far
+        """
+        return OrderedDict([('queued', self.queued + self.work.qsize()),
+                            ('running', self.running),
+                            ('max_workers', self.max_w),
+                            ('submitted', self.submitted)])
+
     def join(self):
         self.close()
-        self.work.get()
+        self.dispatcher.join()
 
-    def execute(self, func, args=None, kwargs=None, c=None, slurm_spec=None):
+    def execute(self, func, args=None, kwargs=None, c=None, slurm_spec=None, name=None, local=False):
+        """
+        :param slurm_spec: default is default_slurm_spec
+        :param local: run the task in a local process, regardless of the slurm specifications
+        """
         if args is None: args = tuple()
         if kwargs is None: kwargs = dict()
-        if slurm_spec is None: slurm_spec = self.default_slurm_spec
-        self.work.put(dill.dumps((slurm_spec, func, args, kwargs, c)))
+        if local: slurm_spec = None
+        elif slurm_spec is None: slurm_spec = self.default_slurm_spec
+        self.work.put(dill.dumps((slurm_spec, func, args, kwargs, c, name)))
 
     @staticmethod
-    def exec_wrapper(f, args, kwargs, c, intercom, wid, slurm_spec, tmp_path=None):
-        err = None  # benefit of the doubt
-        try:
-            if slurm_spec is not None: out = slurm.execute(f, args, kwargs, slurm_spec, tmp_path=tmp_path)
-            else: out = f(*args, **kwargs)
-        except Exception:
-            out, err = None, traceback.format_exc(10)
+    def report(c, intercom, wid, name, profq, out, err):
+        if profq is not None and err is None:
+            out, m = out
+            profq.put((name, m))
         if c is not None: c.put((out, err))
         intercom.put(wid)  # notify dispatcher that task is done
 
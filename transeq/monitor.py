@@ -0,0 +1,172 @@
+"""
+Live status of a running experiment. The status is periodically written as json to the output folder (status.json)
+so long runs can be followed from anywhere the output folder is visible, e.g.:
+---
+watch -n 10 "python -m json.tool /path/to/output/status.json"
+---
+The status holds the progress and throughput of barcode splitting, the running/done stages of every sample, the
+progress of running alignments, the WorkManager queue, and an ETA for every one of these and for the whole run.
+Progress of the awk/bowtie pipes is reported by the pipes themselves - they write the number of reads they have
+processed to a progress file every PROGRESS_EVERY reads.
+"""
+
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+PROGRESS_EVERY = 100000
+
+
+def read_progress(path):
+    """
+    :return: the number of reads reported in a progress file, 0 if not available
+    """
+    try:
+        with open(path) as IN: return int(IN.read().strip() or 0)
+    except (IOError, ValueError):
+        return 0
+
+
+def eta(done, total, elapsed):
+    if not done or total is None or elapsed <= 0: return None
+    return round(max(total - done, 0) * elapsed / done)
+
+
+class StatusMonitor(object):
+
+    def __init__(self, path, samples, stages, w_manager=None, interval=10.):
+        """
+        :param path: the status file path
+        :param samples: sample names
+        :param stages: the stages every sample goes through
+        :param w_manager: if given, its queue status is reported
+        """
+        self.path = path
+        self.stages = stages
+        self.w_manager = w_manager
+        self.interval = interval
+        self.start = time.time()
+        self.lock = threading.Lock()
+        self.split = OrderedDict([('state', 'waiting'), ('reads', 0)])
+        self.split_input = None  # (file handle of the R1 being read, progress path)
+        self.split_bytes = [0, 0]  # done, total
+        self.samples = OrderedDict((s, OrderedDict([('reads', None), ('running', OrderedDict()), ('done', []),
+                                                     ('cached', []), ('failed', [])])) for s in samples)
+        self.align_progress = {}
+        self.done = threading.Event()
+        self.writer = threading.Thread(target=self.write_periodically)
+        self.writer.daemon = True
+
+    def run(self):
+        self.writer.start()
+
+    def stop(self):
+        self.done.set()
+        self.writer.join()
+
+    def split_started(self, input_files):
+        with self.lock:
+            self.split.update(state='running', started=time.time())
+            self.split_bytes = [0, sum(os.path.getsize(r1) for r1, _ in input_files)]
+
+    def split_reading(self, r1_handle, progress_path):
+        """
+        :param r1_handle: a file handle shared with the process reading R1, its offset is the position in the file
+        """
+        with self.lock: self.split_input = (r1_handle, progress_path)
+
+    def split_pair_done(self):
+        with self.lock:
+            r1, progress = self.split_input
+            self.split['reads'] += read_progress(progress)
+            self.split_bytes[0] += os.fstat(r1.fileno()).st_size
+            self.split_input = None
+            if os.path.isfile(progress): os.remove(progress)  # the next pair reports to the same file
+
+    def split_done(self, read_counts, cached=False):
+        with self.lock:
+            self.split.update(state='cached' if cached else 'done', reads=sum(read_counts.values()))
+            self.split_input = None
+            for s, n in read_counts.items():
+                if s in self.samples: self.samples[s]['reads'] = n
+
+    def stage_started(self, sample, stage, cached=False, progress_path=None):
+        with self.lock:
+            if cached:
+                self.samples[sample]['cached'].append(stage)
+            else:
+                self.samples[sample]['running'][stage] = time.time()
+                if progress_path is not None: self.align_progress[sample] = progress_path
+
+    def sample_failed(self, sample):
+        with self.lock:
+            s = self.samples[sample]
+            s['failed'].extend(s['running'])
+            s['running'].clear()
+
+    def stage_done(self, sample, stage, failed=False):
+        with self.lock:
+            s = self.samples[sample]
+            if stage in s['running']:
+                del s['running'][stage]
+                s['failed' if failed else 'done'].append(stage)
+
+    def split_status(self, now):
+        st = OrderedDict(self.split)
+        if st['state'] != 'running': return st
+        elapsed = now - st['started']
+        done_bytes = self.split_bytes[0]
+        if self.split_input is not None:
+            r1, progress = self.split_input
+            st['reads'] += read_progress(progress)
+            done_bytes += os.lseek(r1.fileno(), 0, os.SEEK_CUR)
+        st['reads_per_sec'] = round(st['reads'] / elapsed) if elapsed > 0 else None
+        st['progress'] = round(done_bytes / self.split_bytes[1], 3) if self.split_bytes[1] else None
+        st['eta'] = eta(done_bytes, self.split_bytes[1], elapsed)
+        return st
+
+    def sample_status(self, sample, now):
+        s = self.samples[sample]
+        st = OrderedDict([('reads', s['reads'])] + [(k, list(s[k])) for k in ['done', 'cached', 'failed']])
+        st['running'] = OrderedDict()
+        for stage, started in s['running'].items():
+            rst = OrderedDict([('elapsed', round(now - started))])
+            if stage == 'align' and sample in self.align_progress:
+                n = read_progress(self.align_progress[sample])
+                rst['reads'] = n
+                rst['reads_per_sec'] = round(n / (now - started)) if now > started else None
+                rst['eta'] = eta(n, s['reads'], now - started)
+            st['running'][stage] = rst
+        return st
+
+    def status(self):
+        """
+        :return: a json-able status
+        """
+        now = time.time()
+        with self.lock:
+            split = self.split_status(now)
+            samples = OrderedDict((s, self.sample_status(s, now)) for s in self.samples)
+        done = {'waiting': 0, 'running': split.get('progress') or 0}.get(split['state'], 1)
+        done += (sum(len(s['done']) + len(s['cached']) + len(s['failed']) for s in samples.values()) /
+                 max(len(self.stages), 1))
+        progress = done / (1 + len(samples))
+        elapsed = now - self.start
+        st = OrderedDict([('updated', time.strftime('%Y-%m-%d %H:%M:%S')),
+                          ('elapsed', round(elapsed)),
+                          ('progress', round(progress, 3)),
+                          ('eta', eta(progress, 1, elapsed)),
+                          ('split', split),
+                          ('samples', samples)])
+        if self.w_manager is not None: st['work'] = self.w_manager.status()
+        return st
+
+    def write(self):
+        with open(self.path + '.tmp', 'w') as OUT: json.dump(self.status(), OUT, indent=1)
+        os.replace(self.path + '.tmp', self.path)
+
+    def write_periodically(self):
+        while not self.done.wait(self.interval): self.write()
+        self.write()
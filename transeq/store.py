@@ -0,0 +1,153 @@
+"""
+An append-only store of count tables across experiments. Every finished run appends a segment - its tables (e.g.
+"tts" and "stats", rows x samples) as .npy files - and a catalog record per sample, keyed by (user, project,
+experiment, sample features). An index maps every row name (e.g. a gene) of every table to its position in every
+segment, so a gene is retrieved across all experiments with one memory mapped row read per segment. Usage:
+---
+store = CountStore('/path/to/store')
+store.append(('user', 'proj', 'exp'), features, samples, tables)  # done by the pipeline with --store_path
+records, values = store.get('YAL001C', project='proj', t=11)  # values[i] is the count of records[i]
+---
+Nothing is ever rewritten, except the index, which is replaced atomically. If a sample is appended again (e.g. an
+experiment is re-run), the latest record of its key is the one returned.
+"""
+
+import fcntl
+import json
+import os
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import numpy as np
+
+CATALOG_FNAME = 'catalog.jsonl'
+INDEX_FNAME = 'index.json'
+SEGMENTS_DIR = 'segments'
+META_KEYS = ('user', 'project', 'experiment')
+
+
+class CountStore(object):
+
+    def __init__(self, path):
+        self.path = path
+        self.seg_path = path + os.sep + SEGMENTS_DIR
+        os.makedirs(self.seg_path, exist_ok=True)
+        self._index = None  # loaded on demand
+        self._index_mtime = None
+
+    @contextmanager
+    def locked(self):
+        """
+        serializes appends of concurrent runs
+        """
+        with open(self.path + os.sep + '.lock', 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def append(self, meta, features, samples, tables, source=None):
+        """
+        :param meta: a (user, project, experiment) triple
+        :param features: the sample features
+        :param samples: the samples, in table column order
+        :param tables: a list of exporters.Table objects
+        :param source: optional, e.g. the output folder of the run
+        :return: the new segment name
+        """
+        features, samples = list(features), list(samples)
+        with self.locked():
+            seg = '%06i' % len(os.listdir(self.seg_path))
+            d = self.seg_path + os.sep + seg
+            os.makedirs(d + '.tmp')
+            smeta = OrderedDict([('segment', seg), ('time', time.strftime('%Y-%m-%d %H:%M:%S')), ('source', source),
+                                 ('features', [OrderedDict([('name', f.name), ('short_name', f.short_name),
+                                                            ('type', f.strtype), ('units', f.units)])
+                                               for f in features]),
+                                 ('tables', OrderedDict())])
+            for t in tables:
+                np.save(d + '.tmp' + os.sep + t.name + '.npy', np.ascontiguousarray(t.data, dtype=np.double))
+                smeta['tables'][t.name] = t.rows
+            with open(d + '.tmp' + os.sep + 'meta.json', 'w') as OUT: json.dump(smeta, OUT)
+            os.rename(d + '.tmp', d)  # a segment is either complete or absent
+
+            with open(self.path + os.sep + CATALOG_FNAME, 'a') as OUT:
+                for i, s in enumerate(samples):
+                    rec = OrderedDict(zip(META_KEYS, meta))
+                    rec.update([('sample', s.base_name()),
+                                ('features', OrderedDict((f.name, s.fvals[f]) for f in features)),
+                                ('segment', seg), ('column', i), ('time', smeta['time'])])
+                    OUT.write(json.dumps(rec) + '\n')
+
+            index = self.index()
+            for t in tables:
+                tidx = index.setdefault(t.name, {})
+                for i, r in enumerate(t.rows): tidx.setdefault(r, []).append([seg, i])
+            with open(self.path + os.sep + INDEX_FNAME + '.tmp', 'w') as OUT: json.dump(index, OUT)
+            os.replace(self.path + os.sep + INDEX_FNAME + '.tmp', self.path + os.sep + INDEX_FNAME)
+        return seg
+
+    def index(self):
+        """
+        :return: a map from table name to a map from row name to a list of (segment, row index) pairs
+        """
+        path = self.path + os.sep + INDEX_FNAME
+        if not os.path.isfile(path): return {}
+        mtime = os.stat(path).st_mtime_ns
+        if self._index is None or mtime != self._index_mtime:
+            with open(path) as IN: self._index = json.load(IN)
+            self._index_mtime = mtime
+        return self._index
+
+    def catalog(self):
+        """
+        :return: the latest record of every (user, project, experiment, sample features) key, in append order
+        """
+        path = self.path + os.sep + CATALOG_FNAME
+        if not os.path.isfile(path): return []
+        latest = OrderedDict()
+        with open(path) as IN:
+            for line in IN:
+                if not line.strip(): continue
+                rec = json.loads(line, object_pairs_hook=OrderedDict)
+                key = tuple(rec[k] for k in META_KEYS) + tuple(sorted(rec['features'].items()))
+                latest.pop(key, None)
+                latest[key] = rec
+        return list(latest.values())
+
+    def select(self, **criteria):
+        """
+        :param criteria: values of user, project, experiment or any sample feature, e.g. select(project='p', t=11)
+        :return: the matching catalog records
+        """
+        def match(rec):
+            for k, v in criteria.items():
+                if k in META_KEYS: val = rec[k]
+                elif k in rec['features']: val = rec['features'][k]
+                else: return False
+                if val != v: return False
+            return True
+        return [rec for rec in self.catalog() if match(rec)]
+
+    def segment(self, seg, table, mmap_mode='r'):
+        return np.load(self.seg_path + os.sep + seg + os.sep + table + '.npy', mmap_mode=mmap_mode)
+
+    def get(self, row, table='tts', **criteria):
+        """
+        :param row: a row name, e.g. a gene
+        :return: the catalog records (as in select) that have this row, and an array of their values
+        """
+        where = dict((seg, i) for seg, i in self.index().get(table, {}).get(row, []))
+        recs = [rec for rec in self.select(**criteria) if rec['segment'] in where]
+        rows = {}
+        for seg in set(rec['segment'] for rec in recs):
+            rows[seg] = np.array(self.segment(seg, table)[where[seg]])
+        return recs, np.array([rows[rec['segment']][rec['column']] for rec in recs], dtype=np.double)
+
+    def experiments(self):
+        """
+        :return: the (user, project, experiment) triples in the store
+        """
+        return list(OrderedDict((tuple(rec[k] for k in META_KEYS), None) for rec in self.catalog()))
@@ -0,0 +1,215 @@
+"""
+Synthetic TranSeq data, for benchmarking the pipeline. Usage:
+---
+genome = ToyGenome.generate(out_dir + '/genome')   # sacCer3 sized random genome, with genes and a tts annotation
+barcodes = plate_barcodes()[:12]
+write_sample_db(out_dir + '/sample_db.csv', barcodes, 'bench')
+simulate_reads(genome, barcodes, 10**6, out_dir + '/bench')  # -> bench_R1.fastq.gz, bench_R2.fastq.gz
+---
+Reads mimic the library structure the pipeline expects - R1 is the 3' end of a transcript followed by a polyA tail,
+and R2 starts with the sample barcode and the UMI followed by a dT stretch. A fraction of the reads has a barcode
+error (within hamming distance 1), an unknown barcode, or is a PCR duplicate of an earlier read.
+"""
+
+import argparse
+import csv
+import gzip
+import os
+import sys
+
+import numpy as np
+
+project_dir = os.path.sep.join(sys.modules[__name__].__file__.split(os.path.sep)[:-2])
+sys.path.append(project_dir)
+
+BASES = np.array(list('ACGT'))
+COMPLEMENT = str.maketrans('ACGTN', 'TGCAN')
+PLATE_BARCODES = project_dir + os.sep + os.sep.join(['data', 'transeq_barcodes.csv'])
+SACCER_SIZES = project_dir + os.sep + os.sep.join(['data', 'sacCer3.sizes'])
+
+
+def revcomp(seq):
+    return seq.translate(COMPLEMENT)[::-1]
+
+
+def random_seq(rs, n):
+    return ''.join(BASES[rs.randint(0, 4, n)])
+
+
+def random_seqs(rs, n, length):
+    """
+    :return: an array of n random sequences of the given length
+    """
+    return BASES[rs.randint(0, 4, (n, length))].view('U%i' % length).ravel()
+
+
+def plate_barcodes(path=PLATE_BARCODES):
+    """
+    :return: a list of (barcode, row, column) tuples from the plate layout barcode file
+    """
+    with open(path, newline='') as IN:
+        rows = list(csv.reader(IN))
+    return [(r[0], r[1], int(r[2])) for r in rows[1:] if r and r[0] and r[1]]
+
+
+def write_sample_db(path, barcodes, exp, proj='benchmark'):
+    with open(path, 'w') as OUT:
+        OUT.write('project: %s\nexperiment: %s\n' % (proj, exp))
+        OUT.write('barcode,row(r):str,col(c):int\n')
+        for bc, row, col in barcodes:
+            OUT.write('%s,%s,%i\n' % (bc, row, col))
+
+
+class ToyGenome(object):
+    """
+    A random genome with the chromosome sizes of sacCer3 (scaled by a given factor), and randomly placed genes
+    """
+
+    def __init__(self, path, chroms, genes):
+        self.path = path
+        self.chroms = chroms  # chromosome name -> sequence
+        self.genes = genes  # list of (acc, chr, orf_start, orf_end, tts), orf_start > orf_end on the crick strand
+        self.fasta = path + os.sep + 'genome.fa'
+        self.sizes = path + os.sep + 'genome.sizes'
+        self.tts = path + os.sep + 'tts.tsv'
+
+    @classmethod
+    def generate(cls, path, scale=1., n_genes=6000, seed=0, sizes=SACCER_SIZES):
+        """
+        :param path: a folder to which the genome fasta, chromosome sizes and tts annotation are written. If it
+                     already holds a genome generated with the same parameters, it is loaded instead.
+        :param scale: chromosome size factor
+        """
+        params = '%s %f %i %i' % (sizes, scale, n_genes, seed)
+        if os.path.isfile(path + os.sep + 'params') and open(path + os.sep + 'params').read() == params:
+            return cls.load(path)
+        os.makedirs(path, exist_ok=True)
+        rs = np.random.RandomState(seed)
+        chroms = {}
+        for line in open(sizes):
+            c, l = line.strip().split('\t')
+            chroms[c] = random_seq(rs, max(int(int(l) * scale), 10000))
+        names = sorted(chroms)
+        lens = np.array([len(chroms[c]) for c in names], dtype=float)
+        genes = []
+        for i, ci in enumerate(rs.choice(len(names), n_genes, p=lens / lens.sum())):
+            c = names[ci]
+            orf_len, utr = rs.randint(300, 3000), rs.randint(50, 300)
+            start = rs.randint(1000, len(chroms[c]) - orf_len - 1000)
+            if rs.rand() < .5:
+                genes.append(('G%05iW' % i, c, start, start + orf_len, start + orf_len + utr))
+            else:
+                genes.append(('G%05iC' % i, c, start + orf_len, start, start - utr))
+        g = cls(path, chroms, genes)
+        g.write()
+        with open(path + os.sep + 'params', 'w') as OUT: OUT.write(params)
+        return g
+
+    @classmethod
+    def load(cls, path):
+        chroms, c = {}, None
+        with open(path + os.sep + 'genome.fa') as IN:
+            for line in IN:
+                if line.startswith('>'):
+                    c = line[1:].strip()
+                    chroms[c] = []
+                else:
+                    chroms[c].append(line.strip())
+        chroms = {c: ''.join(s) for c, s in chroms.items()}
+        genes = []
+        with open(path + os.sep + 'tts.tsv') as IN:
+            for line in IN:
+                acc, c, s, e, t = line.strip().split('\t')
+                genes.append((acc, c, int(s), int(e), int(t)))
+        return cls(path, chroms, genes)
+
+    def write(self):
+        with open(self.fasta, 'w') as OUT:
+            for c, seq in self.chroms.items():
+                OUT.write('>%s\n' % c)
+                for i in range(0, len(seq), 80): OUT.write(seq[i:i + 80] + '\n')
+        with open(self.sizes, 'w') as OUT:
+            for c, seq in self.chroms.items(): OUT.write('%s\t%i\n' % (c, len(seq)))
+        with open(self.tts, 'w') as OUT:
+            for g in self.genes: OUT.write('\t'.join(str(x) for x in g) + '\n')
+
+
+def simulate_reads(genome, barcodes, n_reads, prefix, umi_len=8, r1_len=50, r2_len=40, dup_rate=.1,
+                   bc_err_rate=.03, no_bc_rate=.02, seq_err_rate=.002, seed=1):
+    """
+    write a pair of fastq files with n_reads reads, distributed between the barcodes (samples) and genes
+
+    :param barcodes: a list of (barcode, ...) tuples, as returned from plate_barcodes
+    :param prefix: output path prefix, files are <prefix>_R1.fastq.gz and <prefix>_R2.fastq.gz
+    :return: the paths of the R1 and R2 files
+    """
+    rs = np.random.RandomState(seed)
+    bcs = [b[0] for b in barcodes]
+    bc_len = len(bcs[0])
+    expr = rs.lognormal(0, 1.5, len(genome.genes))  # gene expression
+    sample_expr = expr * rs.lognormal(0, .3, (len(bcs), len(genome.genes)))  # per sample variation
+    sample_expr /= sample_expr.sum(axis=1)[:, None]
+    samples = rs.randint(0, len(bcs), n_reads)
+    genes = np.empty(n_reads, dtype=int)
+    for si in range(len(bcs)):
+        genes[samples == si] = rs.choice(len(genome.genes), (samples == si).sum(), p=sample_expr[si])
+    umis = random_seqs(rs, n_reads, umi_len)
+    r2_ends = random_seqs(rs, n_reads, max(r2_len - bc_len - umi_len - 15, 0))
+    tails = rs.randint(0, 20, n_reads)
+    shifts = rs.normal(0, 30, n_reads).astype(int)
+    qual1, qual2 = 'I' * r1_len, 'I' * r2_len
+    paths = (prefix + '_R1.fastq.gz', prefix + '_R2.fastq.gz')
+    R1, R2 = gzip.open(paths[0], 'wt', compresslevel=1), gzip.open(paths[1], 'wt', compresslevel=1)
+    prev = None
+    for i in range(n_reads):
+        if prev is not None and rs.rand() < dup_rate:
+            r1, r2 = prev  # PCR duplicate - same UMI and position
+        else:
+            si = samples[i]
+            acc, c, start, end, tts = genome.genes[genes[i]]
+            tail = min(tails[i], r1_len - 20)
+            glen = r1_len - tail
+            chrom = genome.chroms[c]
+            if start < end:
+                to = min(max(tts + shifts[i], glen), len(chrom))
+                r1 = chrom[to - glen:to]
+            else:
+                fr = min(max(tts + shifts[i], 0), len(chrom) - glen)
+                r1 = revcomp(chrom[fr:fr + glen])
+            r1 += 'A' * tail
+            bc = bcs[si]
+            u = rs.rand()
+            if u < no_bc_rate:
+                bc = random_seq(rs, bc_len)
+            elif u < no_bc_rate + bc_err_rate:
+                j = rs.randint(bc_len)
+                bc = bc[:j] + BASES[(list(BASES).index(bc[j]) + rs.randint(1, 4)) % 4] + bc[j + 1:]
+            r2 = bc + umis[i] + 'T' * 15 + r2_ends[i]
+            errs = np.where(rs.rand(r1_len) < seq_err_rate)[0]
+            if len(errs):
+                r1 = list(r1)
+                for j in errs: r1[j] = BASES[rs.randint(4)]
+                r1 = ''.join(r1)
+            prev = (r1, r2)
+        R1.write('@bench:%i\n%s\n+\n%s\n' % (i, r1, qual1))
+        R2.write('@bench:%i\n%s\n+\n%s\n' % (i, r2, qual2))
+    R1.close()
+    R2.close()
+    return paths
+
+
+if __name__ == '__main__':
+    p = argparse.ArgumentParser(description='generate a synthetic TranSeq experiment')
+    p.add_argument('output_dir', type=str, help='fastq files, sample_db.csv and genome/ are written here')
+    p.add_argument('--n_reads', '-n', type=float, default=1e5, help='number of read pairs')
+    p.add_argument('--n_samples', '-s', type=int, default=12, help='number of samples (from the plate barcodes)')
+    p.add_argument('--genome_scale', '-g', type=float, default=1., help='genome size, relative to sacCer3')
+    p.add_argument('--umi_length', '-ul', type=int, default=8, help='UMI length')
+    p.add_argument('--seed', type=int, default=1)
+    a = p.parse_args()
+    os.makedirs(a.output_dir, exist_ok=True)
+    g = ToyGenome.generate(a.output_dir + os.sep + 'genome', scale=a.genome_scale)
+    bcs = plate_barcodes()[:a.n_samples]
+    write_sample_db(a.output_dir + os.sep + 'sample_db.csv', bcs, 'synthetic')
+    print('\n'.join(simulate_reads(g, bcs, int(a.n_reads), a.output_dir + os.sep + 'synthetic',
+                                   umi_len=a.umi_length, seed=a.seed)))